@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: benchmark.py
+Description:
+    Benchmarks of optibus_assignment.py on a dataset file, or on a synthetic
+    dataset generated with generate_dataset.py at the requested size.
+    Times each stage and records its peak memory:
+        - load_<backend>: decoding of the file with each other installed JSON
+          backend (orjson, msgspec into dicts, msgspec_typed into structs)
+        - load: decoding of the file with the json module
+        - index: Dataset build from the loaded JSON
+    The load and index stages run through the functions of load_dataset(), with
+    the garbage collector paused as it does. Each stage starts after a collection
+    and the decode stages with no other decoded file alive, so that they are
+    compared on equal terms.
+        - times, stops, breaks: each report on its own
+        - all_reports: the three reports together
+        - stream: the three reports in streaming mode, from the file
+        - cache_warm: Dataset load from a warm cache
+    Results are saved as JSON so runs of different versions can be compared,
+    with --compare flagging the stages that got slower.
+
+Usage: python3 benchmark.py --duties 100000 --output results.json
+       python3 benchmark.py mini_json_dataset.json --compare results.json
+Python Version: 3.9.13
+Dependencies: gc, sys, json, time, argparse, platform, subprocess, tempfile, tracemalloc,
+    pathlib
+"""
+
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+
+from pathlib import Path
+
+import optibus_assignment
+from optibus_assignment import (REPORTS, build_reports, decode_json, get_json_backends,
+                                index_dataset, load_dataset, paused_gc)
+from generate_dataset import generate_dataset
+
+
+def get_stages(dataset_file, cache_dir):
+    """Return the benchmark stages as (name, function, keep) in order. Each function
+    takes the results of the previous stages, {name: result}, and returns its own,
+    kept for the next stages if 'keep'. The decode stages run first and their data
+    is dropped, except for the json one that the index stage builds on.
+    """
+    def decode(backend, typed=False):
+        # As load_dataset() reads a file
+        def load_with_backend(results):
+            with paused_gc():
+                with open(dataset_file, 'rb') as f:
+                    return decode_json(f.read(), backend, typed)
+        return load_with_backend
+
+    def index(results):
+        with paused_gc():
+            return index_dataset(results.pop('load'))
+
+    def report(*reports):
+        return lambda results: build_reports(results['index'], reports)
+
+    backend_stages = [(f'load_{backend}', decode(backend), False)
+                      for backend in get_json_backends() if backend != 'json']
+    if 'msgspec' in get_json_backends():
+        backend_stages.append(('load_msgspec_typed', decode('msgspec', typed=True), False))
+
+    return [
+        *backend_stages,
+        ('load', decode('json'), True),
+        ('index', index, True),
+        ('times', report('times'), False),
+        ('stops', report('stops'), False),
+        ('breaks', report('breaks'), False),
+        ('all_reports', report(*REPORTS), False),
+        ('stream', lambda results: build_reports(dataset_file, REPORTS, stream=True), False),
+        ('cache_warm', lambda results: load_dataset(dataset_file, cache_dir=cache_dir), False)
+    ]
+
+def run_stage(function, results):
+    """Return the result of a stage and its time in seconds, after a collection of
+    the garbage of the previous stages
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = function(results)
+    return result, time.perf_counter() - start
+
+def run_benchmark(dataset_file, repeat=3, measure_memory=True):
+    """Return the best time in seconds and the peak memory in bytes of each stage"""
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Cold run writes the cache used by the cache_warm stage
+        load_dataset(dataset_file, cache_dir=cache_dir)
+
+        for run in range(repeat):
+            results = {}
+            for name, function, keep in get_stages(dataset_file, cache_dir):
+                result, elapsed = run_stage(function, results)
+                if keep:
+                    results[name] = result
+                del result
+
+                stage = stages.setdefault(name, {'seconds': elapsed})
+                stage['seconds'] = min(stage['seconds'], elapsed)
+
+        # Separate pass, tracemalloc slows down the stages
+        if measure_memory:
+            results = {}
+            for name, function, keep in get_stages(dataset_file, cache_dir):
+                gc.collect()
+                tracemalloc.start()
+                result = function(results)
+                stages[name]['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                if keep:
+                    results[name] = result
+                del result
+
+    return stages
+
+def get_dataset_sizes(dataset_file):
+    """Return the size of the file and the number of records of each kind"""
+    dataset = load_dataset(dataset_file)
+    return {
+        'file': str(dataset_file),
+        'file_bytes': Path(dataset_file).stat().st_size,
+        'stops': len(dataset.stop_index),
+        'trips': len(dataset.trip_index),
+        'vehicle_events': len(dataset.vehicle_event_index),
+        'duties': len(dataset.duties),
+        'duty_events': sum(len(duty.duty_events) for duty in dataset.duties)
+    }
+
+def get_git_commit():
+    """Return the current git commit of the code benchmarked, None outside a git repo"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=Path(optibus_assignment.__file__).parent).stdout.strip()
+    except Exception:
+        return None
+
+def compare_results(results, baseline, threshold):
+    """Print the time ratio of each stage against a baseline and return the
+    stages slower by more than 'threshold' times
+    """
+    regressions = []
+    sizes = {key: value for key, value in results['dataset'].items() if key != 'file'}
+    baseline_sizes = {key: value for key, value in baseline['dataset'].items() if key != 'file'}
+    if sizes != baseline_sizes:
+        print("Warning: the compared runs used different datasets\n")
+
+    print(f"{'stage':>12}  {'baseline (s)':>12}  {'current (s)':>12}  {'ratio':>6}")
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['seconds']
+        ratio = stage['seconds'] / before if before else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:>12}  {before:>12.4f}  {stage['seconds']:>12.4f}  {ratio:>6.2f}{flag}")
+    return regressions
+
+def parse_arguments(argv):
+    """Return the command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark the reports of optibus_assignment.py.")
+    parser.add_argument('dataset_file', nargs='?', type=Path,
+                        help="JSON dataset file, a synthetic one is generated if not given")
+    parser.add_argument('--duties', type=int, default=10000,
+                        help="Duties of the synthetic dataset (default: %(default)s)")
+    parser.add_argument('--trips-per-duty', type=int, default=8,
+                        help="Service trips per duty of the synthetic dataset (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs of each stage, the best time is kept (default: %(default)s)")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Skip the peak memory pass")
+    parser.add_argument('--output', type=Path, help="Save the results to this JSON file")
+    parser.add_argument('--compare', type=Path, help="Compare with the results of a previous run")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Time ratio over the compared run reported as a regression "
+                             "(default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dataset_file = args.dataset_file
+        if dataset_file is None:
+            dataset_file = Path(temp_dir) / 'synthetic.json'
+            print(f"Generating {args.duties} duties ...")
+            generate_dataset(dataset_file, args.duties, args.trips_per_duty)
+
+        results = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_commit': get_git_commit(),
+            'python': platform.python_version(),
+            'numpy': optibus_assignment.get_numpy() is not None,
+            'json_backends': get_json_backends(),
+            'dataset': get_dataset_sizes(dataset_file),
+            'repeat': args.repeat,
+            'stages': run_benchmark(dataset_file, args.repeat, not args.no_memory)
+        }
+
+    print(f"Dataset: {results['dataset']}\n")
+    print(f"{'stage':>18}  {'seconds':>10}  {'peak MB':>10}")
+    for name, stage in results['stages'].items():
+        peak = stage.get('peak_memory_bytes')
+        peak = f"{peak / 1e6:>10.1f}" if peak is not None else f"{'-':>10}"
+        print(f"{name:>18}  {stage['seconds']:>10.4f}  {peak}")
+    print()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results saved:", args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:", ", ".join(regressions))
+            sys.exit(1)
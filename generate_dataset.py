@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: generate_dataset.py
+Description:
+    Generates synthetic JSON datasets with the same schema and referential
+    integrity as mini_json_dataset.json, at configurable sizes, for the
+    benchmarks of optibus_assignment.py.
+        - stops with coordinates and depots
+        - trips of service trips between stops, with route numbers
+        - vehicles with pre_trip, depot_pull_out, service_trip, deadhead,
+          attendance and depot_pull_in events in sequence
+        - duties with sign_on, taxi and vehicle_event duty events
+    Each vehicle runs two duties, an early and a late one. Layovers of random
+    length between events give breaks to the breaks report.
+    The file is written section by section, so memory stays bounded by one
+    vehicle whatever the dataset size.
+
+Usage: python3 generate_dataset.py synthetic.json --duties 100000 --trips-per-duty 10
+Python Version: 3.9.13
+Dependencies: sys, json, random, argparse, shutil, tempfile
+"""
+
+import sys
+import json
+import random
+import argparse
+import shutil
+import tempfile
+
+
+def format_time(minutes):
+    """Return integer minutes since the service day start as a "D.HH:MM" time"""
+    return f"{minutes // 1440}.{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+def generate_stops(stop_count, depot_count, rng):
+    """Return the stops, the first 'depot_count' of them being depots"""
+    stops = []
+    for number in range(stop_count):
+        is_depot = number < depot_count
+        stops.append({
+            "stop_id": f"D{number}" if is_depot else f"S{number}",
+            "stop_name": f"Depot {number}" if is_depot else f"Stop {number}",
+            "latitude": round(rng.uniform(33.8, 34.3), 6),
+            "longitude": round(rng.uniform(-118.4, -117.6), 6),
+            "is_depot": is_depot
+        })
+    return stops
+
+class DatasetGenerator:
+    """Generate the trips, vehicle events and duties of one vehicle at a time"""
+
+    def __init__(self, stops, route_count, trips_per_duty, rng):
+        self.depots = [stop['stop_id'] for stop in stops if stop['is_depot']]
+        self.stops = [stop['stop_id'] for stop in stops if not stop['is_depot']]
+        self.route_count = route_count
+        self.trips_per_duty = trips_per_duty
+        self.rng = rng
+        self.trip_count = 0
+
+    def new_trip(self, origin, start, end):
+        """Return a service trip from 'origin' between 'start' and 'end' minutes"""
+        rng = self.rng
+        self.trip_count += 1
+        return {
+            "trip_id": str(5000000 + self.trip_count),
+            "route_number": str(400 + rng.randrange(self.route_count)),
+            "origin_stop_id": origin,
+            "destination_stop_id": rng.choice(self.stops),
+            "departure_time": format_time(start),
+            "arrival_time": format_time(end)
+        }
+
+    def generate_vehicle(self, vehicle_id, duty_ids):
+        """Return the trips, the vehicle and the duties of a vehicle running 'duty_ids'"""
+        rng = self.rng
+        depot = rng.choice(self.depots)
+        trips = []
+        vehicle_events = []
+        duties = []
+        # Early duty starts 03:00-07:00, late duty 12:00-15:00 or after the early one
+        start_windows = [(180, 420), (720, 900)]
+        time = 0
+
+        for duty_id, window in zip(duty_ids, start_windows):
+            time = max(time, rng.randint(*window))
+            duty_events = []
+
+            def add_duty_event(event_type, **fields):
+                duty_events.append({"duty_event_sequence": str(len(duty_events)),
+                                    "duty_event_type": event_type, **fields})
+
+            def add_vehicle_event(event_type, **fields):
+                sequence = len(vehicle_events)
+                vehicle_events.append({"vehicle_event_sequence": str(sequence),
+                                       "vehicle_event_type": event_type, **fields,
+                                       "duty_id": duty_id})
+                add_duty_event("vehicle_event", vehicle_event_sequence=sequence,
+                               vehicle_id=vehicle_id)
+
+            def add_timed_vehicle_event(event_type, origin, destination, duration):
+                nonlocal time
+                add_vehicle_event(event_type, start_time=format_time(time),
+                                  end_time=format_time(time + duration),
+                                  origin_stop_id=origin, destination_stop_id=destination)
+                time += duration
+
+            if rng.random() < 0.4:
+                add_duty_event("sign_on", start_time=format_time(time),
+                               end_time=format_time(time + 10),
+                               origin_stop_id=depot, destination_stop_id=depot)
+                time += 10
+
+            add_timed_vehicle_event("pre_trip", depot, depot, 20)
+            location = rng.choice(self.stops)
+            add_timed_vehicle_event("depot_pull_out", depot, location, rng.randint(10, 40))
+
+            for count in range(self.trips_per_duty):
+                end = time + rng.randint(20, 90)
+                trip = self.new_trip(location, time, end)
+                trips.append(trip)
+                add_vehicle_event("service_trip", trip_id=trip['trip_id'])
+                time = end
+                location = trip['destination_stop_id']
+
+                if count == self.trips_per_duty - 1:
+                    break
+                # Layover, sometimes long enough to be a break
+                time += rng.choice((0, 2, 5, 8, 12, 20, 35, 50))
+                if rng.random() < 0.1:
+                    add_timed_vehicle_event("attendance", location, location, rng.randint(5, 10))
+                next_location = rng.choice(self.stops)
+                add_timed_vehicle_event("deadhead", location, next_location, rng.randint(2, 15))
+                location = next_location
+
+            add_timed_vehicle_event("depot_pull_in", location, depot, rng.randint(10, 40))
+
+            if rng.random() < 0.3:
+                add_duty_event("taxi", start_time=format_time(time),
+                               end_time=format_time(time + 12),
+                               origin_stop_id=depot, destination_stop_id=rng.choice(self.stops))
+
+            duties.append({"duty_id": duty_id, "duty_events": duty_events})
+
+        vehicle = {"vehicle_id": vehicle_id, "vehicle_events": vehicle_events}
+        return trips, vehicle, duties
+
+class JsonArrayWriter:
+    """Write the items of a JSON array to a temporary file one at a time"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile('w+')
+        self.count = 0
+
+    def write(self, item):
+        self.file.write((",\n" if self.count else "") + json.dumps(item))
+        self.count += 1
+
+    def copy_to(self, f):
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, f)
+        self.file.close()
+
+def generate_dataset(output_file, duty_count, trips_per_duty=8, stop_count=200,
+                     depot_count=4, route_count=50, seed=0):
+    """Write a synthetic dataset of 'duty_count' duties to output_file and return its sizes"""
+    rng = random.Random(seed)
+    stops = generate_stops(stop_count, depot_count, rng)
+    generator = DatasetGenerator(stops, route_count, trips_per_duty, rng)
+
+    sections = {"trips": JsonArrayWriter(), "vehicles": JsonArrayWriter(),
+                "duties": JsonArrayWriter()}
+    vehicle_event_count = 0
+    duty_event_count = 0
+
+    for vehicle_number in range((duty_count + 1) // 2):
+        duty_ids = [str(duty_id) for duty_id in
+                    range(vehicle_number * 2 + 1, min(vehicle_number * 2 + 2, duty_count) + 1)]
+        trips, vehicle, duties = generator.generate_vehicle(str(vehicle_number + 1), duty_ids)
+
+        for trip in trips:
+            sections["trips"].write(trip)
+        sections["vehicles"].write(vehicle)
+        for duty in duties:
+            sections["duties"].write(duty)
+            duty_event_count += len(duty['duty_events'])
+        vehicle_event_count += len(vehicle['vehicle_events'])
+
+    with open(output_file, 'w') as f:
+        f.write('{\n"stops": ' + json.dumps(stops))
+        for name, writer in sections.items():
+            f.write(f',\n"{name}": [\n')
+            writer.copy_to(f)
+            f.write('\n]')
+        f.write('\n}\n')
+
+    return {
+        "stops": stop_count,
+        "trips": generator.trip_count,
+        "vehicles": sections["vehicles"].count,
+        "vehicle_events": vehicle_event_count,
+        "duties": sections["duties"].count,
+        "duty_events": duty_event_count
+    }
+
+def parse_arguments(argv):
+    """Return the command line arguments"""
+    parser = argparse.ArgumentParser(description="Generate a synthetic JSON dataset file.")
+    parser.add_argument('output_file', help="JSON dataset file to write")
+    parser.add_argument('--duties', type=int, default=10000,
+                        help="Number of duties (default: %(default)s)")
+    parser.add_argument('--trips-per-duty', type=int, default=8,
+                        help="Service trips in each duty (default: %(default)s)")
+    parser.add_argument('--stops', type=int, default=200,
+                        help="Number of stops (default: %(default)s)")
+    parser.add_argument('--depots', type=int, default=4,
+                        help="Number of the stops that are depots (default: %(default)s)")
+    parser.add_argument('--routes', type=int, default=50,
+                        help="Number of route numbers (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed, same seed same dataset (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.depots < 1 or args.stops <= args.depots:
+        parser.error("Needs at least one depot and one stop that is not a depot")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+
+    sizes = generate_dataset(args.output_file, args.duties, args.trips_per_duty, args.stops,
+                             args.depots, args.routes, args.seed)
+
+    print("Dataset written:", args.output_file)
+    for name, count in sizes.items():
+        print(f"  {name}: {count}")
@@ -18,20 +18,1786 @@ Description:
 Usage: python3 optibus_assignment.py 'mini_json_dataset.json'
 Contact: ydvigna@gmail.com
 Python Version: 3.9.13
-Dependencies: sys, json, pathlib, tabulate, datetime
+Dependencies: gc, io, os, sys, glob, json, math, time, queue, random, argparse,
+    multiprocessing, hashlib, pickle, csv, shutil, sqlite3, tempfile, threading,
+    array, bisect, collections, collections.abc, contextlib, enum, http.server,
+    pathlib, typing, urllib.parse, urllib.request, urllib.error, tabulate,
+    numpy (optional), orjson (optional), msgspec (optional)
 """
 
+import gc
+import io
+import os
 import sys
+import glob
 import json
+import math
+import time
+import queue
+import random
+import argparse
+import multiprocessing
+import hashlib
+import pickle
+import csv
+import shutil
+import sqlite3
+import tempfile
+import threading
 
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from enum import IntEnum
 from pathlib import Path
-from tabulate import tabulate
-from datetime import timedelta
+from typing import List, Optional, Union
+from urllib.parse import parse_qs, unquote, urlsplit
 
+# NumPy is imported on first use by get_numpy(), importing it takes longer than
+# a small report
+_numpy = None
+
+# Faster JSON decoders, the json module is used when neither is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class Profiler:
+    """Wall time of each stage and counters of a run, for the --profile mode and
+    for metrics pipelines through hooks.
+
+    Disabled by default: stage() then only checks a flag and the hot paths check
+    'enabled' before counting, so instrumentation costs close to nothing.
+    Hooks are called as hook(kind, name, value), kind 'stage' with the seconds
+    of a finished stage, or 'counter' with the amount added to a counter. They
+    are called in the process that added them only: a forked worker inherits
+    them, but its summary is merged, and the hooks called, in the parent.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self.hooks_pid = os.getpid()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_hook(self, hook):
+        self.hooks_pid = os.getpid()
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @contextmanager
+    def stage(self, name):
+        """Add the wall time of the 'with' block to stage 'name'"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.call_hooks('stage', name, seconds)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.call_hooks('counter', name, value)
+
+    def call_hooks(self, kind, name, value):
+        if self.hooks and os.getpid() == self.hooks_pid:
+            for hook in self.hooks:
+                hook(kind, name, value)
+
+    def summary(self):
+        """Return the stage times in seconds and the counters"""
+        return {'stages': dict(self.stages), 'counters': dict(self.counters)}
+
+    def merge(self, summary):
+        """Add the summary of another profiler, e.g. of a worker process"""
+        for name, seconds in summary['stages'].items():
+            self.add_time(name, seconds)
+        for name, value in summary['counters'].items():
+            self.count(name, value)
+
+    def print_summary(self, file=None):
+        file = file or sys.stderr
+        print("--- PROFILE ---\n", file=file)
+        for name, seconds in self.stages.items():
+            print(f"{name:>24}  {seconds * 1000:>12.1f} ms", file=file)
+        print(file=file)
+        for name, value in self.counters.items():
+            print(f"{name:>24}  {value:>12}", file=file)
+        print(file=file)
+
+
+# Instrumentation of this module, see Profiler
+profiler = Profiler()
+
+
+class VehicleEventType(IntEnum):
+    pre_trip = 0
+    depot_pull_out = 1
+    service_trip = 2
+    deadhead = 3
+    depot_pull_in = 4
+    attendance = 5
+
+
+class DutyEventType(IntEnum):
+    sign_on = 0
+    taxi = 1
+    vehicle_event = 2
+
+
+# Enum members by (enum, name), faster than enum[name] when loading
+EVENT_TYPES = {(enum, member.name): member
+               for enum in (VehicleEventType, DutyEventType) for member in enum}
+
+# Fields holding "D.HH:MM" times, kept as integer minutes in the records
+TIME_FIELDS = frozenset({'start_time', 'end_time', 'departure_time', 'arrival_time'})
+
+def intern_id(value):
+    """Return an ID as an interned string, shared by every record referencing it"""
+    if value is None:
+        return None
+    return sys.intern(value if type(value) is str else str(value))
+
+def parse_event_type(enum, name):
+    """Return the enum member of an event type name"""
+    member = EVENT_TYPES.get((enum, name))
+    if member is None:
+        raise ValueError(f"{enum.__name__} unknown: {name}")
+    return member
+
+
+class Record:
+    """Base of the compact dataset records, one slot per field.
+
+    Records can also be read by JSON key (record['stop_id']), giving the same
+    values as the dataset file, so the dict based helpers work on them too.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        value = getattr(self, key) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        if isinstance(value, IntEnum):
+            return value.name
+        if key in TIME_FIELDS:
+            return unparse_time(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def keys(self):
+        return [key for key in self.__slots__ if getattr(self, key) is not None]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f"{key}={getattr(self, key)!r}" for key in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Stop(Record):
+    __slots__ = ('stop_id', 'stop_name', 'latitude', 'longitude', 'is_depot')
+
+    def __init__(self, stop):
+        self.stop_id = intern_id(stop['stop_id'])
+        self.stop_name = intern_id(stop['stop_name'])
+        self.latitude = stop.get('latitude')
+        self.longitude = stop.get('longitude')
+        self.is_depot = stop.get('is_depot', False)
+
+    @classmethod
+    def from_row(cls, row):
+        """Return the record of a tuple of its fields in slot order"""
+        stop = cls.__new__(cls)
+        stop.stop_id, stop.stop_name, stop.latitude, stop.longitude, stop.is_depot = row
+        return stop
+
+
+class Trip(Record):
+    __slots__ = ('trip_id', 'route_number', 'origin_stop_id', 'destination_stop_id',
+                 'departure_time', 'arrival_time')
+
+    def __init__(self, trip):
+        self.trip_id = intern_id(trip['trip_id'])
+        self.route_number = intern_id(trip.get('route_number'))
+        self.origin_stop_id = intern_id(trip.get('origin_stop_id'))
+        self.destination_stop_id = intern_id(trip.get('destination_stop_id'))
+        self.departure_time = parse_time(trip.get('departure_time'))
+        self.arrival_time = parse_time(trip.get('arrival_time'))
+
+    @classmethod
+    def from_row(cls, row):
+        trip = cls.__new__(cls)
+        (trip.trip_id, trip.route_number, trip.origin_stop_id, trip.destination_stop_id,
+         trip.departure_time, trip.arrival_time) = row
+        return trip
+
+
+class VehicleEvent(Record):
+    __slots__ = ('vehicle_id', 'vehicle_event_sequence', 'vehicle_event_type', 'duty_id',
+                 'trip_id', 'start_time', 'end_time', 'origin_stop_id', 'destination_stop_id')
+
+    def __init__(self, vehicle_id, event):
+        self.vehicle_id = vehicle_id
+        self.vehicle_event_sequence = int(event['vehicle_event_sequence'])
+        self.vehicle_event_type = parse_event_type(VehicleEventType, event['vehicle_event_type'])
+        self.duty_id = intern_id(event.get('duty_id'))
+        self.trip_id = intern_id(event.get('trip_id'))
+        self.start_time = parse_time(event.get('start_time'))
+        self.end_time = parse_time(event.get('end_time'))
+        self.origin_stop_id = intern_id(event.get('origin_stop_id'))
+        self.destination_stop_id = intern_id(event.get('destination_stop_id'))
+
+    @classmethod
+    def from_row(cls, row):
+        event = cls.__new__(cls)
+        (event.vehicle_id, event.vehicle_event_sequence, event.vehicle_event_type, event.duty_id,
+         event.trip_id, event.start_time, event.end_time, event.origin_stop_id,
+         event.destination_stop_id) = row
+        return event
+
+
+class DutyEvent(Record):
+    __slots__ = ('duty_event_sequence', 'duty_event_type', 'vehicle_id', 'vehicle_event_sequence',
+                 'start_time', 'end_time', 'origin_stop_id', 'destination_stop_id')
+
+    def __init__(self, event):
+        sequence = event.get('vehicle_event_sequence')
+        self.duty_event_sequence = int(event['duty_event_sequence'])
+        self.duty_event_type = parse_event_type(DutyEventType, event['duty_event_type'])
+        self.vehicle_id = intern_id(event.get('vehicle_id'))
+        self.vehicle_event_sequence = None if sequence is None else int(sequence)
+        self.start_time = parse_time(event.get('start_time'))
+        self.end_time = parse_time(event.get('end_time'))
+        self.origin_stop_id = intern_id(event.get('origin_stop_id'))
+        self.destination_stop_id = intern_id(event.get('destination_stop_id'))
+
+    @classmethod
+    def from_row(cls, row):
+        event = cls.__new__(cls)
+        (event.duty_event_sequence, event.duty_event_type, event.vehicle_id,
+         event.vehicle_event_sequence, event.start_time, event.end_time, event.origin_stop_id,
+         event.destination_stop_id) = row
+        return event
+
+
+class Duty(Record):
+    __slots__ = ('duty_id', 'duty_events')
+
+    def __init__(self, duty):
+        self.duty_id = intern_id(duty['duty_id'])
+        self.duty_events = tuple(DutyEvent(event) for event in duty['duty_events'])
+
+
+class Dataset:
+    """Compact in-memory model of a dataset, with hash indexes built once for
+    constant time lookups.
+
+    Stops, trips, vehicle events and duties are held as slotted records with
+    interned IDs, small-int enums for the event types and times in integer
+    minutes. Measured with tracemalloc on mini_json_dataset.json, a vehicle
+    event takes about 230 bytes as a record, index entry included, against
+    about 560 bytes as a dict from json.load, and the whole dataset goes from
+    3.2 MB of dicts to 1.1 MB.
+
+    A Dataset can be passed to every helper in place of the 'vehicles', 'trips'
+    and 'stops' lists, and to every report function in place of the file path.
+
+    With a 'duty_filter' selecting duty or vehicle IDs, only the selected duties,
+    their vehicles and the trips of these vehicles are indexed.
+    """
+
+    def __init__(self, data=None, duty_filter=None):
+        self.duties = []
+        self.stop_index = {}
+        self.trip_index = {}
+        # Keyed by (vehicle_id, vehicle_event_sequence), sequence as int
+        self.vehicle_event_index = {}
+        # ValidationReport of the JSON data, when validated by load_dataset()
+        self.validation = None
+
+        if data is None:
+            return
+
+        if duty_filter is None or not duty_filter.selects_vehicles:
+            self.duties = [Duty(duty) for duty in data['duties']]
+            for stop in data['stops']:
+                self.add_stop(stop)
+            for trip in data['trips']:
+                self.add_trip(trip)
+            for vehicle in data['vehicles']:
+                self.add_vehicle(vehicle)
+            return
+
+        self.duties = [Duty(duty) for duty in data['duties'] if duty_filter.matches_data(duty)]
+        vehicle_ids = {duty_event.vehicle_id for duty in self.duties
+                       for duty_event in duty.duty_events}
+        trip_ids = set()
+        for stop in data['stops']:
+            self.add_stop(stop)
+        for vehicle in data['vehicles']:
+            if vehicle['vehicle_id'] in vehicle_ids:
+                self.add_vehicle(vehicle)
+                trip_ids.update(event.get('trip_id') for event in vehicle['vehicle_events'])
+        for trip in data['trips']:
+            if trip['trip_id'] in trip_ids:
+                self.add_trip(trip)
+
+    # First match wins, same as the linear scans over the lists
+    def add_stop(self, stop):
+        stop = Stop(stop)
+        self.stop_index.setdefault(stop.stop_id, stop)
+
+    def add_trip(self, trip):
+        trip = Trip(trip)
+        self.trip_index.setdefault(trip.trip_id, trip)
+
+    def add_vehicle(self, vehicle):
+        vehicle_id = intern_id(vehicle['vehicle_id'])
+        for event in vehicle['vehicle_events']:
+            event = VehicleEvent(vehicle_id, event)
+            key = (vehicle_id, event.vehicle_event_sequence)
+            self.vehicle_event_index.setdefault(key, event)
+
+    def get_vehicle_event(self, vehicle_id, vehicle_event_sequence):
+        return self.vehicle_event_index.get((vehicle_id, int(vehicle_event_sequence)))
+
+    def get_trip(self, trip_id):
+        return self.trip_index.get(trip_id)
+
+    def get_stop(self, stop_id):
+        return self.stop_index.get(stop_id)
+
+    def get_stop_name(self, stop_id):
+        stop = self.stop_index.get(stop_id)
+        return stop.stop_name if stop else None
+
+    def get_columns(self):
+        """Return the records as columns of typed arrays and lists of strings, the
+        cache format: plain data only, no record class, read back by from_columns()
+        """
+        duties = list(self.duties)
+        offsets = array('q', [0])
+        for duty in duties:
+            offsets.append(offsets[-1] + len(duty.duty_events))
+        return {
+            'stops': get_record_columns(Stop, self.stop_index.values()),
+            'trips': get_record_columns(Trip, self.trip_index.values()),
+            'vehicle_events': get_record_columns(VehicleEvent, self.vehicle_event_index.values()),
+            'duties': {'duty_id': [duty.duty_id for duty in duties], 'offsets': offsets},
+            'duty_events': get_record_columns(DutyEvent, (duty_event for duty in duties
+                                                          for duty_event in duty.duty_events))
+        }
+
+    @classmethod
+    def from_columns(cls, columns, duty_filter=None):
+        """Return the Dataset of the columns from get_columns(). The records are
+        built when first looked up, see RecordIndex and DutyList. With a
+        'duty_filter' selecting duty or vehicle IDs, only the selected duties,
+        their vehicles and the trips of these vehicles are built, right away.
+        """
+        dataset = cls()
+        stops, trips = columns['stops'], columns['trips']
+        vehicle_events = columns['vehicle_events']
+        dataset.stop_index = RecordIndex(stops['stop_id'], RecordColumns(Stop, stops))
+        if duty_filter is not None and duty_filter.selects_vehicles:
+            dataset.add_selected_columns(columns, duty_filter)
+            return dataset
+
+        dataset.trip_index = RecordIndex(trips['trip_id'], RecordColumns(Trip, trips))
+        dataset.vehicle_event_index = RecordIndex(
+            zip(vehicle_events['vehicle_id'], vehicle_events['vehicle_event_sequence']),
+            RecordColumns(VehicleEvent, vehicle_events))
+        dataset.duties = DutyList(columns['duties'],
+                                  RecordColumns(DutyEvent, columns['duty_events']))
+        return dataset
+
+    def build(self):
+        """Build now the records of a Dataset from from_columns() that are otherwise
+        built on first lookup, e.g. before forking worker processes that would each
+        build them again
+        """
+        for index in (self.stop_index, self.trip_index, self.vehicle_event_index):
+            if isinstance(index, RecordIndex):
+                index.get_index()
+        if isinstance(self.duties, DutyList):
+            self.duties.build()
+
+    def add_selected_columns(self, columns, duty_filter):
+        """Build the duties selected by the IDs of 'duty_filter', their vehicle
+        events and trips from the columns, found by scanning the ID columns
+        """
+        duty_ids, offsets = columns['duties']['duty_id'], columns['duties']['offsets']
+        event_vehicle_ids = columns['duty_events']['vehicle_id']
+        selected = [index for index, duty_id in enumerate(duty_ids) if duty_filter.matches_ids(
+            duty_id, event_vehicle_ids[offsets[index]:offsets[index + 1]])]
+        duty_events = RecordColumns(DutyEvent, columns['duty_events']).take(
+            [row for index in selected for row in range(offsets[index], offsets[index + 1])])
+        duty_events = duty_events.get_records()
+        position = 0
+        for index in selected:
+            duty = Duty.__new__(Duty)
+            duty.duty_id = duty_ids[index]
+            count = offsets[index + 1] - offsets[index]
+            duty.duty_events = tuple(duty_events[position:position + count])
+            position += count
+            self.duties.append(duty)
+
+        vehicle_ids = {duty_event.vehicle_id for duty in self.duties
+                       for duty_event in duty.duty_events}
+        vehicle_events = RecordColumns(VehicleEvent, columns['vehicle_events'])
+        vehicle_events = vehicle_events.take([row for row, vehicle_id in enumerate(
+            columns['vehicle_events']['vehicle_id']) if vehicle_id in vehicle_ids])
+        for vehicle_event in vehicle_events.get_records():
+            key = (vehicle_event.vehicle_id, vehicle_event.vehicle_event_sequence)
+            self.vehicle_event_index[key] = vehicle_event
+
+        trip_ids = {vehicle_event.trip_id for vehicle_event in self.vehicle_event_index.values()}
+        trips = RecordColumns(Trip, columns['trips'])
+        trips = trips.take([row for row, trip_id in enumerate(columns['trips']['trip_id'])
+                            if trip_id in trip_ids])
+        self.trip_index = {trip.trip_id: trip for trip in trips.get_records()}
+
+
+# Typecode of the cache column of each numeric record field, None stored as the
+# value of NONE_VALUES. The other fields, IDs and names, are lists of strings.
+COLUMN_TYPECODES = {
+    'latitude': 'd', 'longitude': 'd', 'is_depot': 'b',
+    'vehicle_event_sequence': 'q', 'duty_event_sequence': 'q',
+    'start_time': 'q', 'end_time': 'q', 'departure_time': 'q', 'arrival_time': 'q',
+    'vehicle_event_type': 'b', 'duty_event_type': 'b'
+}
+NONE_VALUES = {'q': -1 << 63, 'b': -1, 'd': math.nan}
+
+def get_record_columns(record_class, records):
+    """Return {field: column} of records. A field with a value its typecode cannot
+    hold, such as a latitude given as a string, is kept as a list.
+    """
+    records = list(records)
+    columns = {}
+    for field in record_class.__slots__:
+        values = [getattr(record, field) for record in records]
+        typecode = COLUMN_TYPECODES.get(field)
+        if typecode is not None:
+            none = NONE_VALUES[typecode]
+            try:
+                values = array(typecode, [none if value is None else value for value in values])
+            except (TypeError, OverflowError):
+                pass
+        columns[field] = values
+    return columns
+
+class RecordColumns:
+    """Records of one class held as columns. The columns are converted back to
+    record values and zipped into rows when first needed, a record is then built
+    from its row by the from_row() of its class.
+    """
+
+    def __init__(self, record_class, columns):
+        self.record_class = record_class
+        self.columns = [columns[field] for field in record_class.__slots__]
+        self.rows = None
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def get_rows(self):
+        if self.rows is None:
+            self.rows = list(zip(*(convert_column(field, column) for field, column
+                                   in zip(self.record_class.__slots__, self.columns))))
+        return self.rows
+
+    def get_records(self):
+        """Return all the records, built in one pass"""
+        return list(map(self.record_class.from_row, self.get_rows()))
+
+    def take(self, rows):
+        """Return the RecordColumns of the given rows only"""
+        columns = {}
+        for field, column in zip(self.record_class.__slots__, self.columns):
+            values = [column[row] for row in rows]
+            columns[field] = array(column.typecode, values) if isinstance(column, array) else values
+        return RecordColumns(self.record_class, columns)
+
+def convert_column(field, column):
+    """Return the record values of a column, a typed column converted as a whole"""
+    if not isinstance(column, array):
+        return column
+    if column.typecode == 'd':
+        return [None if value != value else value for value in column]
+    none = NONE_VALUES[column.typecode]
+    has_none = none in column
+    enum = {'vehicle_event_type': VehicleEventType, 'duty_event_type': DutyEventType}.get(field)
+    if enum is not None:
+        members = tuple(enum)
+        if not has_none:
+            return list(map(members.__getitem__, column))
+        return [None if value == none else members[value] for value in column]
+    if field == 'is_depot':
+        return [None if value == none else bool(value) for value in column]
+    return [None if value == none else value for value in column] if has_none else column
+
+class RecordIndex(Mapping):
+    """Read-only index of records held as RecordColumns, by key. The records are
+    built all at once on the first lookup, so a Dataset read from the cache is
+    ready as soon as its columns are unpickled, and an index never looked up,
+    such as the trips for the times report alone, is never built.
+    """
+
+    def __init__(self, keys, records):
+        # Keys are unique, the columns are written from the indexes of a Dataset.
+        # A list, not an iterator, so that a failed build can be retried.
+        self.pending_keys = list(keys)
+        self.records = records
+        self.length = len(records)
+        self.index = None
+        # Concurrent readers, e.g. the threads of serve(), build the index once
+        self.lock = threading.Lock()
+
+    def get_index(self):
+        if self.index is None:
+            with self.lock:
+                if self.index is None:
+                    with paused_gc():
+                        index = dict(zip(self.pending_keys, self.records.get_records()))
+                    # Lookups go straight to the dict from now on
+                    self.get = index.get
+                    self.index = index
+                    self.pending_keys = self.records = None
+        return self.index
+
+    def __getstate__(self):
+        # Locks cannot be pickled, each process has its own
+        state = self.__dict__.copy()
+        del state['lock']
+        state.pop('get', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        if self.index is not None:
+            self.get = self.index.get
+
+    def get(self, key, default=None):
+        return self.get_index().get(key, default)
+
+    def __getitem__(self, key):
+        return self.get_index()[key]
+
+    def __contains__(self, key):
+        return key in self.get_index()
+
+    def __iter__(self):
+        return iter(self.get_index())
+
+    def __len__(self):
+        return self.length
+
+    def keys(self):
+        return self.get_index().keys()
+
+    def values(self):
+        return self.get_index().values()
+
+    def items(self):
+        return self.get_index().items()
+
+class DutyList(Sequence):
+    """Read-only list of the duties held as columns, built a block of duties at a
+    time on first access, so the reports start on the first duties without
+    building the others
+    """
+    block_size = 1024
+
+    def __init__(self, columns, duty_events):
+        self.duty_ids = columns['duty_id']
+        self.offsets = columns['offsets']
+        self.duty_events = duty_events
+        self.built = [None] * len(self.duty_ids)
+
+    def get_duty(self, index):
+        duty = self.built[index]
+        if duty is None:
+            self.build_block(index - index % self.block_size)
+            duty = self.built[index]
+        return duty
+
+    def build_block(self, start):
+        offsets = self.offsets
+        with paused_gc():
+            rows = self.duty_events.get_rows()
+            for index in range(start, min(start + self.block_size, len(self.duty_ids))):
+                duty = Duty.__new__(Duty)
+                duty.duty_id = self.duty_ids[index]
+                duty.duty_events = tuple(map(DutyEvent.from_row,
+                                             rows[offsets[index]:offsets[index + 1]]))
+                self.built[index] = duty
+
+    def build(self):
+        """Build the blocks of duties not built yet"""
+        for start in range(0, len(self.duty_ids), self.block_size):
+            if self.built[start] is None:
+                self.build_block(start)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_duty(number) for number in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.get_duty(index)
+
+    def __iter__(self):
+        return map(self.get_duty, range(len(self.duty_ids)))
+
+    def __len__(self):
+        return len(self.duty_ids)
+
+
+class DutyFilter:
+    """Selection of the duties to report, by duty ID, vehicle, route number or
+    time window. Pushed down as far as it goes: the duty and vehicle IDs are
+    checked on the JSON data before any record is built, the route numbers and
+    window with a few lookups before a duty is resolved. Empty filters select all.
+    """
+
+    def __init__(self, duty_ids=None, vehicle_ids=None, route_numbers=None, window=None):
+        self.duty_ids = set(duty_ids) if duty_ids else None
+        self.vehicle_ids = set(vehicle_ids) if vehicle_ids else None
+        self.route_numbers = set(route_numbers) if route_numbers else None
+        # (start, end) in integer minutes
+        self.window = window
+
+    def __bool__(self):
+        return any(value is not None for value in
+                   (self.duty_ids, self.vehicle_ids, self.route_numbers, self.window))
+
+    @property
+    def selects_vehicles(self):
+        """Whether only the vehicles of the selected duties need to be indexed"""
+        return self.duty_ids is not None or self.vehicle_ids is not None
+
+    def matches_data(self, duty):
+        """Check the duty and vehicle IDs of a duty of the JSON data"""
+        return self.matches_ids(duty['duty_id'],
+                                (event.get('vehicle_id') for event in duty['duty_events']))
+
+    def matches_ids(self, duty_id, vehicle_ids):
+        """Check the ID of a duty and the vehicle IDs of its events"""
+        if self.duty_ids is not None and duty_id not in self.duty_ids:
+            return False
+        if self.vehicle_ids is not None:
+            return any(vehicle_id in self.vehicle_ids for vehicle_id in vehicle_ids)
+        return True
+
+    def matches(self, duty, dataset):
+        """Check a Duty record against all the filters"""
+        if self.duty_ids is not None and duty.duty_id not in self.duty_ids:
+            return False
+        if self.vehicle_ids is not None and not any(
+                duty_event.vehicle_id in self.vehicle_ids for duty_event in duty.duty_events):
+            return False
+        if self.route_numbers is not None and not self.matches_route(duty, dataset):
+            return False
+        if self.window is not None and not self.matches_window(duty, dataset):
+            return False
+        return True
+
+    def matches_route(self, duty, dataset):
+        """Whether a service trip of the duty runs one of the route numbers"""
+        for duty_event in duty.duty_events:
+            if duty_event.duty_event_type is not DutyEventType.vehicle_event:
+                continue
+            vehicle_event = dataset.vehicle_event_index.get(
+                (duty_event.vehicle_id, duty_event.vehicle_event_sequence))
+            if vehicle_event is None or vehicle_event.trip_id is None:
+                continue
+            trip = dataset.trip_index.get(vehicle_event.trip_id)
+            if trip is not None and trip.route_number in self.route_numbers:
+                return True
+        return False
+
+    def matches_window(self, duty, dataset):
+        """Whether the duty, from the start of its first event to the end of its
+        last one, overlaps the window
+        """
+        if not duty.duty_events:
+            return False
+        first = get_duty_event_times(duty.duty_events[0], dataset)
+        last = get_duty_event_times(duty.duty_events[-1], dataset)
+        if first is None or last is None or first[0] is None or last[1] is None:
+            return False
+        start, end = self.window
+        return first[0] < end and last[1] > start
+
+    def filter(self, duties, dataset):
+        """Yield the duties selected"""
+        for duty in duties:
+            if self.matches(duty, dataset):
+                yield duty
+
+def get_duty_event_times(duty_event, dataset):
+    """Return (start_time, end_time, destination_stop_id) of a duty event,
+    None if its vehicle event or trip is not found
+    """
+    if duty_event.duty_event_type is not DutyEventType.vehicle_event:
+        return duty_event.start_time, duty_event.end_time, duty_event.destination_stop_id
+    vehicle_event = dataset.vehicle_event_index.get(
+        (duty_event.vehicle_id, duty_event.vehicle_event_sequence))
+    return get_vehicle_event_times(vehicle_event, dataset) if vehicle_event else None
+
+
+if msgspec is not None:
+    class JsonStruct(msgspec.Struct):
+        """Typed record decoded by msgspec, read by the Record classes like a dict"""
+
+        def __getitem__(self, key):
+            return getattr(self, key)
+
+        def get(self, key, default=None):
+            return getattr(self, key, default)
+
+    class StopStruct(JsonStruct):
+        stop_id: str
+        stop_name: str
+        latitude: Optional[float] = None
+        longitude: Optional[float] = None
+        is_depot: bool = False
+
+    class TripStruct(JsonStruct):
+        trip_id: str
+        route_number: Optional[str] = None
+        origin_stop_id: Optional[str] = None
+        destination_stop_id: Optional[str] = None
+        departure_time: Optional[str] = None
+        arrival_time: Optional[str] = None
+
+    class VehicleEventStruct(JsonStruct):
+        vehicle_event_sequence: Union[str, int]
+        vehicle_event_type: str
+        duty_id: Optional[str] = None
+        trip_id: Optional[str] = None
+        start_time: Optional[str] = None
+        end_time: Optional[str] = None
+        origin_stop_id: Optional[str] = None
+        destination_stop_id: Optional[str] = None
+
+    class VehicleStruct(JsonStruct):
+        vehicle_id: str
+        vehicle_events: List[VehicleEventStruct]
+
+    class DutyEventStruct(JsonStruct):
+        duty_event_sequence: Union[str, int]
+        duty_event_type: str
+        vehicle_id: Optional[str] = None
+        vehicle_event_sequence: Union[str, int, None] = None
+        start_time: Optional[str] = None
+        end_time: Optional[str] = None
+        origin_stop_id: Optional[str] = None
+        destination_stop_id: Optional[str] = None
+
+    class DutyStruct(JsonStruct):
+        duty_id: str
+        duty_events: List[DutyEventStruct]
+
+    class DatasetStruct(JsonStruct):
+        stops: List[StopStruct]
+        trips: List[TripStruct]
+        vehicles: List[VehicleStruct]
+        duties: List[DutyStruct]
+
+    _dataset_decoder = msgspec.json.Decoder(DatasetStruct)
+
+def decode_json_stdlib(content, typed=False):
+    return json.loads(content)
+
+def decode_json_orjson(content, typed=False):
+    return orjson.loads(content)
+
+def decode_json_msgspec(content, typed=False):
+    """With 'typed' decode straight into the dataset structs, the schema being
+    checked by msgspec, otherwise into dicts and lists
+    """
+    if typed:
+        return _dataset_decoder.decode(content)
+    return msgspec.json.decode(content)
+
+# JSON decoders of dataset files, in order of preference when installed
+JSON_BACKENDS = {
+    'msgspec': decode_json_msgspec,
+    'orjson': decode_json_orjson,
+    'json': decode_json_stdlib
+}
+JSON_BACKEND_MODULES = {'msgspec': msgspec, 'orjson': orjson, 'json': json}
+
+# Backend used by load_dataset(), the fastest installed unless set by set_json_backend()
+json_backend = None
+
+def get_json_backends():
+    """Return the names of the installed JSON backends, fastest first"""
+    return [name for name in JSON_BACKENDS if JSON_BACKEND_MODULES[name] is not None]
+
+def set_json_backend(name=None):
+    """Select the JSON backend of load_dataset() by name, the fastest installed if None"""
+    global json_backend
+    if name is not None and name not in get_json_backends():
+        raise ValueError(f"JSON backend not installed: {name}")
+    json_backend = name
+
+def decode_json(content, backend=None, typed=False):
+    """Return the data of a JSON document given as bytes, decoded with 'backend',
+    the selected or fastest installed one by default.
+    With 'typed' the msgspec backend returns dataset structs instead of dicts.
+    """
+    backend = backend or json_backend or get_json_backends()[0]
+    return JSON_BACKENDS[backend](content, typed)
+
+def load_dataset(dataset_file, stream=False, cache_dir=None, rebuild_cache=False,
+                 sample_rate=None, duty_filter=None):
+    """Return the Dataset of a JSON dataset file.
+    With 'stream' only the stops, trips and vehicles are kept in memory and
+    the duties are read one at a time from the file whenever they are iterated.
+    With 'cache_dir' the Dataset is read from the binary cache when up to date.
+    With 'sample_rate' the JSON data is validated, that fraction of it, before
+    indexing and the ValidationReport kept as Dataset.validation. Not when streaming.
+    The file is decoded with the selected JSON backend, see decode_json().
+    With a 'duty_filter' only the records of the duties it selects may be
+    indexed, the caller still applies it to the duties.
+    """
+    if stream:
+        return stream_dataset(dataset_file)
+
+    with paused_gc():
+        if cache_dir is not None:
+            return load_cached_dataset(dataset_file, cache_dir, rebuild_cache, sample_rate,
+                                       duty_filter)
+
+        with profiler.stage('load'):
+            with open(dataset_file, 'rb') as f:
+                # Typed structs when not validated, the validator reads dicts
+                data = decode_json(f.read(), typed=not sample_rate)
+        return index_dataset(data, sample_rate, duty_filter)
+
+def index_dataset(data, sample_rate=None, duty_filter=None):
+    """Return the Dataset of loaded JSON data, validated first with 'sample_rate'"""
+    validation = None
+    if sample_rate:
+        with profiler.stage('validate'):
+            validation = validate_dataset(data, sample_rate)
+    with profiler.stage('index'):
+        dataset = Dataset(data, duty_filter)
+    dataset.validation = validation
+    return dataset
+
+@contextmanager
+def paused_gc():
+    """Pause the cyclic garbage collector while loading. The collections it would
+    run over and over the many new records find no garbage, and made loading a
+    dataset or its cache up to three times slower.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Bump when the records or the columns change, older cache files are then rebuilt
+CACHE_VERSION = 3
+
+def get_cache_dir():
+    """Return the default directory of the dataset cache"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(cache_home) / 'optibus_assignment'
+
+def get_cache_file(dataset_file, cache_dir):
+    """Return the cache file of a dataset file, named after its absolute path"""
+    path = str(Path(dataset_file).resolve())
+    return Path(cache_dir) / (hashlib.blake2b(path.encode(), digest_size=16).hexdigest() + '.pickle')
+
+def get_file_hash(dataset_file):
+    """Return the content hash of a file"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(dataset_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_cache_payload(dataset):
+    """Return the Dataset columns and its validation summary pickled. Only arrays,
+    lists, dicts and strings are pickled, so the cache does not depend on the
+    module name of the records: the script and an import of it share the cache.
+    """
+    validation = dataset.validation.summary() if dataset.validation else None
+    return pickle.dumps((dataset.get_columns(), validation), pickle.HIGHEST_PROTOCOL)
+
+def write_dataset_cache(cache_file, cache_key, dataset=None, payload=None):
+    """Write the cache key followed by the payload of the Dataset, or the payload
+    given, replacing the cache file atomically
+    """
+    try:
+        if payload is None:
+            payload = get_cache_payload(dataset)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with open(temp_file, 'wb') as f:
+            pickle.dump(cache_key, f, pickle.HIGHEST_PROTOCOL)
+            f.write(payload)
+        os.replace(temp_file, cache_file)
+    except Exception as e:
+        # The reports do not depend on the cache
+        # On stderr, stdout may be a CSV or JSON Lines report
+        print(f"{e.args}. Dataset cache not written: {cache_file}", file=sys.stderr)
+
+def load_cached_dataset(dataset_file, cache_dir, rebuild=False, sample_rate=None,
+                        duty_filter=None):
+    """Return the Dataset of a JSON dataset file from its binary cache in 'cache_dir'.
+
+    The cache is keyed by the file path, size, mtime and content hash. A matching
+    size and mtime is trusted without reading the file, otherwise the content hash
+    decides, so a touched but unchanged file keeps its cache. A missing, stale or
+    unreadable cache, or 'rebuild', parses the JSON file and writes a new cache.
+    The validation of the file is cached with it, and is only run again when
+    'sample_rate' asks for more than the cached one. A 'duty_filter' selecting
+    duty or vehicle IDs builds only the records they need, from the cache or the
+    JSON data, and a partial Dataset is not cached.
+
+    The cache holds the records as columns, see Dataset.get_columns(), read back
+    without building any record: on the 33 MB synthetic dataset of 5000 duties a
+    warm load takes 25-40 ms, against 0.46 s for the pickled records it replaced.
+    """
+    path = str(Path(dataset_file).resolve())
+    stat = os.stat(dataset_file)
+    cache_file = get_cache_file(dataset_file, cache_dir)
+
+    def read_dataset(payload):
+        with profiler.stage('cache_load'):
+            columns, validation = pickle.loads(payload)
+            dataset = Dataset.from_columns(columns, duty_filter)
+            if validation is not None:
+                dataset.validation = ValidationReport.from_summary(validation)
+        profiler.count('cache_hits')
+        return dataset
+
+    if not rebuild and cache_file.is_file():
+        try:
+            with open(cache_file, 'rb') as f:
+                cache_key = pickle.load(f)
+                if (cache_key['version'] == CACHE_VERSION and cache_key['path'] == path
+                        and cache_key['size'] == stat.st_size
+                        and (cache_key['sample_rate'] or 0) >= (sample_rate or 0)):
+                    if cache_key['mtime'] == stat.st_mtime_ns:
+                        return read_dataset(f.read())
+                    if cache_key['hash'] == get_file_hash(dataset_file):
+                        # Same payload under the new mtime, the records are not built
+                        payload = f.read()
+                        cache_key['mtime'] = stat.st_mtime_ns
+                        write_dataset_cache(cache_file, cache_key, payload=payload)
+                        return read_dataset(payload)
+        except Exception:
+            # Unreadable cache, rebuilt below
+            pass
+
+    profiler.count('cache_misses')
+
+    # Hash the same bytes that are parsed, the file is read once
+    with profiler.stage('load'):
+        with open(dataset_file, 'rb') as f:
+            content = f.read()
+        data = decode_json(content, typed=not sample_rate)
+    if duty_filter is not None and duty_filter.selects_vehicles:
+        return index_dataset(data, sample_rate, duty_filter)
+    dataset = index_dataset(data, sample_rate)
+    del data
+
+    cache_key = {
+        'version': CACHE_VERSION,
+        'path': path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': hashlib.blake2b(content, digest_size=20).hexdigest(),
+        'sample_rate': sample_rate
+    }
+    del content
+    write_dataset_cache(cache_file, cache_key, dataset)
+    return dataset
+
+
+class JsonStreamReader:
+    """Incremental reader of a JSON document, decoding one value at a time.
+
+    Only the value being decoded is held in memory, so the items of a large
+    top-level array can be iterated without loading the whole file.
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+        """Read more of the file into the buffer, return False at end of file"""
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop the part of the buffer already consumed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non whitespace character without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON file.")
+
+    def _expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of JSON buffer.")
+        self.pos += 1
+
+    def decode(self):
+        """Decode and return the next JSON value"""
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                value, end = None, None
+            # A value ending at the buffer end may be a truncated number
+            if end is not None and (end < len(self.buffer) or self.eof):
+                self.pos = end
+                return value
+            if not self._fill(size):
+                if end is not None:
+                    self.pos = end
+                    return value
+                raise ValueError("Unexpected end of JSON file.")
+            # Grow the reads so large values are not re-decoded too often
+            size *= 2
+
+    def iter_object(self):
+        """Yield the keys of the next JSON object, the caller must consume each value"""
+        self._expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self._expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self._expect('}')
+                return
+
+    def iter_array(self):
+        """Yield the decoded items of the next JSON array"""
+        self._expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self._expect(']')
+                return
+
+
+def iter_dataset_array(dataset_file, key):
+    """Yield the items of the top-level array 'key' of a JSON dataset file one at a time"""
+    with open(dataset_file) as f:
+        reader = JsonStreamReader(f)
+        for section in reader.iter_object():
+            if section == key:
+                yield from reader.iter_array()
+                return
+            # Other sections are decoded item by item and dropped
+            if reader.peek() == '[':
+                for _ in reader.iter_array():
+                    pass
+            else:
+                reader.decode()
+
+
+class DutyStream:
+    """Iterable over the duties of a JSON dataset file, read from the file on every pass"""
+
+    def __init__(self, dataset_file):
+        self.dataset_file = dataset_file
+
+    def __iter__(self):
+        for duty in iter_dataset_array(self.dataset_file, 'duties'):
+            yield Duty(duty)
+
+
+def stream_dataset(dataset_file):
+    """Return a Dataset indexing stops, trips and vehicles of a JSON dataset file
+    in a single streaming pass, with the duties streamed from the file on demand.
+    Works with the sections in any order.
+    """
+    dataset = Dataset()
+    add_item = {
+        'stops': dataset.add_stop,
+        'trips': dataset.add_trip,
+        'vehicles': dataset.add_vehicle
+    }
+
+    with open(dataset_file) as f, paused_gc(), profiler.stage('index'):
+        reader = JsonStreamReader(f)
+        for section in reader.iter_object():
+            if reader.peek() != '[':
+                reader.decode()
+                continue
+            add = add_item.get(section)
+            for item in reader.iter_array():
+                # Duties are dropped here and read again when iterated
+                if add:
+                    add(item)
+
+    dataset.duties = DutyStream(dataset_file)
+    return dataset
+
+
+# Bump when the tables change, older store files are then imported again
+STORE_VERSION = 1
+
+STORE_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE stops (
+    stop_id TEXT PRIMARY KEY, stop_name TEXT, latitude REAL, longitude REAL, is_depot INTEGER
+);
+CREATE TABLE trips (
+    trip_id TEXT PRIMARY KEY, route_number TEXT, origin_stop_id TEXT,
+    destination_stop_id TEXT, departure_time TEXT, arrival_time TEXT
+);
+CREATE TABLE vehicle_events (
+    vehicle_id TEXT, vehicle_event_sequence INTEGER, vehicle_event_type TEXT, duty_id TEXT,
+    trip_id TEXT, start_time TEXT, end_time TEXT, origin_stop_id TEXT, destination_stop_id TEXT,
+    PRIMARY KEY (vehicle_id, vehicle_event_sequence)
+) WITHOUT ROWID;
+CREATE TABLE duties (duty_position INTEGER PRIMARY KEY, duty_id TEXT);
+CREATE TABLE duty_events (
+    duty_position INTEGER, event_position INTEGER, duty_event_sequence INTEGER,
+    duty_event_type TEXT, vehicle_id TEXT, vehicle_event_sequence INTEGER, start_time TEXT,
+    end_time TEXT, origin_stop_id TEXT, destination_stop_id TEXT,
+    PRIMARY KEY (duty_position, event_position)
+) WITHOUT ROWID;
+"""
+
+# Created after the bulk insert, faster than maintaining them row by row
+STORE_INDEXES = """
+CREATE INDEX duties_duty_id ON duties (duty_id);
+CREATE INDEX duty_events_vehicle_id ON duty_events (vehicle_id);
+"""
+
+STORE_COLUMNS = {
+    'stops': ('stop_id', 'stop_name', 'latitude', 'longitude', 'is_depot'),
+    'trips': ('trip_id', 'route_number', 'origin_stop_id', 'destination_stop_id',
+              'departure_time', 'arrival_time'),
+    'vehicle_events': ('vehicle_id', 'vehicle_event_sequence', 'vehicle_event_type', 'duty_id',
+                       'trip_id', 'start_time', 'end_time', 'origin_stop_id',
+                       'destination_stop_id'),
+    'duty_events': ('duty_event_sequence', 'duty_event_type', 'vehicle_id',
+                    'vehicle_event_sequence', 'start_time', 'end_time', 'origin_stop_id',
+                    'destination_stop_id')
+}
+
+def get_store_rows(section, item, position):
+    """Return the table and the rows to insert of an item of a JSON dataset section"""
+    if section == 'stops':
+        return 'stops', [tuple(item.get(column) for column in STORE_COLUMNS['stops'])]
+    if section == 'trips':
+        return 'trips', [tuple(item.get(column) for column in STORE_COLUMNS['trips'])]
+    if section == 'vehicles':
+        vehicle_id = item['vehicle_id']
+        return 'vehicle_events', [
+            (vehicle_id, int(event['vehicle_event_sequence']))
+            + tuple(event.get(column) for column in STORE_COLUMNS['vehicle_events'][2:])
+            for event in item['vehicle_events']]
+    return 'duty_events', [
+        (position, event_position)
+        + tuple(event.get(column) for column in STORE_COLUMNS['duty_events'])
+        for event_position, event in enumerate(item['duty_events'])]
+
+def import_dataset_store(dataset_file, store_file, batch_size=10000):
+    """Import a JSON dataset file into a new SQLite store file in one streaming pass,
+    rows inserted 'batch_size' at a time in a single transaction. The file is built
+    aside and moved in place once complete. Return the store key written to its meta.
+    """
+    stat = os.stat(dataset_file)
+    store_key = {
+        'version': STORE_VERSION,
+        'path': str(Path(dataset_file).resolve()),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': get_file_hash(dataset_file)
+    }
+
+    store_file = Path(store_file)
+    store_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = store_file.with_suffix(f'.{os.getpid()}.tmp')
+    if temp_file.exists():
+        temp_file.unlink()
+
+    connection = sqlite3.connect(temp_file)
+    try:
+        # Nothing to recover from a failed import, the temporary file is discarded
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(STORE_SCHEMA)
+
+        pending = {}
+        def flush(table):
+            rows = pending.pop(table, [])
+            if rows:
+                placeholders = ', '.join('?' * len(rows[0]))
+                # First match wins, same as the Dataset indexes
+                connection.executemany(f"INSERT OR IGNORE INTO {table} VALUES ({placeholders})",
+                                       rows)
+
+        with open(dataset_file) as f, profiler.stage('store_import'):
+            reader = JsonStreamReader(f)
+            for section in reader.iter_object():
+                if section not in ('stops', 'trips', 'vehicles', 'duties') \
+                        or reader.peek() != '[':
+                    reader.decode()
+                    continue
+                for position, item in enumerate(reader.iter_array()):
+                    if section == 'duties':
+                        pending.setdefault('duties', []).append((position, item['duty_id']))
+                    table, rows = get_store_rows(section, item, position)
+                    pending.setdefault(table, []).extend(rows)
+                    if len(pending[table]) >= batch_size:
+                        flush(table)
+                        flush('duties')
+                for table in list(pending):
+                    flush(table)
+
+        connection.executescript(STORE_INDEXES)
+        connection.executemany("INSERT INTO meta VALUES (?, ?)",
+                               [(key, json.dumps(value)) for key, value in store_key.items()])
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(temp_file, store_file)
+    return store_key
+
+def open_store(dataset_file, store_file, rebuild=False):
+    """Return the DatasetStore of a JSON dataset file, importing it into 'store_file'
+    first unless the store is up to date. Checked like the dataset cache: a
+    matching size and mtime, or else a matching content hash.
+    """
+    store_file = Path(store_file)
+    if not rebuild and store_file.is_file():
+        try:
+            store = DatasetStore(store_file)
+            stat = os.stat(dataset_file)
+            key = store.get_meta()
+            if (key.get('version') == STORE_VERSION and key.get('size') == stat.st_size
+                    and (key.get('mtime') == stat.st_mtime_ns
+                         or key.get('hash') == get_file_hash(dataset_file))):
+                profiler.count('store_hits')
+                return store
+            store.close()
+        except sqlite3.Error:
+            # Unreadable store, imported again below
+            pass
+
+    profiler.count('store_imports')
+    import_dataset_store(dataset_file, store_file)
+    return DatasetStore(store_file)
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+class DatasetStore:
+    """Dataset kept out of core in an SQLite file written by import_dataset_store().
+
+    Only the stops are held in memory. The duties are read in batches, each with
+    a Dataset of the vehicle events and trips they reference, read with indexed
+    joins, so the report engine runs on it unchanged with memory bounded by a batch.
+    """
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.connection = sqlite3.connect(store_file)
+        self.connection.row_factory = _dict_factory
+        self.stop_index = {}
+        for stop in self.connection.execute("SELECT * FROM stops"):
+            stop['is_depot'] = bool(stop['is_depot'])
+            self.stop_index[stop['stop_id']] = Stop(stop)
+
+    def close(self):
+        self.connection.close()
+
+    def get_meta(self):
+        return {row['key']: json.loads(row['value'])
+                for row in self.connection.execute("SELECT key, value FROM meta")}
+
+    def get_stop_name(self, stop_id):
+        stop = self.stop_index.get(stop_id)
+        return stop.stop_name if stop else None
+
+    @property
+    def duties(self):
+        """The duties, read from the store on every pass"""
+        return (duty for duties, _ in self.iter_batches() for duty in duties)
+
+    def get_duty_positions(self, duty_filter):
+        """Return the positions of the duties with the IDs or vehicles selected by the
+        filter, found through the indexes, None to read all of them
+        """
+        if duty_filter is None or not duty_filter.selects_vehicles:
+            return None
+        # The IDs are loaded into temporary tables and joined, not passed as an IN
+        # list, whose parameters are limited by SQLITE_MAX_VARIABLE_NUMBER
+        queries = []
+        for table, ids, query in (
+                ('selected_duty_ids', duty_filter.duty_ids,
+                 "SELECT d.duty_position FROM duties d "
+                 "JOIN temp.selected_duty_ids s ON d.duty_id = s.id"),
+                ('selected_vehicle_ids', duty_filter.vehicle_ids,
+                 "SELECT DISTINCT de.duty_position FROM duty_events de "
+                 "JOIN temp.selected_vehicle_ids s ON de.vehicle_id = s.id")):
+            if ids is None:
+                continue
+            self.connection.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY)")
+            self.connection.execute(f"DELETE FROM temp.{table}")
+            self.connection.executemany(f"INSERT INTO temp.{table} VALUES (?)",
+                                        ((record_id,) for record_id in ids))
+            queries.append(query)
+        self.connection.commit()
+        query = " INTERSECT ".join(queries) + " ORDER BY duty_position"
+        return [row['duty_position'] for row in self.connection.execute(query)]
+
+    def iter_batches(self, batch_size=1024, duty_filter=None):
+        """Yield (duties, dataset) batches of up to 'batch_size' duties in dataset order,
+        the dataset holding the records they reference. With 'duty_filter' only the
+        duties it selects, their positions found through the indexes when it can.
+        """
+        positions = self.get_duty_positions(duty_filter)
+        if positions is None:
+            count = self.connection.execute("SELECT COUNT(*) AS count FROM duties").fetchone()
+            ranges = ((start, start + batch_size)
+                      for start in range(0, count['count'], batch_size))
+        else:
+            # Selected duties are few, read one at a time
+            ranges = ((position, position + 1) for position in positions)
+
+        for start, end in ranges:
+            duties, dataset = self.read_batch(start, end)
+            if duty_filter:
+                duties = list(duty_filter.filter(duties, dataset))
+            if duties:
+                yield duties, dataset
+
+    def read_batch(self, start, end):
+        """Return the duties at positions start to end, excluded, and a Dataset of the
+        vehicle events and trips they reference
+        """
+        where = "de.duty_position >= ? AND de.duty_position < ?"
+        events = {}
+        for event in self.connection.execute(
+                f"SELECT * FROM duty_events de WHERE {where} "
+                "ORDER BY duty_position, event_position", (start, end)):
+            events.setdefault(event['duty_position'], []).append(event)
+        duties = [Duty({'duty_id': row['duty_id'],
+                        'duty_events': events.get(row['duty_position'], [])})
+                  for row in self.connection.execute(
+                      "SELECT duty_position, duty_id FROM duties WHERE duty_position >= ? "
+                      "AND duty_position < ? ORDER BY duty_position", (start, end))]
+
+        dataset = Dataset()
+        dataset.stop_index = self.stop_index
+        for event in self.connection.execute(
+                "SELECT DISTINCT ve.* FROM duty_events de JOIN vehicle_events ve "
+                "ON ve.vehicle_id = de.vehicle_id "
+                "AND ve.vehicle_event_sequence = de.vehicle_event_sequence "
+                f"WHERE {where}", (start, end)):
+            vehicle_event = VehicleEvent(intern_id(event['vehicle_id']), event)
+            dataset.vehicle_event_index[(vehicle_event.vehicle_id,
+                                         vehicle_event.vehicle_event_sequence)] = vehicle_event
+        for trip in self.connection.execute(
+                "SELECT DISTINCT t.* FROM duty_events de JOIN vehicle_events ve "
+                "ON ve.vehicle_id = de.vehicle_id "
+                "AND ve.vehicle_event_sequence = de.vehicle_event_sequence "
+                f"JOIN trips t ON t.trip_id = ve.trip_id WHERE {where}", (start, end)):
+            dataset.add_trip(trip)
+        return duties, dataset
+
+
+# Required fields and their JSON types, from the Data Model documentation
+NUMBER = (int, float)
+SEQUENCE = (str, int)
+STOP_FIELDS = {'stop_id': str, 'stop_name': str, 'latitude': NUMBER, 'longitude': NUMBER,
+               'is_depot': bool}
+TRIP_FIELDS = {'trip_id': str, 'route_number': str, 'origin_stop_id': str,
+               'destination_stop_id': str, 'departure_time': str, 'arrival_time': str}
+VEHICLE_FIELDS = {'vehicle_id': str, 'vehicle_events': list}
+DUTY_FIELDS = {'duty_id': str, 'duty_events': list}
+# Events with a start and end time and stops, unlike service trips and duty vehicle events
+TIMED_EVENT_FIELDS = {'start_time': str, 'end_time': str, 'origin_stop_id': str,
+                      'destination_stop_id': str}
+VEHICLE_EVENT_FIELDS = {
+    None: {'vehicle_event_sequence': SEQUENCE, 'vehicle_event_type': str, 'duty_id': str},
+    'service_trip': {'trip_id': str}
+}
+DUTY_EVENT_FIELDS = {
+    None: {'duty_event_sequence': SEQUENCE, 'duty_event_type': str},
+    'vehicle_event': {'vehicle_event_sequence': SEQUENCE, 'vehicle_id': str}
+}
+
+
+class ValidationReport:
+    """Violations found by validate_dataset(), each a dict with the section, the
+    position and ID of the record and a message. Keeps the first 'max_violations'
+    and counts the others.
+    """
+
+    def __init__(self, sample_rate=1.0, max_violations=1000):
+        self.sample_rate = sample_rate
+        self.max_violations = max_violations
+        self.violations = []
+        self.violation_count = 0
+        self.checked = dict.fromkeys(('stops', 'trips', 'vehicles', 'vehicle_events',
+                                      'duties', 'duty_events'), 0)
+
+    @property
+    def ok(self):
+        return self.violation_count == 0
+
+    def add(self, section, position, record_id, message):
+        self.violation_count += 1
+        if len(self.violations) < self.max_violations:
+            self.violations.append({"section": section, "position": position,
+                                    "id": record_id, "message": message})
+
+    @classmethod
+    def from_summary(cls, summary):
+        """Return the ValidationReport of a summary(), as read from the cache"""
+        report = cls(summary["sample_rate"])
+        report.checked.update(summary["checked"])
+        report.violation_count = summary["violation_count"]
+        report.violations = list(summary["violations"])
+        return report
+
+    def summary(self):
+        return {"sample_rate": self.sample_rate, "checked": dict(self.checked),
+                "violation_count": self.violation_count, "violations": list(self.violations)}
+
+    def print_report(self, file=None, limit=20):
+        file = file or sys.stdout
+        checked = ", ".join(f"{count} {section}" for section, count in self.checked.items())
+        print(f"--- DATASET VALIDATION: {self.violation_count} violations in {checked} ---\n",
+              file=file)
+        if self.violations:
+            from tabulate import tabulate
+            print(tabulate(self.violations[:limit], headers="keys", disable_numparse=True),
+                  file=file)
+            if self.violation_count > limit:
+                print(f"... {self.violation_count - limit} more", file=file)
+            print(file=file)
+
+
+class DatasetValidator:
+    """Single pass schema and referential integrity check of a loaded JSON dataset.
+
+    Each record is checked once for its fields, types, times and sequences. The IDs
+    it references are kept and resolved at the end against the IDs of all records,
+    so the sections can be in any order. With a 'sample_rate' under 1, only that
+    fraction of the stops, trips, vehicles and duties is checked, while the IDs of
+    every record are still collected for the references of the sampled ones.
+    """
+
+    def __init__(self, sample_rate=1.0, seed=0, max_violations=1000):
+        self.report = ValidationReport(sample_rate, max_violations)
+        self.sample_rate = sample_rate
+        self.random = random.Random(seed)
+        self.ids = {'stop': set(), 'trip': set(), 'vehicle_event': set(), 'duty': set()}
+        # (kind, key, section, position, record_id, field) resolved by finish()
+        self.references = []
+
+    def is_sampled(self):
+        return self.sample_rate >= 1 or self.random.random() < self.sample_rate
+
+    def add_id(self, kind, key, section, position):
+        ids = self.ids[kind]
+        if key in ids:
+            self.report.add(section, position, key, f"duplicate {kind} ID")
+        ids.add(key)
+
+    def check_fields(self, record, fields, section, position, record_id):
+        """Return whether 'record' is an object with all of 'fields', of the right types"""
+        if not isinstance(record, dict):
+            self.report.add(section, position, record_id, "not a JSON object")
+            return False
+        valid = True
+        for field, field_type in fields.items():
+            value = record.get(field)
+            if value is None:
+                self.report.add(section, position, record_id, f"missing {field}")
+                valid = False
+            elif not isinstance(value, field_type) or (field_type is NUMBER
+                                                       and isinstance(value, bool)):
+                self.report.add(section, position, record_id,
+                                f"{field} has type {type(value).__name__}")
+                valid = False
+        return valid
+
+    def check_times(self, record, start_field, end_field, section, position, record_id):
+        times = []
+        for field in (start_field, end_field):
+            try:
+                minutes = parse_time(record[field])
+            except (ValueError, TypeError):
+                minutes = None
+            # parse_time() returns None for an empty time
+            if minutes is None:
+                self.report.add(section, position, record_id,
+                                f"{field} is not a D.HH:MM time: {record[field]!r}")
+            else:
+                times.append(minutes)
+        if len(times) == 2 and times[1] < times[0]:
+            self.report.add(section, position, record_id, f"{end_field} before {start_field}")
+
+    def check_sequence(self, sequence, previous, section, position, record_id):
+        """Return the sequence as int, checking it follows 'previous'"""
+        try:
+            sequence = int(sequence)
+        except (ValueError, TypeError):
+            self.report.add(section, position, record_id, f"sequence is not an integer: {sequence!r}")
+            return previous
+        if previous is not None and sequence <= previous:
+            self.report.add(section, position, record_id,
+                            f"sequence {sequence} does not follow {previous}")
+        return sequence
+
+    def refer(self, kind, key, section, position, record_id, field):
+        self.references.append((kind, key, section, position, record_id, field))
+
+    def check_stop(self, stop, position):
+        stop_id = stop.get('stop_id') if isinstance(stop, dict) else None
+        self.add_id('stop', stop_id, 'stops', position)
+        if not self.is_sampled():
+            return
+        self.report.checked['stops'] += 1
+        self.check_fields(stop, STOP_FIELDS, 'stops', position, stop_id)
+
+    def check_trip(self, trip, position):
+        trip_id = trip.get('trip_id') if isinstance(trip, dict) else None
+        self.add_id('trip', trip_id, 'trips', position)
+        if not self.is_sampled():
+            return
+        self.report.checked['trips'] += 1
+        if self.check_fields(trip, TRIP_FIELDS, 'trips', position, trip_id):
+            self.check_times(trip, 'departure_time', 'arrival_time', 'trips', position, trip_id)
+            for field in ('origin_stop_id', 'destination_stop_id'):
+                self.refer('stop', trip[field], 'trips', position, trip_id, field)
+
+    def check_vehicle(self, vehicle, position):
+        vehicle_id = vehicle.get('vehicle_id') if isinstance(vehicle, dict) else None
+        events = vehicle.get('vehicle_events') if isinstance(vehicle, dict) else None
+        sampled = self.is_sampled()
+        if sampled:
+            self.report.checked['vehicles'] += 1
+            if not self.check_fields(vehicle, VEHICLE_FIELDS, 'vehicles', position, vehicle_id):
+                return
+        if not isinstance(events, list):
+            return
+
+        previous = None
+        for number, event in enumerate(events):
+            event_position = f"{position}/{number}"
+            if not sampled:
+                if isinstance(event, dict):
+                    try:
+                        sequence = int(event.get('vehicle_event_sequence'))
+                    except (ValueError, TypeError):
+                        continue
+                    self.ids['vehicle_event'].add((vehicle_id, sequence))
+                continue
+
+            self.report.checked['vehicle_events'] += 1
+            event_type = event.get('vehicle_event_type') if isinstance(event, dict) else None
+            if event_type is not None and (VehicleEventType, event_type) not in EVENT_TYPES:
+                self.report.add('vehicle_events', event_position, vehicle_id,
+                                f"unknown vehicle_event_type {event_type!r}")
+                continue
+            fields = {**VEHICLE_EVENT_FIELDS[None],
+                      **VEHICLE_EVENT_FIELDS.get(event_type, TIMED_EVENT_FIELDS)}
+            if not self.check_fields(event, fields, 'vehicle_events', event_position, vehicle_id):
+                continue
+
+            sequence = self.check_sequence(event['vehicle_event_sequence'], previous,
+                                           'vehicle_events', event_position, vehicle_id)
+            if sequence != previous:
+                self.add_id('vehicle_event', (vehicle_id, sequence), 'vehicle_events',
+                            event_position)
+            previous = sequence
+
+            self.refer('duty', event['duty_id'], 'vehicle_events', event_position, vehicle_id,
+                       'duty_id')
+            if event_type == 'service_trip':
+                self.refer('trip', event['trip_id'], 'vehicle_events', event_position,
+                           vehicle_id, 'trip_id')
+            else:
+                self.check_times(event, 'start_time', 'end_time', 'vehicle_events',
+                                 event_position, vehicle_id)
+                for field in ('origin_stop_id', 'destination_stop_id'):
+                    self.refer('stop', event[field], 'vehicle_events', event_position,
+                               vehicle_id, field)
+
+    def check_duty(self, duty, position):
+        duty_id = duty.get('duty_id') if isinstance(duty, dict) else None
+        self.add_id('duty', duty_id, 'duties', position)
+        if not self.is_sampled():
+            return
+        self.report.checked['duties'] += 1
+        if not self.check_fields(duty, DUTY_FIELDS, 'duties', position, duty_id):
+            return
+
+        previous = None
+        for number, event in enumerate(duty['duty_events']):
+            event_position = f"{position}/{number}"
+            self.report.checked['duty_events'] += 1
+            event_type = event.get('duty_event_type') if isinstance(event, dict) else None
+            if event_type is not None and (DutyEventType, event_type) not in EVENT_TYPES:
+                self.report.add('duty_events', event_position, duty_id,
+                                f"unknown duty_event_type {event_type!r}")
+                continue
+            fields = {**DUTY_EVENT_FIELDS[None],
+                      **DUTY_EVENT_FIELDS.get(event_type, TIMED_EVENT_FIELDS)}
+            if not self.check_fields(event, fields, 'duty_events', event_position, duty_id):
+                continue
+
+            previous = self.check_sequence(event['duty_event_sequence'], previous,
+                                           'duty_events', event_position, duty_id)
+            if event_type == 'vehicle_event':
+                try:
+                    key = (event['vehicle_id'], int(event['vehicle_event_sequence']))
+                except ValueError:
+                    self.report.add('duty_events', event_position, duty_id,
+                                    "vehicle_event_sequence is not an integer")
+                    continue
+                self.refer('vehicle_event', key, 'duty_events', event_position, duty_id,
+                           'vehicle_event_sequence')
+            else:
+                self.check_times(event, 'start_time', 'end_time', 'duty_events',
+                                 event_position, duty_id)
+                for field in ('origin_stop_id', 'destination_stop_id'):
+                    self.refer('stop', event[field], 'duty_events', event_position,
+                               duty_id, field)
+
+    def finish(self):
+        """Resolve the references collected and return the report"""
+        for kind, key, section, position, record_id, field in self.references:
+            if key not in self.ids[kind]:
+                self.report.add(section, position, record_id, f"{field} {key!r} not found")
+        self.references = []
+        return self.report
+
+def validate_dataset(data, sample_rate=1.0, seed=0, max_violations=1000):
+    """Return the ValidationReport of a loaded JSON dataset, see DatasetValidator"""
+    validator = DatasetValidator(sample_rate, seed, max_violations)
+    if not isinstance(data, dict):
+        validator.report.add('dataset', None, None, "not a JSON object")
+        return validator.report
+
+    check_record = {
+        'stops': validator.check_stop,
+        'trips': validator.check_trip,
+        'vehicles': validator.check_vehicle,
+        'duties': validator.check_duty
+    }
+    for section, check in check_record.items():
+        records = data.get(section)
+        if not isinstance(records, list):
+            validator.report.add(section, None, None, "missing or not a list")
+            continue
+        for position, record in enumerate(records):
+            check(record, position)
+    return validator.finish()
+
+def validate_dataset_file(dataset_file, sample_rate=1.0, seed=0, max_violations=1000):
+    """Return the ValidationReport of a JSON dataset file"""
+    with open(dataset_file, 'rb') as f:
+        return validate_dataset(decode_json(f.read()), sample_rate, seed, max_violations)
+
+
+def find_trip(trips, trip_id):
+    """Return the trip matching trip_id from a list of trips or a Dataset"""
+    if isinstance(trips, Dataset):
+        return trips.get_trip(trip_id)
+    return next((trip for trip in trips if trip['trip_id'] == trip_id), None)
+
+def find_stop(stops, stop_id):
+    """Return the stop matching stop_id from a list of stops or a Dataset"""
+    if isinstance(stops, Dataset):
+        return stops.get_stop(stop_id)
+    return next((stop for stop in stops if stop['stop_id'] == stop_id), None)
 
 def get_vehicle_event(vehicles, vehicle_id, vehicle_event_sequence):
     """Return an event matching vehicle_id and vehicle_event_sequence"""
     try:
+        if isinstance(vehicles, Dataset):
+            return vehicles.get_vehicle_event(vehicle_id, vehicle_event_sequence)
+
         # Generator expression to get first match of vehicle ID and Sequence
         event = next((event for vehicle in vehicles if vehicle['vehicle_id'] == vehicle_id
                             for event in vehicle['vehicle_events']
@@ -73,8 +1839,9 @@ def get_last_service_trip(duty_events, vehicles):
 def get_start_stop(event, trips, stops):
     """Return the start stop description of the event"""
     try:
-        description = next((stop['stop_name'] for trip in trips if trip['trip_id'] == event['trip_id']
-                            for stop in stops if stop['stop_id'] == trip["origin_stop_id"]), None)
+        trip = find_trip(trips, event['trip_id'])
+        stop = find_stop(stops, trip["origin_stop_id"]) if trip else None
+        description = stop['stop_name'] if stop else None
     except Exception as e:
         print(e.args)
         return None
@@ -84,8 +1851,9 @@ def get_start_stop(event, trips, stops):
 def get_end_stop(event, trips, stops):
     """Return the end stop description of the event"""
     try:
-        description = next((stop['stop_name'] for trip in trips if trip['trip_id'] == event['trip_id']
-                            for stop in stops if stop['stop_id'] == trip["destination_stop_id"]), None)
+        trip = find_trip(trips, event['trip_id'])
+        stop = find_stop(stops, trip["destination_stop_id"]) if trip else None
+        description = stop['stop_name'] if stop else None
     except Exception as e:
         print(e.args)
         return None
@@ -95,31 +1863,52 @@ def get_end_stop(event, trips, stops):
 def get_stop_name(destination_stop_id, stops):
     """Return the end stop description of the event"""
     try:
-        name = next((stop['stop_name'] for stop in stops
-                     if stop['stop_id'] == destination_stop_id), None)
+        stop = find_stop(stops, destination_stop_id)
+        name = stop['stop_name'] if stop else None
     except Exception as e:
         print(e.args)
         return None
     else:
         return name
     
+# Parsed times, a dataset repeats the same few thousand times over and over
+_parsed_times = {}
+
+def parse_time(time):
+    """Return a "D.HH:MM" time as integer minutes since the start of the service day,
+    None for a missing time.
+    """
+    minutes = _parsed_times.get(time)
+    if minutes is not None:
+        return minutes
+    if not time:
+        return None
+    day, _, hours_minutes = time.partition('.')
+    hours, minutes = hours_minutes.split(':')
+    minutes = int(day) * 1440 + int(hours) * 60 + int(minutes)
+    if len(_parsed_times) < 100000:
+        _parsed_times[time] = minutes
+    return minutes
+
+def unparse_time(minutes):
+    """Return integer minutes as a "D.HH:MM" time, the dataset format"""
+    return f"{minutes // 1440}.{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+def format_time(minutes):
+    """Return integer minutes as "HH:MM" for the reports, empty for a missing time"""
+    if minutes is None:
+        return ''
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
 def get_time_difference_minutes(start_time, end_time):
     """Return the difference between two times in minutes"""
     try:
-        start_time_split = start_time.replace(':', '.').split('.')
-        end_time_split = end_time.replace(':', '.').split('.')
-        start_timedelta = timedelta(days=int(start_time_split[0]),
-                                    hours=int(start_time_split[1]),
-                                    minutes=int(start_time_split[2]))
-        end_timedelta = timedelta(days=int(end_time_split[0]),
-                                    hours=int(end_time_split[1]),
-                                    minutes=int(end_time_split[2]))
-        delta = end_timedelta - start_timedelta
+        delta = parse_time(end_time) - parse_time(start_time)
     except Exception as e:
         print(e.args)
         return None
     else:
-        return delta.total_seconds() / 60
+        return float(delta)
     
 def get_event_list(duty_events, stops, vehicles, trips):
     """Return events in the duty_events in a single list"""
@@ -155,8 +1944,7 @@ def get_event_list(duty_events, stops, vehicles, trips):
                         'destination_stop_name': name
                     })
                 elif vehicle_event['vehicle_event_type'] == "service_trip":
-                    trip = next((trip for trip in trips
-                                    if trip['trip_id'] == vehicle_event['trip_id']), None)
+                    trip = find_trip(trips, vehicle_event['trip_id'])
                     # All the information needed is in the trip
                     name = get_stop_name(trip['destination_stop_id'], stops)
                     event_list.append({
@@ -174,286 +1962,1827 @@ def get_event_list(duty_events, stops, vehicles, trips):
     else:
         return event_list
 
-def print_times_report(dataset_file):
-    """Print report with Duty ID, Start Time, and End Time for duties in dataset."""
-    # List of Duty Reports 
-    # {Duty ID, Start Time, End Time}
-    duty_report = []
+def get_vehicle_event_times(vehicle_event, dataset):
+    """Return (start_time, end_time, destination_stop_id) of a vehicle event record,
+    service trips taking them from their trip. None if the trip is not found.
+    """
+    if vehicle_event.vehicle_event_type is VehicleEventType.service_trip:
+        trip = dataset.trip_index.get(vehicle_event.trip_id)
+        if trip is None:
+            return None
+        return trip.departure_time, trip.arrival_time, trip.destination_stop_id
+    return vehicle_event.start_time, vehicle_event.end_time, vehicle_event.destination_stop_id
+
+def get_service_trip_stop(vehicle_events, dataset, stop_field):
+    """Return the stop name of 'stop_field' of the trip of the first service trip
+    in vehicle_events, None if it is not found or a vehicle event is missing before it
+    """
+    for vehicle_event in vehicle_events:
+        if vehicle_event is None:
+            return None
+        if vehicle_event.vehicle_event_type is VehicleEventType.service_trip:
+            trip = dataset.trip_index.get(vehicle_event.trip_id)
+            if profiler.enabled:
+                profiler.count('trip_lookups')
+                if trip:
+                    profiler.count('stop_lookups')
+            return dataset.get_stop_name(getattr(trip, stop_field)) if trip else None
+    return None
+
+def resolve_duty(duty, dataset, with_stops=True, with_events=True):
+    """Return the timeline of a duty: start and end time, start and end stop
+    description and, for the breaks report, the times and stops of all its events.
+    Each duty is resolved once and shared by all the reports, times in integer minutes.
+    """
+    # Vehicle event record of each vehicle_event duty event, None if not in dataset
+    vehicle_events = [
+        dataset.vehicle_event_index.get((duty_event.vehicle_id, duty_event.vehicle_event_sequence))
+        for duty_event in duty.duty_events
+        if duty_event.duty_event_type is DutyEventType.vehicle_event
+    ]
+
+    # (start_time, end_time, destination_stop_id) of every duty event
+    events = []
+    vehicle_event_iter = iter(vehicle_events)
+    # Lookups counted as they are made, when profiling
+    counting = profiler.enabled
+    trip_lookups = 0
+    for duty_event in duty.duty_events:
+        if duty_event.duty_event_type is DutyEventType.vehicle_event:
+            vehicle_event = next(vehicle_event_iter)
+            events.append(get_vehicle_event_times(vehicle_event, dataset) if vehicle_event else None)
+            # get_vehicle_event_times() looks up the trip of a service trip
+            if counting and vehicle_event is not None and (
+                    vehicle_event.vehicle_event_type is VehicleEventType.service_trip):
+                trip_lookups += 1
+        else:
+            events.append((duty_event.start_time, duty_event.end_time,
+                           duty_event.destination_stop_id))
+
+    timeline = {
+        'duty_id': duty.duty_id,
+        'start_time': events[0][0] if events and events[0] else None,
+        'end_time': events[-1][1] if events and events[-1] else None,
+        'start_stop': '',
+        'end_stop': '',
+        'event_start_times': [],
+        'event_end_times': [],
+        'event_stop_names': []
+    }
+
+    if with_stops:
+        # Start Stop Description of first service trip, End Stop Description of last one
+        timeline['start_stop'] = get_service_trip_stop(vehicle_events, dataset, 'origin_stop_id')
+        timeline['end_stop'] = get_service_trip_stop(reversed(vehicle_events), dataset,
+                                                     'destination_stop_id')
+
+    # Without every event found the event list is incomplete and has no breaks
+    complete = None not in events
+    if with_events and complete:
+        for start_time, end_time, stop_id in events:
+            timeline['event_start_times'].append(start_time)
+            timeline['event_end_times'].append(end_time)
+            timeline['event_stop_names'].append(dataset.get_stop_name(stop_id))
+        if counting:
+            profiler.count('stop_lookups', len(events))
+
+    if counting:
+        profiler.count('duties_processed')
+        profiler.count('vehicle_event_lookups', len(vehicle_events))
+        profiler.count('trip_lookups', trip_lookups)
+        profiler.count('lookup_failures', events.count(None))
+
+    return timeline
+
+def get_numpy():
+    """Return the numpy module, None if it is not installed and break detection
+    falls back to plain Python
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+def find_breaks(duty_index, end_times, start_times, min_duration):
+    """Return (event index, duration) of every gap over 'min_duration' minutes between
+    the end of an event and the start of the next event of the same duty.
+    The arrays hold the events of any number of duties one after the other, duty_index
+    giving the duty of each event. Vectorized with NumPy when it is installed.
+    """
+    if len(end_times) < 2:
+        return []
+
+    np = get_numpy()
+    if np is not None:
+        duty_index = np.asarray(duty_index, dtype=np.int64)
+        end_times = np.asarray(end_times, dtype=np.int64)
+        start_times = np.asarray(start_times, dtype=np.int64)
+
+        gaps = start_times[1:] - end_times[:-1]
+        same_duty = duty_index[1:] == duty_index[:-1]
+        indexes = np.flatnonzero(same_duty & (gaps > min_duration))
+        return list(zip(indexes.tolist(), gaps[indexes].tolist()))
+
+    breaks = []
+    for index in range(len(end_times) - 1):
+        gap = start_times[index + 1] - end_times[index]
+        if gap > min_duration and duty_index[index + 1] == duty_index[index]:
+            breaks.append((index, gap))
+    return breaks
+
+def detect_breaks(timelines, min_duration):
+    """Return for each resolved duty the list of (event index, duration) of its breaks
+    over 'min_duration' minutes, detected over the events of all the duties at once.
+    """
+    # Typed arrays are handed to NumPy without copying
+    duty_index = array('q')
+    end_times = array('q')
+    start_times = array('q')
+    offsets = []
+
+    for number, timeline in enumerate(timelines):
+        offsets.append(len(end_times))
+        duty_index.extend([number] * len(timeline['event_end_times']))
+        end_times.extend(timeline['event_end_times'])
+        start_times.extend(timeline['event_start_times'])
+
+    breaks = [[] for _ in timelines]
+    for index, duration in find_breaks(duty_index, end_times, start_times, min_duration):
+        number = duty_index[index]
+        breaks[number].append((index - offsets[number], duration))
+    return breaks
+
+def get_times_rows(timeline):
+    """Return the times report rows of a resolved duty"""
+    return [{
+        "Duty ID": timeline['duty_id'],
+        "Start Time": format_time(timeline['start_time']),
+        "End Time": format_time(timeline['end_time'])
+    }]
+
+def get_stop_names_rows(timeline):
+    """Return the stop names report rows of a resolved duty"""
+    return [{
+        "Duty ID": timeline['duty_id'],
+        "Start Time": format_time(timeline['start_time']),
+        "End Time": format_time(timeline['end_time']),
+        "Start Stop Description": timeline['start_stop'],
+        "End Stop Description": timeline['end_stop']
+    }]
+
+def get_breaks_rows(timeline, breaks):
+    """Return one breaks report row for every break of a resolved duty,
+    breaks given as (event index, duration) from detect_breaks()
+    """
+    rows = []
+    for index, duration in breaks:
+        rows.append({
+            "Duty ID": timeline['duty_id'],
+            "Start Time": format_time(timeline['start_time']),
+            "End Time": format_time(timeline['end_time']),
+            "Start Stop Description": timeline['start_stop'],
+            "End Stop Description": timeline['end_stop'],
+            "Break start time": format_time(timeline['event_end_times'][index]),
+            "Break duration": duration,
+            "Break stop name": timeline['event_stop_names'][index]
+        })
+    return rows
+
+# Reports produced by the engine, in printing order
+REPORTS = ('times', 'stops', 'breaks')
+# Fleet aggregate reports, printed by the fleet subcommand
+AGGREGATES = ('break_minutes_by_stop', 'break_minutes_by_route', 'break_minutes_by_depot',
+              'vehicle_minutes', 'duty_lengths')
+# Vehicle reports, printed by their subcommand
+VEHICLE_REPORTS = ('layovers',)
+# Occupancy reports, printed by the occupancy subcommand
+OCCUPANCY_REPORTS = ('occupancy_peaks', 'occupancy_series')
+
+REPORT_TITLES = {
+    'times': "--- DUTY TIMES REPORT ---",
+    'stops': "--- DUTY TIMES AND STOPS REPORT ---",
+    'breaks': "--- BREAKS REPORT ---",
+    'break_query': "--- BREAKS QUERY REPORT ---",
+    'stop_clusters': "--- STOP CLUSTERS REPORT ---",
+    'break_minutes_by_stop': "--- BREAK MINUTES BY STOP ---",
+    'break_minutes_by_route': "--- BREAK MINUTES BY ROUTE ---",
+    'break_minutes_by_depot': "--- BREAK MINUTES BY DEPOT ---",
+    'vehicle_minutes': "--- VEHICLE MINUTES BY EVENT TYPE ---",
+    'duty_lengths': "--- DUTY LENGTH DISTRIBUTION ---",
+    'layovers': "--- VEHICLE LAYOVERS REPORT ---",
+    'occupancy_peaks': "--- STOP OCCUPANCY PEAKS REPORT ---",
+    'occupancy_series': "--- STOP OCCUPANCY TIME SERIES REPORT ---",
+    'duty_diff': "--- DUTY DIFF REPORT ---"
+}
+
+# Columns of each report, in output order
+REPORT_COLUMNS = {
+    'times': ("Duty ID", "Start Time", "End Time"),
+    'stops': ("Duty ID", "Start Time", "End Time", "Start Stop Description",
+              "End Stop Description"),
+    'breaks': ("Duty ID", "Start Time", "End Time", "Start Stop Description",
+               "End Stop Description", "Break start time", "Break duration", "Break stop name"),
+    'stop_clusters': ("Cluster", "Stops", "Stop names", "Nearest depot", "Depot distance (m)"),
+    'break_minutes_by_stop': ("Stop", "Breaks", "Break minutes"),
+    'break_minutes_by_route': ("Route", "Breaks", "Break minutes"),
+    'break_minutes_by_depot': ("Depot", "Breaks", "Break minutes"),
+    'vehicle_minutes': ("Vehicle ID",) + tuple(member.name for member in VehicleEventType)
+                       + ("Total minutes",),
+    'duty_lengths': ("Duty length", "Duties", "Duty minutes"),
+    'layovers': ("Vehicle ID", "Layover start time", "Layover end time", "Layover duration",
+                 "Layover stop name", "At depot"),
+    'occupancy_peaks': ("Stop name", "Occupants", "Peak occupancy", "Peak start time",
+                        "Peak end time", "Intervals"),
+    'occupancy_series': ("Stop name", "Occupants", "Time", "Occupancy"),
+    'duty_diff': ("Duty ID", "Change", "Field", "Old", "New")
+}
+
+def iter_duty_batches(duties, batch_size):
+    """Yield lists of up to 'batch_size' duties"""
+    batch = []
+    for duty in duties:
+        batch.append(duty)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def get_report_rows(duties, dataset, reports=REPORTS, min_duration=15):
+    """Return the (report, row) pairs of the requested reports for a batch of duties.
+    The breaks of the whole batch are detected in one vectorized pass.
+    """
+    with_stops = 'stops' in reports or 'breaks' in reports
+    with_events = 'breaks' in reports
+
+    with profiler.stage('resolve'):
+        timelines = [resolve_duty(duty, dataset, with_stops, with_events) for duty in duties]
+    with profiler.stage('break_detection'):
+        duty_breaks = detect_breaks(timelines, min_duration) if with_events else []
+
+    report_rows = []
+    with profiler.stage('rows'):
+        for number, timeline in enumerate(timelines):
+            if 'times' in reports:
+                report_rows.extend(('times', row) for row in get_times_rows(timeline))
+            if 'stops' in reports:
+                report_rows.extend(('stops', row) for row in get_stop_names_rows(timeline))
+            if 'breaks' in reports:
+                report_rows.extend(('breaks', row)
+                                   for row in get_breaks_rows(timeline, duty_breaks[number]))
+    return report_rows
+
+# Dataset of the report worker processes, inherited through fork or set by the initializer
+_worker_dataset = None
+
+def _init_report_worker(dataset, profile):
+    global _worker_dataset
+    _worker_dataset = dataset
+    if profile:
+        profiler.enable()
+
+def _report_rows_worker(task):
+    """Return the report rows of a shard of duties in a worker process, with the
+    profiler summary of the shard when profiling.
+    A shard is a (start, stop) range of the dataset duties or a list of duties.
+    """
+    shard, reports, min_duration = task
+    profiler.reset()
+    if isinstance(shard, tuple):
+        shard = _worker_dataset.duties[shard[0]:shard[1]]
+    report_rows = get_report_rows(shard, _worker_dataset, reports, min_duration)
+    return report_rows, profiler.summary() if profiler.enabled else None
+
+def iter_report_rows_parallel(dataset, reports, min_duration, batch_size, workers, duties=None):
+    """Yield the (report, row) pairs of iter_report_rows() from shards of 'batch_size'
+    duties resolved by a pool of 'workers' processes, in the same order as serially.
+
+    The stops, trips and vehicles are inherited by the workers through fork, or sent
+    once to each worker where fork is not available, never again per shard. Duties
+    loaded in memory are sent as index ranges; streamed duties, or 'duties' selected
+    from the dataset, as lists.
+    """
+    global _worker_dataset
+
+    if duties is not None:
+        shards = iter_duty_batches(duties, batch_size)
+    elif isinstance(dataset.duties, Sequence):
+        count = len(dataset.duties)
+        shards = ((start, min(start + batch_size, count)) for start in range(0, count, batch_size))
+    else:
+        shards = iter_duty_batches(dataset.duties, batch_size)
+    tasks = ((shard, tuple(reports), min_duration) for shard in shards)
+
+    # Records of a cached dataset built here once, not again in every worker
+    if isinstance(dataset, Dataset):
+        dataset.build()
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        _worker_dataset = dataset
+        pool = context.Pool(workers)
+    else:
+        context = multiprocessing.get_context()
+        pool = context.Pool(workers, initializer=_init_report_worker,
+                            initargs=(dataset, profiler.enabled))
+
+    try:
+        # imap keeps the shards in order
+        for report_rows, summary in pool.imap(_report_rows_worker, tasks):
+            if summary:
+                profiler.merge(summary)
+            yield from report_rows
+    finally:
+        pool.terminate()
+        _worker_dataset = None
+
+def iter_report_rows(dataset, reports=REPORTS, min_duration=15, batch_size=1024, workers=1,
+                     duty_filter=None):
+    """Yield (report, row) pairs of the requested reports as the duties are resolved.
+    Every duty is resolved once for all the reports. Duties are held 'batch_size'
+    at a time so that the breaks of a whole batch are detected in one vectorized pass.
+    With 'workers' above 1 the batches are resolved in parallel processes.
+    With 'duty_filter' the duties it does not select are skipped before being resolved.
+    """
+    unknown = set(reports) - set(REPORTS)
+    if unknown:
+        raise ValueError(f"Unknown reports: {sorted(unknown)}")
+
+    if isinstance(dataset, DatasetStore):
+        # Batches read from the store, each with the records its duties reference
+        for duties, batch_dataset in dataset.iter_batches(batch_size, duty_filter):
+            yield from get_report_rows(duties, batch_dataset, reports, min_duration)
+        return
+
+    duties = dataset.duties
+    if duty_filter:
+        duties = duty_filter.filter(duties, dataset)
+
+    if workers > 1:
+        yield from iter_report_rows_parallel(dataset, reports, min_duration, batch_size, workers,
+                                             duties if duty_filter else None)
+        return
+
+    # Run all duties in the dataset
+    for batch in iter_duty_batches(duties, batch_size):
+        yield from get_report_rows(batch, dataset, reports, min_duration)
+
+def build_reports(dataset, reports=REPORTS, min_duration=15, stream=False, workers=1,
+                  duty_filter=None):
+    """Return the rows of the requested reports as {report: [rows]}.
+    The dataset is loaded once and every duty is resolved once for all the reports.
+    """
+    if not isinstance(dataset, (Dataset, DatasetStore)):
+        dataset = load_dataset(dataset, stream, duty_filter=duty_filter)
+
+    report_rows = {report: [] for report in REPORTS if report in reports}
+    for report, row in iter_report_rows(dataset, reports, min_duration, workers=workers,
+                                        duty_filter=duty_filter):
+        report_rows[report].append(row)
+
+    return report_rows
+
+def print_report(report, rows):
+    """Print the rows of a report formatted as table"""
+    # Imported when printing tables only, it is slow to import
+    from tabulate import tabulate
+
+    with profiler.stage('render'):
+        print(REPORT_TITLES[report] + "\n")
+        print(tabulate(rows, headers="keys", stralign="right"))
+        print("\n") # empty line
+
+def print_reports(dataset_file, reports=REPORTS, min_duration=15, stream=False, workers=1,
+                  duty_filter=None):
+    """Print the requested reports, sharing a single load and duty resolution"""
+    try:
+        report_rows = build_reports(dataset_file, reports, min_duration, stream, workers,
+                                    duty_filter)
+        for report, rows in report_rows.items():
+            print_report(report, rows)
+    except Exception as e:
+        print(e.args)
+
+class ReportWriter:
+    """Base of the streaming report writers: every row is written as soon as it is
+    produced, nothing is buffered in memory.
+    """
+
+    def __init__(self, stream, report):
+        self.stream = stream
+        self.report = report
+        self.columns = REPORT_COLUMNS[report]
+
+    def write_row(self, row):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CsvWriter(ReportWriter):
+    """Write a report as CSV with a header line.
+
+    Several reports written to one stream share a single CSV document: given the
+    'columns' of get_combined_columns(), every row is tagged with the report name
+    and only the writer with 'header' writes the header line.
+    """
+
+    def __init__(self, stream, report, columns=None, header=True):
+        super().__init__(stream, report)
+        self.tagged = columns is not None
+        self.writer = csv.DictWriter(stream, columns or self.columns, lineterminator='\n')
+        if header:
+            self.writer.writeheader()
+
+    def write_row(self, row):
+        if self.tagged:
+            self.writer.writerow({"Report": self.report, **row})
+        else:
+            self.writer.writerow(row)
+
+
+def get_combined_columns(reports):
+    """Return the columns of a single CSV document holding several reports: the
+    report name, then the columns of every report in order, each once
+    """
+    columns = ["Report"]
+    for report in reports:
+        columns.extend(column for column in REPORT_COLUMNS[report] if column not in columns)
+    return columns
+
+
+class JsonLinesWriter(ReportWriter):
+    """Write a report as one JSON object per line, tagged with the report name"""
+
+    def write_row(self, row):
+        self.stream.write(json.dumps({"Report": self.report, **row}) + '\n')
+
+
+class FixedWidthWriter(ReportWriter):
+    """Write a report as a right aligned table with fixed column widths, given in
+    'widths' by column name or pre-computed by get_column_widths(). Values longer
+    than their column are written in full and shift the rest of the line.
+    """
+
+    def __init__(self, stream, report, widths=None):
+        super().__init__(stream, report)
+        widths = widths or {}
+        self.widths = [max(len(column), widths.get(column, 0)) for column in self.columns]
+
+        self.stream.write(REPORT_TITLES[report] + "\n\n")
+        self.write_line(self.columns)
+        self.write_line(['-' * width for width in self.widths])
+
+    def write_line(self, values):
+        self.stream.write('  '.join(str(value).rjust(width)
+                                    for value, width in zip(values, self.widths)) + '\n')
+
+    def write_row(self, row):
+        self.write_line('' if row[column] is None else row[column] for column in self.columns)
+
+    def close(self):
+        self.stream.write("\n\n")
+
+
+OUTPUT_FORMATS = {
+    'csv': CsvWriter,
+    'jsonl': JsonLinesWriter,
+    'fixed': FixedWidthWriter
+}
+
+def get_column_widths(dataset):
+    """Return column widths covering every value of the reports of a dataset, computed
+    from the stop names and duty IDs without resolving any duty
+    """
+    stop_name_width = max((len(stop.stop_name) for stop in dataset.stop_index.values()), default=0)
+    widths = {
+        "Start Time": 5,
+        "End Time": 5,
+        "Start Stop Description": stop_name_width,
+        "End Stop Description": stop_name_width,
+        "Break start time": 5,
+        "Break stop name": stop_name_width
+    }
+    # Streamed duties are not read ahead for their IDs, cached duties are not built
+    if isinstance(dataset.duties, DutyList):
+        widths["Duty ID"] = max(map(len, dataset.duties.duty_ids), default=0)
+    elif isinstance(dataset.duties, Sequence):
+        widths["Duty ID"] = max((len(duty.duty_id) for duty in dataset.duties), default=0)
+    return widths
+
+def write_reports(dataset, output_format, reports=REPORTS, min_duration=15, workers=1,
+                  stream=None, output_dir=None, widths=None, duty_filter=None):
+    """Write the requested reports with the writer of 'output_format' as the rows are
+    produced and return the number of rows written of each report.
+
+    With 'output_dir' each report goes to its own file, <report>.<output_format>.
+    Otherwise the reports go one after the other to 'stream' (standard output by
+    default): the first report is written directly and the others are spooled to
+    temporary files, so every duty is still resolved once. Several CSV reports on
+    one stream are written as a single CSV document with a Report column.
+    """
+    if not isinstance(dataset, (Dataset, DatasetStore)):
+        dataset = load_dataset(dataset, duty_filter=duty_filter)
+    stream = stream or sys.stdout
+    reports = tuple(report for report in REPORTS if report in reports)
+    writer_class = OUTPUT_FORMATS[output_format]
+    if writer_class is FixedWidthWriter and widths is None:
+        widths = get_column_widths(dataset)
+
+    outputs = {}
+    for number, report in enumerate(reports):
+        if output_dir is not None:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            outputs[report] = open(Path(output_dir) / f"{report}.{output_format}", 'w', newline='')
+        elif number == 0:
+            outputs[report] = stream
+        else:
+            outputs[report] = tempfile.TemporaryFile('w+', newline='')
+
+    try:
+        writers = {}
+        for number, report in enumerate(reports):
+            if writer_class is FixedWidthWriter:
+                writers[report] = writer_class(outputs[report], report, widths)
+            elif writer_class is CsvWriter and output_dir is None and len(reports) > 1:
+                writers[report] = writer_class(outputs[report], report,
+                                               get_combined_columns(reports), number == 0)
+            else:
+                writers[report] = writer_class(outputs[report], report)
+
+        row_counts = dict.fromkeys(reports, 0)
+        for report, row in iter_report_rows(dataset, reports, min_duration, workers=workers,
+                                            duty_filter=duty_filter):
+            row_counts[report] += 1
+            if profiler.enabled:
+                start = time.perf_counter()
+                writers[report].write_row(row)
+                profiler.add_time('render', time.perf_counter() - start)
+            else:
+                writers[report].write_row(row)
+
+        for report in reports:
+            writers[report].close()
+            output = outputs[report]
+            if output is not stream and output_dir is None:
+                output.seek(0)
+                shutil.copyfileobj(output, stream)
+    finally:
+        for output in outputs.values():
+            if output is not stream:
+                output.close()
+    return row_counts
+
+
+# Peak memory of loading and reporting a dataset, in bytes per byte of JSON file,
+# measured with tracemalloc on synthetic datasets (about 4.5 for the load) plus margin
+BATCH_MEMORY_FACTOR = 6
+
+def get_batch_files(pattern):
+    """Return the dataset files of a batch: the .json files of a directory, the
+    files matching a glob pattern, or a single file
+    """
+    path = Path(pattern)
+    if path.is_dir():
+        return sorted(path.glob('*.json'))
+    if path.is_file():
+        return [path]
+    return sorted(Path(file) for file in glob.glob(str(pattern)) if Path(file).is_file())
+
+def get_batch_output_files(dataset_files, output_dir, output_format):
+    """Return the output file of each dataset file of a batch. The directories of the
+    dataset files below their common parent are kept, so that files with the same
+    name in different directories do not overwrite each other.
+    """
+    dataset_files = [Path(file).resolve() for file in dataset_files]
+    if not dataset_files:
+        return []
+    common_parent = Path(os.path.commonpath([file.parent for file in dataset_files]))
+    output_files = [Path(output_dir) / file.parent.relative_to(common_parent)
+                    / f"{file.stem}.{output_format}" for file in dataset_files]
+
+    seen = {Path(output_dir) / "summary.csv": None}
+    for dataset_file, output_file in zip(dataset_files, output_files):
+        if output_file in seen:
+            other = seen[output_file] or "the batch summary"
+            raise ValueError(f"Output file {output_file} of {dataset_file} collides with "
+                             f"the output of {other}")
+        seen[output_file] = dataset_file
+    return output_files
+
+def prefetch_file(dataset_file):
+    """Ask the OS to start reading a file in the background, where supported"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(dataset_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+_batch_started = None
+
+def _init_batch_worker(started, profile):
+    """Keep the queue a batch worker reports the files it starts to, and profile
+    the files if the batch is profiled
+    """
+    global _batch_started
+    _batch_started = started
+    if profile:
+        profiler.enable()
+
+def _batch_worker(task):
+    """Write the reports of one dataset file in a batch worker process and return
+    its summary, with the error instead of the row counts if it failed or is not
+    valid, and with the profiler summary of the file when profiling
+    """
+    (dataset_file, output_file, output_format, reports, min_duration, cache_dir,
+     sample_rate) = task
+    if _batch_started is not None:
+        _batch_started.put((str(dataset_file), os.getpid()))
+    summary = {"file": str(dataset_file), "output": str(output_file), "duties": None,
+               "rows": None, "seconds": None, "error": None}
+    profiler.reset()
+    start = time.perf_counter()
+    try:
+        dataset = load_dataset(dataset_file, cache_dir=cache_dir, sample_rate=sample_rate)
+        if sample_rate and dataset.validation and not dataset.validation.ok:
+            raise ValueError(f"{dataset.validation.violation_count} validation violations, "
+                             f"first: {dataset.validation.violations[0]['message']}")
+        # The pool is started before any file is loaded, so a dataset is never
+        # shared through fork: it is built in full here, in the one worker using it
+        dataset.build()
+        with open(output_file, 'w', newline='') as f:
+            row_counts = write_reports(dataset, output_format, reports, min_duration, stream=f)
+        summary["duties"] = len(dataset.duties)
+        summary["rows"] = sum(row_counts.values())
+    except Exception as e:
+        summary["error"] = str(e.args)
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    if profiler.enabled:
+        summary["profile"] = profiler.summary()
+    return summary
+
+def batch_reports(dataset_files, output_dir, output_format='jsonl', reports=REPORTS,
+                  min_duration=15, workers=None, memory_budget=None, cache_dir=None,
+                  sample_rate=None):
+    """Write the reports of many dataset files, one output file per dataset in
+    'output_dir', with a pool of 'workers' processes. Return the summary of each file.
+
+    The processes are started once for the whole batch. Files are started in order
+    while the estimated memory of the files in progress stays under 'memory_budget'
+    bytes; a file over the budget on its own is processed alone. The next file is
+    prefetched while the others are processed.
+
+    Output files are named after the dataset files, in the directories of the
+    dataset files below their common parent; a ValueError is raised if two dataset
+    files would still share an output file. A file whose worker process dies, e.g.
+    killed when out of memory, is reported with an error and the batch goes on.
+
+    With 'sample_rate' each file is validated first, as by load_dataset(), and a
+    file with violations is reported with an error instead of its reports. When the
+    profiler is enabled the profile of every file is merged into it.
+    """
+    workers = workers or os.cpu_count()
+    output_dir = Path(output_dir)
+    dataset_files = [Path(file) for file in dataset_files]
+    output_files = dict(zip(dataset_files,
+                            get_batch_output_files(dataset_files, output_dir, output_format)))
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pending = deque(dataset_files)
+    summaries = {}
+    finished = queue.Queue()
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    # Workers report the file they start and their process ID, to detect a dead worker
+    started = context.SimpleQueue()
+    pool = context.Pool(min(workers, len(pending)) or 1, initializer=_init_batch_worker,
+                        initargs=(started, profiler.enabled))
+
+    def failed(dataset_file, error):
+        return {"file": str(dataset_file), "output": str(output_files[dataset_file]),
+                "duties": None, "rows": None, "seconds": None, "error": error}
+
+    try:
+        running = {}
+        worker_ids = {}
+        memory_in_use = 0
+        while pending or running:
+            while pending and len(running) < workers:
+                dataset_file = pending[0]
+                memory = dataset_file.stat().st_size * BATCH_MEMORY_FACTOR
+                if running and memory_budget and memory_in_use + memory > memory_budget:
+                    break
+                pending.popleft()
+                if pending:
+                    prefetch_file(pending[0])
+
+                output_file = output_files[dataset_file]
+                output_file.parent.mkdir(parents=True, exist_ok=True)
+                task = (dataset_file, output_file, output_format, reports, min_duration,
+                        cache_dir, sample_rate)
+                running[dataset_file] = memory
+                memory_in_use += memory
+                pool.apply_async(_batch_worker, (task,), callback=finished.put,
+                                 error_callback=lambda e, file=dataset_file:
+                                     finished.put(failed(file, str(e.args))))
+
+            try:
+                summary = finished.get(timeout=1)
+            except queue.Empty:
+                while not started.empty():
+                    file, worker_id = started.get()
+                    worker_ids[Path(file)] = worker_id
+                alive = {process.pid for process in multiprocessing.active_children()}
+                dead = [file for file in running
+                        if file in worker_ids and worker_ids[file] not in alive]
+                for dataset_file in dead:
+                    memory_in_use -= running.pop(dataset_file)
+                    summaries[dataset_file] = failed(dataset_file, "worker process died")
+                continue
+
+            profile = summary.pop("profile", None)
+            if profile:
+                profiler.merge(profile)
+            dataset_file = Path(summary["file"])
+            if dataset_file in running:
+                memory_in_use -= running.pop(dataset_file)
+                summaries[dataset_file] = summary
+    finally:
+        pool.terminate()
+
+    # Summaries in the order of the files given
+    return [summaries[Path(file)] for file in dataset_files]
+
+def write_batch_summary(summaries, output_dir):
+    """Write the summaries of a batch to summary.csv in 'output_dir' and print them"""
+    columns = ["file", "output", "duties", "rows", "seconds", "error"]
+    with open(Path(output_dir) / "summary.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    from tabulate import tabulate
+
+    print("--- BATCH SUMMARY ---\n")
+    print(tabulate(summaries, headers="keys", stralign="right"))
+    print("\n") # empty line
+
+
+class IncrementalReports:
+    """Report rows kept per duty, recomputed only for the duties affected by a change.
+
+    Every duty is resolved once on creation. update() compares a new Dataset with
+    the current one and recomputes the rows of the duties that were added or
+    changed, or that reference a vehicle event, trip or stop that changed.
+    """
+
+    def __init__(self, dataset, reports=REPORTS, min_duration=15):
+        self.reports = tuple(report for report in REPORTS if report in reports)
+        self.min_duration = min_duration
+        self.dataset = Dataset()
+        self.duties = {}
+        # Report rows of each duty, {duty_id: [(report, row)]}
+        self.duty_rows = {}
+        # Duties referencing each vehicle event key, trip_id and stop_id
+        self.references = {}
+        self.update(dataset)
+
+    def get_duty_references(self, duty, dataset):
+        """Return the vehicle event keys, trip_ids and stop_ids the rows of a duty depend on"""
+        references = set()
+        for duty_event in duty.duty_events:
+            references.add(('stop', duty_event.destination_stop_id))
+            if duty_event.duty_event_type is DutyEventType.vehicle_event:
+                key = (duty_event.vehicle_id, duty_event.vehicle_event_sequence)
+                references.add(('vehicle_event', key))
+                vehicle_event = dataset.vehicle_event_index.get(key)
+                if vehicle_event is None:
+                    continue
+                references.add(('stop', vehicle_event.destination_stop_id))
+                if vehicle_event.trip_id is not None:
+                    references.add(('trip', vehicle_event.trip_id))
+                    trip = dataset.trip_index.get(vehicle_event.trip_id)
+                    if trip is not None:
+                        references.add(('stop', trip.origin_stop_id))
+                        references.add(('stop', trip.destination_stop_id))
+        return references
+
+    def add_references(self, duty_id, references):
+        for reference in references:
+            self.references.setdefault(reference, set()).add(duty_id)
+
+    def remove_references(self, duty_id, references):
+        for reference in references:
+            duty_ids = self.references.get(reference)
+            if duty_ids:
+                duty_ids.discard(duty_id)
+
+    def get_changed_references(self, dataset):
+        """Return the vehicle event keys, trip_ids and stop_ids whose records differ"""
+        changed = set()
+        for kind, old_index, new_index in (
+                ('vehicle_event', self.dataset.vehicle_event_index, dataset.vehicle_event_index),
+                ('trip', self.dataset.trip_index, dataset.trip_index),
+                ('stop', self.dataset.stop_index, dataset.stop_index)):
+            for key in old_index.keys() | new_index.keys():
+                if old_index.get(key) != new_index.get(key):
+                    changed.add((kind, key))
+        return changed
+
+    def update(self, dataset):
+        """Switch to a new Dataset and recompute the rows of the affected duties.
+        Return the (added, changed, removed) duty_ids.
+        """
+        duties = {duty.duty_id: duty for duty in dataset.duties}
+
+        added = duties.keys() - self.duties.keys()
+        removed = self.duties.keys() - duties.keys()
+        changed = {duty_id for duty_id in duties.keys() & self.duties.keys()
+                   if duties[duty_id] != self.duties[duty_id]}
+
+        # Duties depending on a changed vehicle event, trip or stop
+        for reference in self.get_changed_references(dataset):
+            changed |= self.references.get(reference, set()) - removed
+
+        for duty_id in removed | changed:
+            old_duty = self.duties[duty_id]
+            self.remove_references(duty_id, self.get_duty_references(old_duty, self.dataset))
+            del self.duty_rows[duty_id]
+
+        for duty_id in added | changed:
+            duty = duties[duty_id]
+            self.add_references(duty_id, self.get_duty_references(duty, dataset))
+            self.duty_rows[duty_id] = get_report_rows([duty], dataset, self.reports,
+                                                      self.min_duration)
+
+        self.dataset = dataset
+        self.duties = duties
+        return added, changed, removed
+
+    def build_reports(self):
+        """Return the rows of the reports as {report: [rows]}, in dataset duty order"""
+        report_rows = {report: [] for report in self.reports}
+        for duty_id in self.duties:
+            for report, row in self.duty_rows[duty_id]:
+                report_rows[report].append(row)
+        return report_rows
+
+
+def get_file_signature(dataset_file):
+    """Return the size and mtime of a file, to notice when it is rewritten"""
+    stat = os.stat(dataset_file)
+    return stat.st_size, stat.st_mtime_ns
+
+def refresh_reports(dataset_file, signature, incremental):
+    """Update 'incremental' from the dataset file if it was rewritten since 'signature'.
+    Return the new signature and the (added, changed, removed) duty_ids, None if the
+    file is unchanged. Raises OSError or ValueError if the file is missing or partially
+    written, the reports then left as they were and the file read again on the next call.
+    """
+    new_signature = get_file_signature(dataset_file)
+    if new_signature == signature:
+        return signature, None
+    return new_signature, incremental.update(load_dataset(dataset_file))
+
+def watch_reports(dataset_file, reports=REPORTS, min_duration=15, interval=0.5, dataset=None):
+    """Print the reports, then watch the dataset file and print them again whenever it
+    is rewritten, recomputing only the duties affected by the change. Runs until interrupted.
+    """
+    signature = get_file_signature(dataset_file)
+    if dataset is None:
+        dataset = load_dataset(dataset_file)
+    incremental = IncrementalReports(dataset, reports, min_duration)
+
+    for report, rows in incremental.build_reports().items():
+        print_report(report, rows)
+
+    print(f"--- WATCHING {dataset_file} ---\n")
+    try:
+        while True:
+            time.sleep(interval)
+            start = time.perf_counter()
+            try:
+                signature, changes = refresh_reports(dataset_file, signature, incremental)
+            except Exception as e:
+                # File missing or partially written, read again on the next poll
+                print(e.args)
+                continue
+            if changes is None:
+                continue
+            added, changed, removed = changes
+            elapsed = (time.perf_counter() - start) * 1000
+
+            print(f"--- DATASET CHANGED: {len(added)} added, {len(changed)} changed, "
+                  f"{len(removed)} removed duties, refreshed in {elapsed:.0f} ms ---\n")
+            for report, rows in incremental.build_reports().items():
+                print_report(report, rows)
+    except KeyboardInterrupt:
+        pass
+
+class QueryService:
+    """Per-duty queries on a dataset kept in memory, for long-running processes.
+    The resolved timelines of the last 'cache_size' duties queried are kept in an
+    LRU cache. Safe for concurrent readers: the dataset, its duty index and its
+    cache are swapped together by reload(), queries in progress finish on the
+    dataset they started with.
+    """
+
+    def __init__(self, dataset_file, cache_size=1024, cache_dir=None, dataset=None):
+        self.dataset_file = dataset_file
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.state = self.get_state(dataset or load_dataset(dataset_file, cache_dir=cache_dir))
+
+    @staticmethod
+    def get_state(dataset):
+        """Return the (dataset, {duty_id: duty}, timeline cache) of a dataset"""
+        return dataset, {duty.duty_id: duty for duty in dataset.duties}, OrderedDict()
+
+    def reload(self):
+        """Load the dataset file again and swap it in, return the number of duties"""
+        with self.reload_lock:
+            state = self.get_state(load_dataset(self.dataset_file, cache_dir=self.cache_dir))
+            self.state = state
+        return len(state[1])
+
+    def get_timeline(self, duty_id):
+        """Return the resolved timeline of a duty, None if the duty does not exist"""
+        dataset, duties, cache = self.state
+        with self.lock:
+            timeline = cache.get(duty_id)
+            if timeline is not None:
+                cache.move_to_end(duty_id)
+                self.hits += 1
+                return timeline
+
+        duty = duties.get(duty_id)
+        if duty is None:
+            return None
+        timeline = resolve_duty(duty, dataset)
+
+        with self.lock:
+            self.misses += 1
+            cache[duty_id] = timeline
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return timeline
+
+    def query_duty(self, duty_id, min_duration=15):
+        """Return the times, stops and breaks over 'min_duration' minutes of a duty,
+        None if the duty does not exist
+        """
+        timeline = self.get_timeline(duty_id)
+        if timeline is None:
+            return None
+
+        end_times = timeline['event_end_times']
+        breaks = find_breaks([0] * len(end_times), end_times, timeline['event_start_times'],
+                             min_duration)
+        return {
+            "duty_id": timeline['duty_id'],
+            "start_time": format_time(timeline['start_time']),
+            "end_time": format_time(timeline['end_time']),
+            "start_stop": timeline['start_stop'],
+            "end_stop": timeline['end_stop'],
+            "breaks": [{
+                "start_time": format_time(end_times[index]),
+                "duration": duration,
+                "stop_name": timeline['event_stop_names'][index]
+            } for index, duration in breaks]
+        }
+
+    def get_stats(self):
+        dataset, duties, cache = self.state
+        return {"dataset_file": str(self.dataset_file), "duties": len(duties),
+                "cached_timelines": len(cache), "cache_size": self.cache_size,
+                "cache_hits": self.hits, "cache_misses": self.misses}
+
+def get_query_request_handler():
+    """Return the HTTP request handler of serve(), defined here so that http.server
+    is imported only when serving
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class QueryRequestHandler(BaseHTTPRequestHandler):
+        """JSON HTTP interface of a QueryService:
+            GET /duties/<duty_id>?min_duration=15
+            GET /stats
+            POST /reload
+        """
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            service = self.server.service
+            url = urlsplit(self.path)
+            path = url.path.rstrip('/')
+
+            if path == '/stats':
+                return self.send_json(200, service.get_stats())
+
+            if path.startswith('/duties/'):
+                duty_id = unquote(path[len('/duties/'):])
+                try:
+                    min_duration = int(parse_qs(url.query).get('min_duration', ['15'])[0])
+                except ValueError:
+                    return self.send_json(400, {"error": "min_duration must be an integer"})
+
+                result = service.query_duty(duty_id, min_duration)
+                if result is None:
+                    return self.send_json(404, {"error": f"Duty {duty_id} not found"})
+                return self.send_json(200, result)
+
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+        def do_POST(self):
+            if urlsplit(self.path).path.rstrip('/') != '/reload':
+                return self.send_json(404, {"error": f"Unknown path {self.path}"})
+            try:
+                duty_count = self.server.service.reload()
+            except Exception as e:
+                # The previous dataset stays in service
+                return self.send_json(500, {"error": str(e.args)})
+            self.send_json(200, {"reloaded": True, "duties": duty_count})
+
+        def log_message(self, format, *args):
+            if self.server.verbose:
+                super().log_message(format, *args)
+
+    return QueryRequestHandler
+
+def get_query_server(dataset_file, host='127.0.0.1', port=8080, cache_size=1024,
+                     cache_dir=None, dataset=None, verbose=False):
+    """Return the HTTP server of serve(), bound but not serving yet. Port 0 binds
+    a free port, read back from server.server_address.
+    """
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), get_query_request_handler())
+    server.service = QueryService(dataset_file, cache_size, cache_dir, dataset)
+    server.verbose = verbose
+    return server
+
+def serve(dataset_file, host='127.0.0.1', port=8080, cache_size=1024, cache_dir=None,
+          dataset=None, verbose=False):
+    """Answer per-duty queries over HTTP until interrupted, see get_query_request_handler()"""
+    server = get_query_server(dataset_file, host, port, cache_size, cache_dir, dataset, verbose)
+
+    print(f"--- SERVING {dataset_file} ON http://{host}:{server.server_address[1]} ---\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class IntervalIndex:
+    """Static index of [start, end) intervals in integer minutes, each with an item.
+
+    The intervals are held in a centered interval tree. Each node keeps the
+    intervals containing its center, the median start of its intervals, sorted
+    by start and by end; the intervals ending before the center go to the left
+    subtree and those starting after it to the right one. A query walks one path
+    down the tree, or both sides where it spans a center, and takes the
+    overlapping intervals of each node with a binary search: logarithmic plus the
+    intervals found, however long the longest interval.
+    """
+
+    def __init__(self, intervals=()):
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.starts = array('q', (interval[0] for interval in intervals))
+        self.ends = array('q', (interval[1] for interval in intervals))
+        self.items = [interval[2] for interval in intervals]
+        # Nodes as parallel lists, the intervals given by position in self.items:
+        # (positions by start, their starts) and (positions by end descending,
+        # their ends negated) of the intervals containing the center of each node
+        self.centers = []
+        self.by_start = []
+        self.by_end = []
+        self.children = []
+        if self.items:
+            self.add_node(list(range(len(self.items))))
+
+    def add_node(self, positions):
+        """Add the subtree of the intervals at 'positions', sorted by start, and
+        return the number of its root node
+        """
+        starts, ends = self.starts, self.ends
+        center = starts[positions[len(positions) // 2]]
+        node = len(self.centers)
+        here = [position for position in positions if starts[position] <= center <= ends[position]]
+        by_end = sorted(here, key=ends.__getitem__, reverse=True)
+        self.centers.append(center)
+        self.by_start.append((here, array('q', (starts[position] for position in here))))
+        self.by_end.append((by_end, array('q', (-ends[position] for position in by_end))))
+        self.children.append(None)
+        left = [position for position in positions if ends[position] < center]
+        right = [position for position in positions if starts[position] > center]
+        self.children[node] = (self.add_node(left) if left else None,
+                               self.add_node(right) if right else None)
+        return node
+
+    def __len__(self):
+        return len(self.items)
+
+    def overlapping(self, start, end):
+        """Return the items of the intervals overlapping [start, end), by start"""
+        found = []
+        nodes = [0] if self.items else []
+        while nodes:
+            node = nodes.pop()
+            center = self.centers[node]
+            left, right = self.children[node]
+            if end <= center:
+                # Every interval here ends at or after the center, past 'start'
+                positions, node_starts = self.by_start[node]
+                found.extend(positions[:bisect_left(node_starts, end)])
+                right = None
+            elif start >= center:
+                # Every interval here starts at or before the center, before 'end'
+                positions, node_ends = self.by_end[node]
+                found.extend(positions[:bisect_left(node_ends, -start)])
+                left = None
+            else:
+                found.extend(self.by_start[node][0])
+            if left is not None:
+                nodes.append(left)
+            if right is not None:
+                nodes.append(right)
+        found.sort()
+        return [self.items[position] for position in found]
+
+    def at(self, time):
+        """Return the items of the intervals containing 'time'"""
+        return self.overlapping(time, time + 1)
+
+def iter_breaks(dataset, min_duration=15, batch_size=1024):
+    """Yield every break over 'min_duration' minutes as a dict with the duty_id,
+    the stop name, and start, end and duration in integer minutes
+    """
+    for duties in iter_duty_batches(dataset.duties, batch_size):
+        timelines = [resolve_duty(duty, dataset) for duty in duties]
+        for timeline, breaks in zip(timelines, detect_breaks(timelines, min_duration)):
+            for index, duration in breaks:
+                start = timeline['event_end_times'][index]
+                yield {"duty_id": timeline['duty_id'],
+                       "stop_name": timeline['event_stop_names'][index],
+                       "start": start, "end": start + duration, "duration": duration}
+
+class BreakIndex:
+    """Breaks of a dataset indexed by time, overall and per stop, for time-window
+    and point-in-time queries such as the duties on break at a stop between
+    10:00 and 11:00.
+    """
+
+    def __init__(self, dataset, min_duration=15):
+        self.dataset = dataset
+        self.min_duration = min_duration
+        breaks = list(iter_breaks(dataset, min_duration))
+        self.index = IntervalIndex((item['start'], item['end'], item) for item in breaks)
+
+        stop_breaks = {}
+        for item in breaks:
+            stop_breaks.setdefault(item['stop_name'], []).append(item)
+        self.stop_index = {stop_name: IntervalIndex((item['start'], item['end'], item)
+                                                    for item in items)
+                           for stop_name, items in stop_breaks.items()}
+
+    def get_stop_index(self, stop):
+        """Return the IntervalIndex of a stop given by ID or name, empty if no breaks"""
+        stop_name = self.dataset.get_stop_name(stop) if stop in self.dataset.stop_index else stop
+        return self.stop_index.get(stop_name, IntervalIndex())
 
+    def overlapping(self, start, end, stop=None):
+        """Return the breaks overlapping [start, end), at a stop if given"""
+        index = self.index if stop is None else self.get_stop_index(stop)
+        return index.overlapping(start, end)
+
+    def at(self, time, stop=None):
+        """Return the breaks in progress at 'time', at a stop if given"""
+        index = self.index if stop is None else self.get_stop_index(stop)
+        return index.at(time)
+
+def parse_query_time(value):
+    """Return a "HH:MM" or "D.HH:MM" time as integer minutes"""
     try:
-        # Open JSON dataset file
-        with open(dataset_file) as f:
-            data = json.load(f)
-
-            # Run all duties in the dataset
-            for duty in data['duties']:
-                start_time = ''
-                end_time = ''
-
-                first_duty_event = duty['duty_events'][0]
-                last_duty_event = duty['duty_events'][-1]
-
-                first_duty_keys = first_duty_event.keys()
-
-                # Find Start Time of the duty (consider all events)
-                if 'start_time' in first_duty_keys:
-                    start_time = first_duty_event['start_time']
-                elif 'vehicle_id' in first_duty_keys and 'vehicle_event_sequence' in first_duty_keys:
-                    vehicle_event = get_vehicle_event(data['vehicles'],
-                                                    first_duty_event['vehicle_id'],
-                                                    str(first_duty_event['vehicle_event_sequence']))
-                    if vehicle_event:
-                        start_time = vehicle_event['start_time']
-
-                last_duty_keys = last_duty_event.keys()
-
-                # Find End Time of the duty (consider all events)
-                if 'end_time' in last_duty_keys:
-                    end_time = last_duty_event['end_time']
-                elif 'vehicle_id' in last_duty_keys and 'vehicle_event_sequence' in last_duty_keys:
-                    vehicle_event = get_vehicle_event(data['vehicles'],
-                                                    last_duty_event['vehicle_id'],
-                                                    str(last_duty_event['vehicle_event_sequence']))
-                    if vehicle_event:
-                        end_time = vehicle_event['end_time']
-
-                duty_report.append({
-                    "Duty ID": duty['duty_id'],
-                    "Start Time": start_time[2:],
-                    "End Time": end_time[2:]
-                })
-        
-        # Print final report formatted as table
-        print("--- DUTY TIMES REPORT ---\n")
-        print(tabulate(duty_report, headers="keys", stralign="right"))
-        print("\n") # empty line
-    except Exception as e:
-        print(e.args)
+        return parse_time(value if '.' in value else '0.' + value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value!r}, expected HH:MM or D.HH:MM")
 
-def print_stop_names_report(dataset_file):
-    """Print report with Duty ID, Start Time, End Time, Start stop description, 
-    and End stop description for duties in dataset.
+def get_break_query_rows(breaks, nearest_depots=None):
+    """Return the rows of the breaks found by a BreakIndex query, with the nearest
+    depot to the break stop from get_nearest_depots() if given
     """
-    # List of Duty Reports 
-    # {Duty ID, Start Time, End Time, Start stop description, End stop description}
-    duty_report = []
+    rows = []
+    for item in breaks:
+        row = {
+            "Duty ID": item['duty_id'],
+            "Break start time": format_time(item['start']),
+            "Break end time": format_time(item['end']),
+            "Break duration": item['duration'],
+            "Break stop name": item['stop_name']
+        }
+        if nearest_depots is not None:
+            nearest = nearest_depots.get(item['stop_name'])
+            row["Nearest depot"] = nearest[1].stop_name if nearest else None
+            row["Depot distance (m)"] = round(nearest[0]) if nearest else None
+        rows.append(row)
+    return rows
 
-    try:
-        # Open JSON dataset file
-        with open(dataset_file) as f:
-            data = json.load(f)
-
-            # Run all duties in the dataset
-            for duty in data['duties']:
-                start_time = ''
-                end_time = ''
-                start_stop = ''
-                end_stop = ''
-
-                first_duty_event = duty['duty_events'][0]
-                last_duty_event = duty['duty_events'][-1]
-
-                first_duty_keys = first_duty_event.keys()
-
-                # Find Start Time of the duty (consider all events)
-                if 'start_time' in first_duty_keys:
-                    start_time = first_duty_event['start_time']
-                elif 'vehicle_id' in first_duty_keys and 'vehicle_event_sequence' in first_duty_keys:
-                    vehicle_event = get_vehicle_event(data['vehicles'],
-                                                    first_duty_event['vehicle_id'],
-                                                    str(first_duty_event['vehicle_event_sequence']))
-                    if vehicle_event:
-                        start_time = vehicle_event['start_time']
-
-                last_duty_keys = last_duty_event.keys()
-
-                # Find End Time of the duty (consider all events)
-                if 'end_time' in last_duty_keys:
-                    end_time = last_duty_event['end_time']
-                elif 'vehicle_id' in last_duty_keys and 'vehicle_event_sequence' in last_duty_keys:
-                    vehicle_event = get_vehicle_event(data['vehicles'],
-                                                    last_duty_event['vehicle_id'],
-                                                    str(last_duty_event['vehicle_event_sequence']))
-                    if vehicle_event:
-                        end_time = vehicle_event['end_time']
-
-                # Find Start Stop Description of first service trip
-                first_service_trip = get_first_service_trip(
-                    duty['duty_events'],
-                    data['vehicles']
-                )
-
-                start_stop = get_start_stop(
-                    first_service_trip,
-                    data['trips'],
-                    data['stops']
-                )
-
-                # Find End Stop Description of last service trip
-                last_service_trip = get_last_service_trip(
-                    duty['duty_events'],
-                    data['vehicles']
-                )
-
-                end_stop = get_end_stop(
-                    last_service_trip,
-                    data['trips'],
-                    data['stops']
-                )
-
-                duty_report.append({
-                    "Duty ID": duty['duty_id'],
-                    "Start Time": start_time[2:],
-                    "End Time": end_time[2:],
-                    "Start Stop Description": start_stop,
-                    "End Stop Description": end_stop
-                })
-        
-        # Print final report formatted as table
-        print("--- DUTY TIMES AND STOPS REPORT ---\n")
-        print(tabulate(duty_report, headers="keys", stralign="right"))
-        print("\n") # empty line
-    except Exception as e:
-        print(e.args)
+EARTH_RADIUS = 6371000.0
 
-def print_breaks_report(dataset_file, min_duration):
-    """Print report with Duty ID, Start Time, End Time, Start stop description, 
-    End stop description, Break start time, Break duration (min), and Break stop name
-    for every break over 'min_duration' minutes of all duties in dataset.
+def get_distance(latitude, longitude, other_latitude, other_longitude):
+    """Return the great-circle distance in meters between two points in degrees"""
+    phi, other_phi = math.radians(latitude), math.radians(other_latitude)
+    half_dphi = (other_phi - phi) / 2
+    half_dlambda = math.radians(other_longitude - longitude) / 2
+    a = math.sin(half_dphi) ** 2 + math.cos(phi) * math.cos(other_phi) * math.sin(half_dlambda) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+class StopGrid:
+    """Spatial index of the stops with coordinates, hashed into square cells of
+    'cell_size' meters so a proximity query only checks the cells around the
+    point instead of every stop.
+
+    Coordinates are projected on the plane tangent at the mean latitude of the
+    stops, which holds over the extent of a bus network. Distances are then
+    measured exactly on the sphere.
+    """
+
+    def __init__(self, stops, cell_size=500):
+        self.cell_size = cell_size
+        self.stops = [stop for stop in stops
+                      if stop.latitude is not None and stop.longitude is not None]
+        latitude = (sum(stop.latitude for stop in self.stops) / len(self.stops)
+                    if self.stops else 0)
+        self.meters_per_degree = math.pi * EARTH_RADIUS / 180
+        self.longitude_scale = math.cos(math.radians(latitude))
+        # {(x, y) cell: [stops]}
+        self.cells = {}
+        for stop in self.stops:
+            self.cells.setdefault(self.get_cell(stop.latitude, stop.longitude), []).append(stop)
+        # Bounding box of the cells, (min x, min y, max x, max y)
+        self.bounds = (min((x for x, _ in self.cells), default=0),
+                       min((y for _, y in self.cells), default=0),
+                       max((x for x, _ in self.cells), default=-1),
+                       max((y for _, y in self.cells), default=-1))
+
+    def __len__(self):
+        return len(self.stops)
+
+    def get_cell(self, latitude, longitude):
+        x = longitude * self.longitude_scale * self.meters_per_degree
+        y = latitude * self.meters_per_degree
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def iter_ring(self, cell, ring):
+        """Yield the stops of the cells at Chebyshev distance 'ring' from 'cell',
+        only the part of the ring inside the bounding box of the grid is visited
+        """
+        cells = self.cells
+        if ring == 0:
+            yield from cells.get(cell, ())
+            return
+        min_x, min_y, max_x, max_y = self.bounds
+        left, right = cell[0] - ring, cell[0] + ring
+        bottom, top = cell[1] - ring, cell[1] + ring
+        # Bottom and top rows, then left and right columns without the corners
+        rows = [row for row in (bottom, top) if min_y <= row <= max_y]
+        for x in range(max(left, min_x), min(right, max_x) + 1):
+            for y in rows:
+                yield from cells.get((x, y), ())
+        columns = [column for column in (left, right) if min_x <= column <= max_x]
+        for y in range(max(bottom + 1, min_y), min(top - 1, max_y) + 1):
+            for x in columns:
+                yield from cells.get((x, y), ())
+
+    def within(self, latitude, longitude, radius):
+        """Return (distance, stop) of the stops within 'radius' meters, nearest first"""
+        cell = self.get_cell(latitude, longitude)
+        # One more ring than the radius covers, for the projection error
+        rings = int(radius // self.cell_size) + 2
+        found = []
+        for ring in range(rings):
+            for stop in self.iter_ring(cell, ring):
+                distance = get_distance(latitude, longitude, stop.latitude, stop.longitude)
+                if distance <= radius:
+                    found.append((distance, stop))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def nearest(self, latitude, longitude):
+        """Return (distance, stop) of the nearest stop, None if the grid is empty.
+        Rings of cells are searched outwards until the next one is farther than
+        the nearest stop found.
+        """
+        if not self.cells:
+            return None
+        cell = self.get_cell(latitude, longitude)
+        # Past this ring every cell has been searched
+        min_x, min_y, max_x, max_y = self.bounds
+        last_ring = max(cell[0] - min_x, max_x - cell[0], cell[1] - min_y, max_y - cell[1])
+        best = None
+        for ring in range(last_ring + 1):
+            if 8 * ring > len(self.cells):
+                # Fewer cells in the grid than in the ring, as with a few depots:
+                # the cells of this ring and past it are searched in one pass
+                stops = (stop for (x, y), stops in self.cells.items()
+                         if max(abs(x - cell[0]), abs(y - cell[1])) >= ring for stop in stops)
+            else:
+                stops = self.iter_ring(cell, ring)
+            for stop in stops:
+                distance = get_distance(latitude, longitude, stop.latitude, stop.longitude)
+                if best is None or distance < best[0]:
+                    best = (distance, stop)
+            # Stops of the next rings are at least 'ring' cells away
+            if 8 * ring > len(self.cells) or (best is not None
+                                              and best[0] < (ring - 1) * self.cell_size):
+                break
+        return best
+
+    def clusters(self, radius):
+        """Return the stops grouped into clusters, stops within 'radius' meters of
+        one another joined, largest clusters first
+        """
+        parents = {stop.stop_id: stop.stop_id for stop in self.stops}
+
+        def find(stop_id):
+            while parents[stop_id] != stop_id:
+                parents[stop_id] = parents[parents[stop_id]]
+                stop_id = parents[stop_id]
+            return stop_id
+
+        for stop in self.stops:
+            for _, other in self.within(stop.latitude, stop.longitude, radius):
+                parents[find(other.stop_id)] = find(stop.stop_id)
+
+        clusters = {}
+        for stop in self.stops:
+            clusters.setdefault(find(stop.stop_id), []).append(stop)
+        return sorted(clusters.values(), key=len, reverse=True)
+
+def get_nearest_depots(dataset, stop_grid=None):
+    """Return {stop_name: (distance, depot)} of the nearest depot to each stop
+    with coordinates, searched in a StopGrid of the depots
     """
-    # List of Duty Reports 
-    # {Duty ID, Start Time, End Time, Start stop description, End stop description, 
-    # Break start time, Break duration, Break stop name}
-    duty_report = []
+    depot_grid = StopGrid(stop for stop in dataset.stop_index.values() if stop.is_depot)
+    stops = stop_grid.stops if stop_grid else StopGrid(dataset.stop_index.values()).stops
+    nearest_depots = {}
+    for stop in stops:
+        if stop.stop_name not in nearest_depots:
+            nearest_depots[stop.stop_name] = depot_grid.nearest(stop.latitude, stop.longitude)
+    return nearest_depots
 
+def parse_point(value):
+    """Return a "LATITUDE,LONGITUDE" point as (latitude, longitude) degrees"""
     try:
-        # Open JSON dataset file
-        with open(dataset_file) as f:
-            data = json.load(f)
-
-            # Run all duties in the dataset
-            for duty in data['duties']:
-                start_time = ''
-                end_time = ''
-                start_stop = ''
-                end_stop = ''
-
-                first_duty_event = duty['duty_events'][0]
-                last_duty_event = duty['duty_events'][-1]
-
-                first_duty_keys = first_duty_event.keys()
-
-                # Find Start Time of the duty (consider all events)
-                if 'start_time' in first_duty_keys:
-                    start_time = first_duty_event['start_time']
-                elif 'vehicle_id' in first_duty_keys and 'vehicle_event_sequence' in first_duty_keys:
-                    vehicle_event = get_vehicle_event(data['vehicles'],
-                                                    first_duty_event['vehicle_id'],
-                                                    str(first_duty_event['vehicle_event_sequence']))
-                    if vehicle_event:
-                        start_time = vehicle_event['start_time']
-
-                last_duty_keys = last_duty_event.keys()
-
-                # Find End Time of the duty (consider all events)
-                if 'end_time' in last_duty_keys:
-                    end_time = last_duty_event['end_time']
-                elif 'vehicle_id' in last_duty_keys and 'vehicle_event_sequence' in last_duty_keys:
-                    vehicle_event = get_vehicle_event(data['vehicles'],
-                                                    last_duty_event['vehicle_id'],
-                                                    str(last_duty_event['vehicle_event_sequence']))
-                    if vehicle_event:
-                        end_time = vehicle_event['end_time']
-
-                # Find Start Stop Description of first service trip
-                first_service_trip = get_first_service_trip(
-                    duty['duty_events'],
-                    data['vehicles']
-                )
-
-                start_stop = get_start_stop(
-                    first_service_trip,
-                    data['trips'],
-                    data['stops']
-                )
-
-                # Find End Stop Description of last service trip
-                last_service_trip = get_last_service_trip(
-                    duty['duty_events'],
-                    data['vehicles']
-                )
-
-                end_stop = get_end_stop(
-                    last_service_trip,
-                    data['trips'],
-                    data['stops']
-                )
-
-                # Get times and stops of all events from the duty_events
-                event_list = get_event_list(
-                    duty['duty_events'], data['stops'], data['vehicles'], data['trips']
-                )
-                
-                # Find breaks larger thatn 15 minutes between events
-                for count, event in enumerate(event_list[:-1]):
-                    break_duration = get_time_difference_minutes(
-                        event_list[count]['end_time'], event_list[count+1]['start_time']
-                    )
-
-                    if break_duration > min_duration:
-                        duty_report.append({
-                            "Duty ID": duty['duty_id'],
-                            "Start Time": start_time[2:],
-                            "End Time": end_time[2:],
-                            "Start Stop Description": start_stop,
-                            "End Stop Description": end_stop, 
-                            "Break start time": event_list[count]['end_time'][2:], 
-                            "Break duration": break_duration, 
-                            "Break stop name": event_list[count]['destination_stop_name']
-                        })
-        
-        # Print final report formatted as table
-        print("--- BREAKS REPORT ---\n")
-        print(tabulate(duty_report, headers="keys", stralign="right"))
-        print("\n") # empty line
-    except Exception as e:
-        print(e.args)
+        latitude, longitude = (float(part) for part in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid point: {value!r}, expected LATITUDE,LONGITUDE")
+    return latitude, longitude
+
+def get_stop_cluster_rows(dataset, radius=25):
+    """Return the rows of the stop clusters report, the stops within 'radius'
+    meters of one another, such as the two sides of the same curb
+    """
+    stop_grid = StopGrid(dataset.stop_index.values())
+    nearest_depots = get_nearest_depots(dataset, stop_grid)
+    rows = []
+    for number, stops in enumerate(stop_grid.clusters(radius), 1):
+        nearest = nearest_depots.get(stops[0].stop_name)
+        rows.append({
+            "Cluster": number,
+            "Stops": len(stops),
+            "Stop names": ", ".join(sorted({stop.stop_name for stop in stops})),
+            "Nearest depot": nearest[1].stop_name if nearest else None,
+            "Depot distance (m)": round(nearest[0]) if nearest else None
+        })
+    return rows
 
 
-def test_dataset_structure(dataset_file):
-    """Check the dataset structure based on Data Model documentation"""
-    # Open JSON dataset file
-    with open(dataset_file) as f:
-        data = json.load(f)
+class FleetAggregator:
+    """Fleet totals grouped as the duties are resolved, one batch at a time: break
+    minutes per stop, route and depot, vehicle minutes per event type and the duty
+    length distribution. Memory grows with the number of stops, routes, depots and
+    vehicles, not with the number of duties.
 
-        assert isinstance(data, dict)
+    The route of a break is the route of the last service trip before it, the
+    depot of a duty the first depot among the origins of its events.
+    """
 
-        assert 'stops' in data.keys()
-        assert 'trips' in data.keys()
-        assert 'vehicles' in data.keys()
-        assert 'duties' in data.keys()
+    def __init__(self, dataset, min_duration=15):
+        self.dataset = dataset
+        self.min_duration = min_duration
+        # {key: [breaks, minutes]} of each grouping
+        self.breaks = {'stop': {}, 'route': {}, 'depot': {}}
+        # {vehicle_id: [minutes of each VehicleEventType]}
+        self.vehicle_minutes = {}
+        # {length in whole hours: [duties, minutes]}
+        self.duty_lengths = {}
 
-        assert isinstance(data['stops'], list)
-        assert isinstance(data['trips'], list)
-        assert isinstance(data['vehicles'], list)
-        assert isinstance(data['duties'], list)
+    def add_duties(self, duties, batch_size=1024):
+        for batch in iter_duty_batches(duties, batch_size):
+            timelines = [resolve_duty(duty, self.dataset, with_stops=False) for duty in batch]
+            for duty, timeline, breaks in zip(batch, timelines,
+                                              detect_breaks(timelines, self.min_duration)):
+                self.add_duty(duty, timeline, breaks)
 
-        for stop in data['stops']:
-            assert "stop_id" in stop
-            assert "stop_name" in stop
-            assert "latitude" in stop
-            assert "longitude" in stop
-            assert "is_depot" in stop
+    def add_duty(self, duty, timeline, breaks):
+        """Add a duty, its resolved timeline and its breaks from detect_breaks()"""
+        dataset = self.dataset
+        # Route of the last service trip up to each duty event, and the depot
+        routes = []
+        route = depot = None
+        for duty_event in duty.duty_events:
+            origin_stop_id = duty_event.origin_stop_id
+            if duty_event.duty_event_type is DutyEventType.vehicle_event:
+                vehicle_event = dataset.vehicle_event_index.get(
+                    (duty_event.vehicle_id, duty_event.vehicle_event_sequence))
+                if vehicle_event is not None:
+                    origin_stop_id = self.add_vehicle_event(vehicle_event)
+                    if vehicle_event.vehicle_event_type is VehicleEventType.service_trip:
+                        trip = dataset.trip_index.get(vehicle_event.trip_id)
+                        route = trip.route_number if trip else None
+            if depot is None:
+                stop = dataset.stop_index.get(origin_stop_id)
+                if stop is not None and stop.is_depot:
+                    depot = stop.stop_name
+            routes.append(route)
 
-        for trip in data['trips']:
-            assert "trip_id" in trip
-            assert "route_number" in trip
-            assert "origin_stop_id" in trip
-            assert "destination_stop_id" in trip
-            assert "departure_time" in trip
-            assert "arrival_time" in trip
+        for index, duration in breaks:
+            for grouping, key in (('stop', timeline['event_stop_names'][index]),
+                                  ('route', routes[index]), ('depot', depot)):
+                totals = self.breaks[grouping].setdefault(key or '', [0, 0])
+                totals[0] += 1
+                totals[1] += duration
+
+        if timeline['start_time'] is not None and timeline['end_time'] is not None:
+            length = timeline['end_time'] - timeline['start_time']
+            totals = self.duty_lengths.setdefault(length // 60, [0, 0])
+            totals[0] += 1
+            totals[1] += length
+
+    def add_vehicle_event(self, vehicle_event):
+        """Add the minutes of a vehicle event to its vehicle, return its origin stop_id"""
+        origin_stop_id = vehicle_event.origin_stop_id
+        times = get_vehicle_event_times(vehicle_event, self.dataset)
+        if vehicle_event.vehicle_event_type is VehicleEventType.service_trip:
+            trip = self.dataset.trip_index.get(vehicle_event.trip_id)
+            origin_stop_id = trip.origin_stop_id if trip else None
+        if times is not None and times[0] is not None and times[1] is not None:
+            minutes = self.vehicle_minutes.setdefault(vehicle_event.vehicle_id,
+                                                      [0] * len(VehicleEventType))
+            minutes[vehicle_event.vehicle_event_type] += times[1] - times[0]
+        return origin_stop_id
+
+    def get_rows(self, aggregate):
+        """Return the rows of an aggregate report"""
+        if aggregate == 'vehicle_minutes':
+            columns = REPORT_COLUMNS[aggregate]
+            return [dict(zip(columns, (vehicle_id, *minutes, sum(minutes))))
+                    for vehicle_id, minutes in self.vehicle_minutes.items()]
+
+        if aggregate == 'duty_lengths':
+            return [{"Duty length": f"{hours}-{hours + 1} h", "Duties": duties,
+                     "Duty minutes": minutes}
+                    for hours, (duties, minutes) in sorted(self.duty_lengths.items())]
+
+        grouping = aggregate.rpartition('_')[2]
+        key_column = REPORT_COLUMNS[aggregate][0]
+        totals = sorted(self.breaks[grouping].items(), key=lambda item: -item[1][1])
+        return [{key_column: key, "Breaks": count, "Break minutes": minutes}
+                for key, (count, minutes) in totals]
+
+def build_aggregates(dataset, min_duration=15, duty_filter=None):
+    """Return the rows of the fleet aggregate reports as {aggregate: [rows]}"""
+    if not isinstance(dataset, Dataset):
+        dataset = load_dataset(dataset, duty_filter=duty_filter)
+    duties = dataset.duties
+    if duty_filter:
+        duties = duty_filter.filter(duties, dataset)
+
+    aggregator = FleetAggregator(dataset, min_duration)
+    with profiler.stage('aggregate'):
+        aggregator.add_duties(duties)
+    return {aggregate: aggregator.get_rows(aggregate) for aggregate in AGGREGATES}
+
+def write_report_rows(report_rows, output_format, stream=None, output_dir=None):
+    """Write reports built in memory, {report: [rows]} such as the aggregates from
+    build_aggregates(), with the writer of 'output_format', one after the other to
+    'stream' or each to its own file. Several CSV reports on one stream are written
+    as a single CSV document with a Report column.
+    """
+    stream = stream or sys.stdout
+    writer_class = OUTPUT_FORMATS[output_format]
+    combined = writer_class is CsvWriter and output_dir is None and len(report_rows) > 1
+    for number, (aggregate, rows) in enumerate(report_rows.items()):
+        if output_dir is not None:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            output = open(Path(output_dir) / f"{aggregate}.{output_format}", 'w', newline='')
+        else:
+            output = stream
+        try:
+            if writer_class is FixedWidthWriter:
+                # The rows are few and already built, the widths are exact
+                widths = {column: max((len(str(row[column])) for row in rows), default=0)
+                          for column in REPORT_COLUMNS[aggregate]}
+                writer = writer_class(output, aggregate, widths)
+            elif combined:
+                writer = writer_class(output, aggregate, get_combined_columns(report_rows),
+                                      number == 0)
+            else:
+                writer = writer_class(output, aggregate)
+            for row in rows:
+                writer.write_row(row)
+            writer.close()
+        finally:
+            if output is not stream:
+                output.close()
+
+
+def iter_vehicle_timelines(dataset, vehicle_ids=None):
+    """Yield (vehicle_id, events) for every vehicle, or those of 'vehicle_ids', in
+    dataset order, events as (start_time, end_time, destination_stop_id) sorted by
+    sequence, None for a service trip whose trip is not found
+    """
+    vehicles = {}
+    for (vehicle_id, sequence), vehicle_event in dataset.vehicle_event_index.items():
+        if vehicle_ids is None or vehicle_id in vehicle_ids:
+            vehicles.setdefault(vehicle_id, []).append((sequence, vehicle_event))
+
+    for vehicle_id, vehicle_events in vehicles.items():
+        # Already in order unless the file lists a vehicle's events out of sequence
+        vehicle_events.sort(key=lambda item: item[0])
+        yield vehicle_id, [get_vehicle_event_times(vehicle_event, dataset)
+                           for _, vehicle_event in vehicle_events]
+
+def iter_vehicle_layovers(events, min_duration=15, window=None):
+    """Yield (start, end, stop_id) of the layovers of a vehicle from its sorted events:
+    every gap over 'min_duration' minutes between the end of an event and the start
+    of the next one, at the destination of the first, overlapping 'window' if given
+    """
+    for event, next_event in zip(events, events[1:]):
+        if event is None or next_event is None or event[1] is None or next_event[0] is None:
+            continue
+        start, end = event[1], next_event[0]
+        if end - start <= min_duration:
+            continue
+        if window is not None and not (start < window[1] and end > window[0]):
+            continue
+        yield start, end, event[2]
+
+def get_layover_rows(vehicle_id, events, dataset, min_duration=15, window=None):
+    """Return the layover report rows of a vehicle"""
+    rows = []
+    for start, end, stop_id in iter_vehicle_layovers(events, min_duration, window):
+        stop = dataset.stop_index.get(stop_id)
+        rows.append({
+            "Vehicle ID": vehicle_id,
+            "Layover start time": format_time(start),
+            "Layover end time": format_time(end),
+            "Layover duration": end - start,
+            "Layover stop name": stop.stop_name if stop else None,
+            "At depot": "yes" if stop and stop.is_depot else "no"
+        })
+    return rows
+
+def iter_layover_rows(dataset, min_duration=15, duty_filter=None):
+    """Yield the rows of the vehicle layover report in one sweep per vehicle over its
+    sorted events, linear in the number of vehicle events. Of the duty filters, the
+    vehicle IDs and the window apply.
+    """
+    vehicle_ids = duty_filter.vehicle_ids if duty_filter else None
+    window = duty_filter.window if duty_filter else None
+    for vehicle_id, events in iter_vehicle_timelines(dataset, vehicle_ids):
+        yield from get_layover_rows(vehicle_id, events, dataset, min_duration, window)
+
+def sweep_occupancy(intervals, resolution=60):
+    """Sweep the (start, end) intervals of a stop in time order, each counted from
+    its start up to its end excluded. Return (peak, peak_start, peak_end, series),
+    the first moment of peak concurrency and the series [(time, occupancy)] of the
+    highest concurrency in each 'resolution' minutes from the first to the last bin.
+    """
+    # Ends sort before starts at the same time, back to back intervals do not overlap
+    markers = sorted([(start, 1) for start, end in intervals]
+                     + [(end, -1) for start, end in intervals])
+    peak = count = previous = 0
+    peak_start = peak_end = None
+    at_peak = False
+    series = []
+    for number, (moment, delta) in enumerate(markers):
+        count += delta
+        # The count is used once all the markers at a time are applied
+        if number + 1 < len(markers) and markers[number + 1][0] == moment:
+            continue
+        time_bin = moment - moment % resolution
+        # Bins without markers keep the count of the previous time
+        while series and series[-1][0] < time_bin:
+            series.append((series[-1][0] + resolution, previous))
+        if not series or moment == time_bin:
+            series[-1:] = [(time_bin, count)]
+        elif count > series[-1][1]:
+            series[-1] = (time_bin, count)
+        previous = count
+
+        if count > peak:
+            peak, peak_start, at_peak = count, moment, True
+        elif at_peak and count < peak:
+            peak_end, at_peak = moment, False
+    return peak, peak_start, peak_end, series
+
+def iter_stop_intervals(dataset, min_duration=15, duty_filter=None, batch_size=1024):
+    """Yield (occupants, stop_name, start, end) of the vehicle layovers and the
+    driver breaks over 'min_duration' minutes, from the resolved vehicle events
+    and duties
+    """
+    vehicle_ids = duty_filter.vehicle_ids if duty_filter else None
+    window = duty_filter.window if duty_filter else None
+    for vehicle_id, events in iter_vehicle_timelines(dataset, vehicle_ids):
+        for start, end, stop_id in iter_vehicle_layovers(events, min_duration, window):
+            stop = dataset.stop_index.get(stop_id)
+            yield 'vehicles', stop.stop_name if stop else None, start, end
+
+    duties = dataset.duties
+    if duty_filter:
+        duties = duty_filter.filter(duties, dataset)
+    for batch in iter_duty_batches(duties, batch_size):
+        timelines = [resolve_duty(duty, dataset, with_stops=True) for duty in batch]
+        for timeline, breaks in zip(timelines, detect_breaks(timelines, min_duration)):
+            for index, duration in breaks:
+                start = timeline['event_end_times'][index]
+                yield ('drivers', timeline['event_stop_names'][index], start,
+                       start + duration)
+
+def build_occupancy(dataset, min_duration=15, resolution=60, duty_filter=None):
+    """Return the rows of the occupancy reports as {report: [rows]}: the buses on
+    layover and the drivers on break at each stop, with one sweep per stop over
+    the start and end of their intervals, O(n log n) in the number of intervals
+    """
+    stops = {}
+    with profiler.stage('occupancy'):
+        for occupants, stop_name, start, end in iter_stop_intervals(dataset, min_duration,
+                                                                   duty_filter):
+            stops.setdefault((stop_name or '', occupants), []).append((start, end))
+
+        peaks = []
+        series = []
+        for (stop_name, occupants), intervals in stops.items():
+            peak, peak_start, peak_end, stop_series = sweep_occupancy(intervals, resolution)
+            peaks.append({
+                "Stop name": stop_name,
+                "Occupants": occupants,
+                "Peak occupancy": peak,
+                "Peak start time": format_time(peak_start),
+                "Peak end time": format_time(peak_end),
+                "Intervals": len(intervals)
+            })
+            series.extend({"Stop name": stop_name, "Occupants": occupants,
+                           "Time": format_time(time), "Occupancy": occupancy}
+                          for time, occupancy in stop_series)
+
+    peaks.sort(key=lambda row: -row["Peak occupancy"])
+    return {'occupancy_peaks': peaks, 'occupancy_series': series}
+
+# Structural diff of two versions of a dataset, printed by the diff subcommand
+def get_timeline_fingerprint(timeline):
+    """Return a stable hash of a resolved duty timeline: its times, stops and
+    events. Unlike hash(), the same across runs and processes.
+    """
+    key = (timeline['start_time'], timeline['end_time'], timeline['start_stop'],
+           timeline['end_stop'], timeline['event_start_times'], timeline['event_end_times'],
+           timeline['event_stop_names'])
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+def get_duty_fingerprints(dataset, duty_filter=None, batch_size=1024):
+    """Return {duty_id: (fingerprint, duty)} of the duties of a dataset, first
+    duty of an ID only
+    """
+    duties = dataset.duties
+    if duty_filter:
+        duties = duty_filter.filter(duties, dataset)
+    fingerprints = {}
+    for batch in iter_duty_batches(duties, batch_size):
+        for duty in batch:
+            if duty.duty_id not in fingerprints:
+                timeline = resolve_duty(duty, dataset)
+                fingerprints[duty.duty_id] = (get_timeline_fingerprint(timeline), duty)
+    return fingerprints
+
+def format_diff_time(minutes):
+    """Return integer minutes as a "D.HH:MM" time for the diff report, keeping the
+    day so that a time moved by whole days is a change, empty for a missing time
+    """
+    if minutes is None:
+        return ''
+    return unparse_time(minutes)
+
+def format_event(timeline, index):
+    """Return an event of a resolved timeline as "START-END STOP", None past its end"""
+    if index >= len(timeline['event_start_times']):
+        return None
+    return (f"{format_diff_time(timeline['event_start_times'][index])}-"
+            f"{format_diff_time(timeline['event_end_times'][index])} "
+            f"{timeline['event_stop_names'][index]}")
+
+def format_breaks(timeline, min_duration):
+    """Return the breaks of a resolved timeline as "START DURATION min at STOP; ..." """
+    breaks = detect_breaks([timeline], min_duration)[0]
+    return "; ".join(f"{format_diff_time(timeline['event_end_times'][index])} {duration} min "
+                     f"at {timeline['event_stop_names'][index]}" for index, duration in breaks)
+
+def get_duty_delta_rows(old_timeline, new_timeline, min_duration=15):
+    """Return the diff report rows of the fields that differ between two
+    resolved timelines of a duty, then of its events that differ
+    """
+    rows = []
+
+    def add_row(field, old, new):
+        if old != new:
+            rows.append({"Duty ID": new_timeline['duty_id'], "Change": "changed",
+                         "Field": field, "Old": old, "New": new})
+
+    add_row("Start Time", format_diff_time(old_timeline['start_time']),
+            format_diff_time(new_timeline['start_time']))
+    add_row("End Time", format_diff_time(old_timeline['end_time']),
+            format_diff_time(new_timeline['end_time']))
+    add_row("Start Stop Description", old_timeline['start_stop'], new_timeline['start_stop'])
+    add_row("End Stop Description", old_timeline['end_stop'], new_timeline['end_stop'])
+    add_row("Breaks", format_breaks(old_timeline, min_duration),
+            format_breaks(new_timeline, min_duration))
+    add_row("Events", len(old_timeline['event_start_times']),
+            len(new_timeline['event_start_times']))
+    for index in range(max(len(old_timeline['event_start_times']),
+                           len(new_timeline['event_start_times']))):
+        add_row(f"Event {index}", format_event(old_timeline, index),
+                format_event(new_timeline, index))
+    return rows
+
+def diff_datasets(old_dataset, new_dataset, min_duration=15, duty_filter=None):
+    """Return the rows of the diff report of two versions of a dataset: the duties
+    added, removed and, field by field, changed. Each duty is fingerprinted once,
+    only the changed ones are resolved again for their deltas, linear in the size
+    of the datasets.
+    """
+    with profiler.stage('diff'):
+        old_fingerprints = get_duty_fingerprints(old_dataset, duty_filter)
+        new_fingerprints = get_duty_fingerprints(new_dataset, duty_filter)
+
+        rows = []
+        for duty_id, (fingerprint, duty) in new_fingerprints.items():
+            old = old_fingerprints.get(duty_id)
+            if old is None:
+                rows.append({"Duty ID": duty_id, "Change": "added", "Field": None,
+                             "Old": None, "New": None})
+            elif old[0] != fingerprint:
+                rows.extend(get_duty_delta_rows(resolve_duty(old[1], old_dataset),
+                                                resolve_duty(duty, new_dataset), min_duration))
+        # Removed duties in the order of the old dataset
+        for duty_id in old_fingerprints:
+            if duty_id in new_fingerprints:
+                continue
+            rows.append({"Duty ID": duty_id, "Change": "removed", "Field": None,
+                         "Old": None, "New": None})
+    return rows
+
+def print_times_report(dataset_file):
+    """Print report with Duty ID, Start Time, and End Time for duties in dataset."""
+    print_reports(dataset_file, ('times',))
+
+def print_stop_names_report(dataset_file):
+    """Print report with Duty ID, Start Time, End Time, Start stop description, 
+    and End stop description for duties in dataset.
+    """
+    print_reports(dataset_file, ('stops',))
+
+def print_breaks_report(dataset_file, min_duration):
+    """Print report with Duty ID, Start Time, End Time, Start stop description, 
+    End stop description, Break start time, Break duration (min), and Break stop name
+    for every break over 'min_duration' minutes of all duties in dataset.
+    """
+    print_reports(dataset_file, ('breaks',), min_duration)
 
-        # TODO: Add similar tests for 'vehicles' and 'duties'
 
 def test_get_vehicle_event(test_vehicles):
     """Tests for get_vehicle_event(), valid and invalid vehicle and sequence"""
@@ -469,6 +3798,17 @@ def test_get_vehicle_event(test_vehicles):
     vehicle_event = get_vehicle_event(test_vehicles, "1", "1")
     assert vehicle_event == None
 
+    # Same lookups through the Dataset index, sequence given as int or string
+    test_dataset = Dataset({'stops': [], 'trips': [], 'vehicles': test_vehicles, 'duties': []})
+    vehicle_event = get_vehicle_event(test_dataset, "1", "0")
+    assert vehicle_event.vehicle_event_sequence == 0
+    assert vehicle_event.vehicle_event_type is VehicleEventType.pre_trip
+    assert vehicle_event['vehicle_event_type'] == "pre_trip"
+    assert vehicle_event['start_time'] == "0.03:15"
+    assert get_vehicle_event(test_dataset, "1", 0) is vehicle_event
+    assert get_vehicle_event(test_dataset, "0", "0") == None
+    assert get_vehicle_event(test_dataset, "1", "1") == None
+
 def test_get_first_service_trip(test_vehicles, test_duty_events_positive, test_duty_events_negative):
     """Tests for get_first_service_trip(), valid and invalid duty events"""
     # Positive test: first event found
@@ -502,16 +3842,755 @@ def test_get_stop_name():
     pass
 
 def test_get_time_difference_minutes():
-    # TODO: 
-    pass
+    """Tests for parse_time(), format_time() and get_time_difference_minutes()"""
+    assert parse_time("0.03:15") == 195
+    assert parse_time("12.00:01") == 12 * 1440 + 1
+    assert parse_time('') == None
+    assert format_time(parse_time("12.03:15")) == "03:15"
+    assert format_time(None) == ''
+
+    # Difference across midnight of the service day
+    assert get_time_difference_minutes("0.23:50", "1.00:10") == 20
+
+def test_find_breaks():
+    """Tests for find_breaks(), gaps only counted inside the same duty"""
+    duty_index = [0, 0, 0, 1, 1]
+    end_times = [10, 40, 100, 200, 230]
+    start_times = [0, 30, 60, 220, 200]
+
+    # Gaps 20, 20 in duty 0, 120 between duties is ignored, 0 in duty 1
+    assert find_breaks(duty_index, end_times, start_times, 15) == [(0, 20), (1, 20)]
+    assert find_breaks(duty_index, end_times, start_times, 20) == []
 
 def test_get_event_list():
     # TODO: 
     pass
 
-def run_tests():
-    test_dataset_structure(dataset_file)
+def test_json_stream_reader():
+    """Tests for JsonStreamReader(), values split across small reads"""
+    reader = JsonStreamReader(io.StringIO('{"duties": [{"duty_id": "1"}, {"duty_id": "2"}], '
+                                          '"stops": [], "count": 1234}'), chunk_size=4)
+    values = {}
+    for key in reader.iter_object():
+        values[key] = list(reader.iter_array()) if reader.peek() == '[' else reader.decode()
+
+    assert values == {"duties": [{"duty_id": "1"}, {"duty_id": "2"}], "stops": [], "count": 1234}
+
+def test_report_writers():
+    """Tests for CsvWriter(), JsonLinesWriter() and FixedWidthWriter() on a times row"""
+    row = {"Duty ID": "1", "Start Time": "03:25", "End Time": "11:39"}
+
+    stream = io.StringIO()
+    CsvWriter(stream, 'times').write_row(row)
+    assert stream.getvalue() == "Duty ID,Start Time,End Time\n1,03:25,11:39\n"
+
+    stream = io.StringIO()
+    columns = get_combined_columns(('times', 'stops'))
+    CsvWriter(stream, 'times', columns).write_row(row)
+    CsvWriter(stream, 'stops', columns, header=False).write_row({"Duty ID": "2"})
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 3 and lines[0].startswith("Report,Duty ID,Start Time,End Time,")
+    assert lines[2].startswith("stops,2,,,")
+
+    stream = io.StringIO()
+    JsonLinesWriter(stream, 'times').write_row(row)
+    assert json.loads(stream.getvalue()) == {"Report": "times", **row}
+
+    stream = io.StringIO()
+    FixedWidthWriter(stream, 'times', {"Duty ID": 9}).write_row(row)
+    assert stream.getvalue().splitlines()[-1] == "        1       03:25     11:39"
+
+def test_profiler():
+    """Tests for Profiler() stages, counters, hooks and merge"""
+    events = []
+    test_profiler = Profiler()
+    with test_profiler.stage('load'):
+        pass
+    assert test_profiler.summary() == {'stages': {}, 'counters': {}}
+
+    test_profiler.enable()
+    test_profiler.add_hook(lambda kind, name, value: events.append((kind, name)))
+    with test_profiler.stage('load'):
+        pass
+    test_profiler.count('cache_hits')
+    test_profiler.merge({'stages': {}, 'counters': {'cache_hits': 2}})
+    assert test_profiler.summary()['counters'] == {'cache_hits': 3}
+    assert events == [('stage', 'load'), ('counter', 'cache_hits'), ('counter', 'cache_hits')]
+
+def test_validate_dataset():
+    """Tests for validate_dataset(), a valid dataset and one violation of each kind"""
+    data = {
+        "stops": [{"stop_id": "A", "stop_name": "Stop A", "latitude": 34.0,
+                   "longitude": -118.0, "is_depot": True}],
+        "trips": [{"trip_id": "1", "route_number": "10", "origin_stop_id": "A",
+                   "destination_stop_id": "A", "departure_time": "0.08:00",
+                   "arrival_time": "0.09:00"}],
+        "vehicles": [{"vehicle_id": "1", "vehicle_events": [
+            {"vehicle_event_sequence": "0", "vehicle_event_type": "service_trip",
+             "trip_id": "1", "duty_id": "1"}]}],
+        "duties": [{"duty_id": "1", "duty_events": [
+            {"duty_event_sequence": "0", "duty_event_type": "vehicle_event",
+             "vehicle_event_sequence": 0, "vehicle_id": "1"}]}]
+    }
+    assert validate_dataset(data).ok
+
+    data["stops"][0]["latitude"] = "34.0"
+    data["trips"][0]["arrival_time"] = "0.07:00"
+    data["vehicles"][0]["vehicle_events"][0]["trip_id"] = "2"
+    data["duties"][0]["duty_events"][0]["vehicle_event_sequence"] = 1
+    messages = [violation["message"] for violation in validate_dataset(data).violations]
+    assert messages == ["latitude has type str", "arrival_time before departure_time",
+                        "trip_id '2' not found", "vehicle_event_sequence ('1', 1) not found"]
+
+    # An empty time is reported, not compared
+    data["trips"][0]["departure_time"] = ""
+    messages = [violation["message"] for violation in validate_dataset(data).violations]
+    assert "departure_time is not a D.HH:MM time: ''" in messages
+    assert "arrival_time before departure_time" not in messages
 
+def test_interval_index():
+    """Tests for IntervalIndex() overlap and point queries, bounds excluded at the end"""
+    index = IntervalIndex([(600, 630, 'a'), (540, 700, 'b'), (650, 660, 'c')])
+    assert index.overlapping(630, 650) == ['b']
+    assert index.overlapping(620, 655) == ['b', 'a', 'c']
+    assert index.at(630) == ['b']
+    assert index.at(700) == []
+    assert IntervalIndex().overlapping(0, 1440) == []
+
+    # Same as a scan of every interval, with long and empty intervals mixed in
+    generator = random.Random(0)
+    intervals = [(start, start + generator.choice((0, 5, 30, 300, 1500)), number)
+                 for number, start in enumerate(generator.randrange(0, 2880) for _ in range(300))]
+    intervals.sort(key=lambda interval: interval[0])
+    index = IntervalIndex(intervals)
+    for start in range(0, 2880, 37):
+        assert index.overlapping(start, start + 20) == [
+            item for interval_start, interval_end, item in intervals
+            if interval_start < start + 20 and interval_end > start]
+
+def test_decode_json():
+    """Tests for decode_json(), the same data with every installed backend"""
+    content = b'{"stops": [{"stop_id": "A", "latitude": 34.05, "is_depot": false}], "n": [1, "2"]}'
+    for backend in get_json_backends():
+        assert decode_json(content, backend) == json.loads(content), backend
+
+def test_get_layover_rows():
+    """Tests for get_layover_rows(), gaps at the destination of the earlier event"""
+    dataset = Dataset({"stops": [{"stop_id": "A", "stop_name": "Depot", "is_depot": True},
+                                 {"stop_id": "B", "stop_name": "Stop B"}],
+                       "trips": [], "vehicles": [], "duties": []})
+    events = [(180, 200, "A"), (230, 240, "B"), None, (250, 260, "B"), (300, 320, "A")]
+    rows = get_layover_rows("1", events, dataset, min_duration=15)
+    assert [(row["Layover start time"], row["Layover duration"], row["Layover stop name"],
+             row["At depot"]) for row in rows] == [("03:20", 30, "Depot", "yes"),
+                                                   ("04:20", 40, "Stop B", "no")]
+    assert get_layover_rows("1", events, dataset, 15, window=(0, 200)) == []
+
+def test_sweep_occupancy():
+    """Tests for sweep_occupancy(), back to back intervals do not overlap"""
+    intervals = [(600, 630), (630, 660), (610, 640), (700, 760)]
+    peak, peak_start, peak_end, series = sweep_occupancy(intervals, resolution=30)
+    assert (peak, peak_start, peak_end) == (2, 610, 640)
+    assert series == [(600, 2), (630, 2), (660, 0), (690, 1), (720, 1), (750, 1)]
+    assert sweep_occupancy([]) == (0, None, None, [])
+
+def test_stop_grid():
+    """Tests for StopGrid() proximity, nearest and cluster queries"""
+    stops = [Stop({"stop_id": stop_id, "stop_name": stop_id, "latitude": latitude,
+                   "longitude": -117.75, "is_depot": stop_id == "D"})
+             for stop_id, latitude in (("A", 34.0), ("B", 34.0001), ("C", 34.01), ("D", 34.1))]
+    stops.append(Stop({"stop_id": "E", "stop_name": "E"}))
+    grid = StopGrid(stops)
+    assert len(grid) == 4
+    assert [stop.stop_id for _, stop in grid.within(34.0, -117.75, 500)] == ["A", "B"]
+    distance, stop = grid.nearest(34.05, -117.75)
+    assert stop.stop_id == "C" and round(distance) == 4448
+    assert [[stop.stop_id for stop in cluster] for cluster in grid.clusters(25)] == [
+        ["A", "B"], ["C"], ["D"]]
+    assert StopGrid([]).nearest(34.0, -117.75) is None
+
+def test_diff_datasets():
+    """Tests for diff_datasets(), only the fields that moved are listed"""
+    def make_data(end_time, duty_ids):
+        return {"stops": [{"stop_id": "A", "stop_name": "Stop A"}], "trips": [],
+                "vehicles": [], "duties": [{"duty_id": duty_id, "duty_events": [{
+                    "duty_event_sequence": "0", "duty_event_type": "sign_on",
+                    "start_time": "0.05:00", "end_time": end_time,
+                    "origin_stop_id": "A", "destination_stop_id": "A"}]}
+                    for duty_id in duty_ids]}
+
+    old = Dataset(make_data("0.05:10", ["1", "5", "2", "4"]))
+    new = Dataset(make_data("0.05:20", ["1", "3"]))
+    rows = [(row["Duty ID"], row["Change"], row["Field"]) for row in diff_datasets(old, new)]
+    assert rows == [("1", "changed", "End Time"), ("1", "changed", "Event 0"),
+                    ("3", "added", None), ("5", "removed", None), ("2", "removed", None),
+                    ("4", "removed", None)]
+    assert diff_datasets(old, old) == []
+
+    # A time moved by a whole day is a change
+    rows = diff_datasets(old, Dataset(make_data("1.05:10", ["1", "5", "2", "4"])))
+    assert rows[0] == {"Duty ID": "1", "Change": "changed", "Field": "End Time",
+                       "Old": "0.05:10", "New": "1.05:10"}
+
+def make_test_data():
+    """Return the JSON data of a small dataset: two vehicles, each driven by one duty,
+    duty 1 with a 30 minute break at Stop C between its two service trips
+    """
+    def vehicle_event(sequence, event_type, start_time, end_time, origin, destination):
+        return {"vehicle_event_sequence": str(sequence), "vehicle_event_type": event_type,
+                "start_time": start_time, "end_time": end_time, "origin_stop_id": origin,
+                "destination_stop_id": destination}
+
+    def service_trip(sequence, trip_id):
+        return {"vehicle_event_sequence": str(sequence), "vehicle_event_type": "service_trip",
+                "trip_id": trip_id}
+
+    def trip(trip_id, route_number, origin, destination, departure_time, arrival_time):
+        return {"trip_id": trip_id, "route_number": route_number, "origin_stop_id": origin,
+                "destination_stop_id": destination, "departure_time": departure_time,
+                "arrival_time": arrival_time}
+
+    vehicles = [
+        {"vehicle_id": "1", "vehicle_events": [
+            vehicle_event(0, "pre_trip", "0.05:00", "0.05:10", "A", "A"),
+            vehicle_event(1, "depot_pull_out", "0.05:10", "0.05:30", "A", "B"),
+            service_trip(2, "T1"), service_trip(3, "T2"),
+            vehicle_event(4, "depot_pull_in", "0.07:00", "0.07:20", "B", "A")]},
+        {"vehicle_id": "2", "vehicle_events": [
+            vehicle_event(0, "pre_trip", "0.08:00", "0.08:10", "A", "A"),
+            vehicle_event(1, "depot_pull_out", "0.08:10", "0.08:20", "A", "B"),
+            service_trip(2, "T3")]}]
+    for vehicle in vehicles:
+        for event in vehicle["vehicle_events"]:
+            event["duty_id"] = vehicle["vehicle_id"]
+
+    return {
+        "stops": [{"stop_id": "A", "stop_name": "Depot", "is_depot": True},
+                  {"stop_id": "B", "stop_name": "Stop B"},
+                  {"stop_id": "C", "stop_name": "Stop C"}],
+        "trips": [trip("T1", "10", "B", "C", "0.05:30", "0.06:00"),
+                  trip("T2", "20", "C", "B", "0.06:30", "0.07:00"),
+                  trip("T3", "30", "B", "C", "0.08:20", "0.09:00")],
+        "vehicles": vehicles,
+        "duties": [{"duty_id": vehicle["vehicle_id"], "duty_events": [
+            {"duty_event_sequence": str(sequence), "duty_event_type": "vehicle_event",
+             "vehicle_event_sequence": sequence, "vehicle_id": vehicle["vehicle_id"]}
+            for sequence in range(len(vehicle["vehicle_events"]))]} for vehicle in vehicles]
+    }
+
+def test_record_index():
+    """Tests for RecordIndex(), built once when first looked up by concurrent threads"""
+    columns = Dataset(make_test_data()).get_columns()
+    for _ in range(5):
+        index = Dataset.from_columns(columns).vehicle_event_index
+        # A build slow enough for the threads to overlap, as on a large dataset
+        get_records = index.records.get_records
+        index.records.get_records = lambda: time.sleep(0.01) or get_records()
+        barrier = threading.Barrier(8)
+        found = []
+
+        def look_up():
+            barrier.wait()
+            found.append(index.get(("1", 4)))
+
+        threads = [threading.Thread(target=look_up) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(index) == len(index.get_index()) == 8
+        assert all(event is not None and event.end_time == 440 for event in found)
+    assert pickle.loads(pickle.dumps(index)).get(("1", 4)) == index[("1", 4)]
+
+def test_dataset_cache():
+    """Tests for load_dataset() with a cache: a hit after the first load, kept when the
+    file is only touched, rebuilt when it changes, a warning on stderr if unwritable
+    """
+    data = make_test_data()
+    counters = profiler.counters
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_file = Path(directory) / "dataset.json"
+        dataset_file.write_text(json.dumps(data))
+        cache_dir = Path(directory) / "cache"
+
+        def load():
+            profiler.counters = {}
+            dataset = load_dataset(dataset_file, cache_dir=cache_dir)
+            return dataset, set(profiler.counters)
+
+        try:
+            dataset, events = load()
+            assert events == {'cache_misses'} and get_cache_file(dataset_file, cache_dir).is_file()
+            expected = build_reports(dataset)
+            dataset, events = load()
+            assert events == {'cache_hits'} and build_reports(dataset) == expected
+
+            # Touched only: the content hash matches
+            stat = os.stat(dataset_file)
+            os.utime(dataset_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            dataset, events = load()
+            assert events == {'cache_hits'} and build_reports(dataset) == expected
+
+            # Same size, another content and mtime
+            data["stops"][2]["stop_name"] = "Stop D"
+            dataset_file.write_text(json.dumps(data))
+            os.utime(dataset_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+            assert os.stat(dataset_file).st_size == stat.st_size
+            dataset, events = load()
+            assert events == {'cache_misses'}
+            assert build_reports(dataset)['breaks'][0]["Break stop name"] == "Stop D"
+            dataset, events = load()
+            assert events == {'cache_hits'}
+            assert build_reports(dataset)['breaks'][0]["Break stop name"] == "Stop D"
+
+            # A cache that cannot be written warns on stderr, stdout is left to the reports
+            cache_dir = dataset_file / "cache"
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                dataset, events = load()
+            assert stdout.getvalue() == "" and "Dataset cache not written" in stderr.getvalue()
+            assert len(dataset.duties) == 2
+        finally:
+            profiler.counters = counters
+
+def test_profiler_workers():
+    """Tests for the Profiler hooks with worker processes, called once per count.
+    The hook appends to a file, as a metrics pipeline would be fed from any process.
+    """
+    dataset = Dataset(make_test_data())
+    enabled = profiler.enabled
+    with tempfile.TemporaryDirectory() as directory:
+        metrics_file = Path(directory) / "metrics.txt"
+
+        def hook(kind, name, value):
+            if kind == 'counter':
+                with open(metrics_file, 'a') as f:
+                    f.write(f"{name} {value}\n")
+
+        profiler.enable()
+        profiler.reset()
+        profiler.add_hook(hook)
+        try:
+            list(iter_report_rows(dataset, batch_size=1, workers=2))
+            counters = profiler.summary()['counters']
+        finally:
+            profiler.remove_hook(hook)
+            profiler.reset()
+            profiler.enabled = enabled
+
+        totals = {}
+        for line in metrics_file.read_text().splitlines():
+            name, value = line.split()
+            totals[name] = totals.get(name, 0) + int(value)
+    assert counters['duties_processed'] == 2
+    assert totals == counters
+
+def test_decode_json_typed():
+    """Tests for decode_json() into the msgspec structs, the same Dataset as from
+    the json module. Skipped when msgspec is not installed.
+    """
+    if msgspec is None:
+        return
+    data = make_test_data()
+    data["stops"][0].update({"latitude": 34.05, "longitude": -118.25})
+    data["duties"][0]["duty_events"].insert(0, {
+        "duty_event_sequence": "0", "duty_event_type": "sign_on", "start_time": "0.04:50",
+        "end_time": "0.05:00", "origin_stop_id": "A", "destination_stop_id": "A"})
+    content = json.dumps(data).encode()
+
+    def get_records(dataset):
+        return (dict(dataset.stop_index), dict(dataset.trip_index),
+                dict(dataset.vehicle_event_index), list(dataset.duties))
+
+    expected = get_records(Dataset(decode_json(content, 'json')))
+    for typed in (False, True):
+        decoded = decode_json(content, 'msgspec', typed)
+        assert isinstance(decoded, DatasetStruct) == typed
+        assert get_records(Dataset(decoded)) == expected, typed
+
+    # The schema is checked when typed
+    try:
+        decode_json(b'{"stops": [{"stop_name": "A"}], "trips": [], "vehicles": [], '
+                    b'"duties": []}', 'msgspec', typed=True)
+        assert False, "stop without stop_id decoded"
+    except msgspec.ValidationError:
+        pass
+
+def test_dataset_store():
+    """Tests for DatasetStore(): the same reports as the Dataset, with and without
+    filters, the store reused while the file is unchanged and imported again after
+    """
+    data = make_test_data()
+    counters = profiler.counters
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_file = Path(directory) / "dataset.json"
+        dataset_file.write_text(json.dumps(data))
+        store_file = Path(directory) / "store" / "dataset.sqlite"
+
+        def open_test_store():
+            profiler.counters = {}
+            return open_store(dataset_file, store_file), set(profiler.counters)
+
+        store = None
+        try:
+            store, events = open_test_store()
+            assert events == {'store_imports'}
+            dataset = Dataset(data)
+            assert build_reports(store) == build_reports(dataset)
+            # Batches of one duty, each with its own records
+            assert (list(iter_report_rows(store, batch_size=1))
+                    == list(iter_report_rows(dataset, batch_size=1)))
+            for duty_filter in (DutyFilter(duty_ids=["2"]), DutyFilter(vehicle_ids=["1"]),
+                                DutyFilter(duty_ids=["1"], vehicle_ids=["1", "2"]),
+                                DutyFilter(route_numbers=["30"]),
+                                DutyFilter(window=parse_window("07:30-08:30")),
+                                DutyFilter(duty_ids=["9"])):
+                assert (build_reports(store, duty_filter=duty_filter)
+                        == build_reports(dataset, duty_filter=duty_filter))
+            store.close()
+
+            store, events = open_test_store()
+            assert events == {'store_hits'}
+            assert build_reports(store) == build_reports(dataset)
+            store.close()
+
+            data["stops"][2]["stop_name"] = "Stop C North"
+            dataset_file.write_text(json.dumps(data))
+            store, events = open_test_store()
+            assert events == {'store_imports'}
+            assert build_reports(store)['breaks'][0]["Break stop name"] == "Stop C North"
+            assert build_reports(store) == build_reports(Dataset(data))
+        finally:
+            if store is not None:
+                store.close()
+            profiler.counters = counters
+
+def test_query_server():
+    """Tests for the --serve HTTP server on a free port: the duty queries against the
+    reports, the stats, a reload, and the error statuses
+    """
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    data = make_test_data()
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_file = Path(directory) / "dataset.json"
+        dataset_file.write_text(json.dumps(data))
+        server = get_query_server(dataset_file, port=0, cache_size=1)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        def request(path, method='GET'):
+            try:
+                with urlopen(Request(url + path, method=method), timeout=10) as response:
+                    return response.status, json.loads(response.read())
+            except HTTPError as e:
+                return e.code, json.loads(e.read())
+
+        def get_expected(duty_id, min_duration, dataset):
+            report_rows = build_reports(dataset, min_duration=min_duration,
+                                        duty_filter=DutyFilter(duty_ids=[duty_id]))
+            row = report_rows['stops'][0]
+            return {"duty_id": duty_id, "start_time": row["Start Time"],
+                    "end_time": row["End Time"], "start_stop": row["Start Stop Description"],
+                    "end_stop": row["End Stop Description"],
+                    "breaks": [{"start_time": row["Break start time"],
+                                "duration": row["Break duration"],
+                                "stop_name": row["Break stop name"]}
+                               for row in report_rows['breaks']]}
+
+        try:
+            dataset = Dataset(data)
+            for duty_id, min_duration in (("1", 15), ("2", 15), ("1", 30), ("1", 0), ("1", 15)):
+                status, result = request(f"/duties/{duty_id}?min_duration={min_duration}")
+                assert status == 200
+                assert result == get_expected(duty_id, min_duration, dataset), (duty_id,
+                                                                                min_duration)
+            assert request("/duties/1")[1]["breaks"][0]["duration"] == 30
+            status, stats = request("/stats")
+            assert status == 200 and stats["duties"] == 2 and stats["cached_timelines"] == 1
+            # Cache of one timeline: duty 2 evicts duty 1, read again then hit thrice
+            assert (stats["cache_hits"], stats["cache_misses"]) == (3, 3)
+
+            assert request("/duties/9")[0] == 404
+            assert request("/duties/1?min_duration=abc")[0] == 400
+            assert request("/unknown")[0] == 404
+            assert request("/stats", method='POST')[0] == 404
+
+            # A reload swaps the new dataset in, a broken file keeps the current one
+            data["stops"][2]["stop_name"] = "Stop C North"
+            dataset_file.write_text(json.dumps(data))
+            assert request("/reload", method='POST') == (200, {"reloaded": True, "duties": 2})
+            assert request("/duties/1")[1] == get_expected("1", 15, Dataset(data))
+            dataset_file.write_text("{")
+            assert request("/reload", method='POST')[0] == 500
+            assert request("/duties/1")[1]["breaks"][0]["stop_name"] == "Stop C North"
+        finally:
+            server.shutdown()
+            server.server_close()
+
+def test_batch_reports():
+    """Tests for batch_reports(): the reports of each file, a broken file and an
+    invalid one reported with an error, the profiles of the files merged
+    """
+    data = make_test_data()
+    # Valid with the stop fields make_test_data() leaves out
+    for number, stop in enumerate(data["stops"]):
+        stop.update({"latitude": 34.0 + number / 100, "longitude": -118.0,
+                     "is_depot": stop.get("is_depot", False)})
+    invalid_data = json.loads(json.dumps(data))
+    invalid_data["trips"][0]["arrival_time"] = "0.05:00"
+    enabled = profiler.enabled
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        dataset_files = [directory / "in" / name
+                         for name in ("valid.json", "broken.json", "invalid.json")]
+        dataset_files[0].parent.mkdir()
+        dataset_files[0].write_text(json.dumps(data))
+        dataset_files[1].write_text('{"stops": [')
+        dataset_files[2].write_text(json.dumps(invalid_data))
+
+        profiler.enable()
+        profiler.reset()
+        try:
+            summaries = batch_reports(dataset_files, directory / "out", 'jsonl', workers=2,
+                                      sample_rate=1.0)
+            counters = profiler.summary()['counters']
+        finally:
+            profiler.reset()
+            profiler.enabled = enabled
+
+        assert [summary["file"] for summary in summaries] == list(map(str, dataset_files))
+        assert summaries[0]["error"] is None and summaries[0]["duties"] == 2
+        assert summaries[1]["error"] and summaries[1]["rows"] is None
+        assert "arrival_time before departure_time" in summaries[2]["error"]
+        assert not Path(summaries[2]["output"]).exists()
+        assert "profile" not in summaries[0]
+        assert counters['duties_processed'] == 2
+
+        expected = io.StringIO()
+        write_reports(Dataset(data), 'jsonl', stream=expected)
+        assert Path(summaries[0]["output"]).read_text() == expected.getvalue()
+
+def test_parallel_reports():
+    """Tests for iter_report_rows() with worker processes, the rows of the serial run
+    in the same order, over shards of 3 duties given as ranges or as lists
+    """
+    data = make_test_data()
+    # Duties 1 to 10, alternating between the two vehicles
+    data["duties"] = [{**data["duties"][number % 2], "duty_id": str(number + 1)}
+                      for number in range(10)]
+    dataset = Dataset(data)
+    for duty_filter in (None, DutyFilter(vehicle_ids=["1"])):
+        serial = list(iter_report_rows(dataset, batch_size=3, duty_filter=duty_filter))
+        parallel = list(iter_report_rows(dataset, batch_size=3, workers=3,
+                                         duty_filter=duty_filter))
+        assert parallel == serial
+    assert [row["Duty ID"] for report, row in serial if report == 'times'] == ["1", "3", "5",
+                                                                                "7", "9"]
+
+    # From the cache columns, built in the parent before the workers start
+    cached = Dataset.from_columns(dataset.get_columns())
+    assert list(iter_report_rows(cached, batch_size=3, workers=3)) == list(
+        iter_report_rows(dataset, batch_size=3))
+
+def test_lookup_counters():
+    """Tests for the lookup counters of resolve_duty(), the lookups actually made"""
+    data = make_test_data()
+    # Trip T1 missing: no stop looked up for the start stop of duty 1, no event list
+    del data["trips"][0]
+    dataset = Dataset(data)
+    enabled = profiler.enabled
+    profiler.enable()
+    profiler.reset()
+    try:
+        for duty in dataset.duties:
+            resolve_duty(duty, dataset)
+        counters = profiler.summary()['counters']
+    finally:
+        profiler.reset()
+        profiler.enabled = enabled
+    assert counters == {'duties_processed': 2, 'vehicle_event_lookups': 8, 'trip_lookups': 7,
+                        'stop_lookups': 6, 'lookup_failures': 1}
+
+def test_incremental_reports():
+    """Tests for IncrementalReports() and refresh_reports(): only the duties referencing
+    a changed record recomputed, removed duties dropped, a watched file deleted
+    """
+    data = make_test_data()
+    incremental_reports = IncrementalReports(Dataset(data))
+    duty_1_rows = incremental_reports.duty_rows["1"]
+
+    # The trip of vehicle 2 arrives later: duty 2 only, the rows of duty 1 are kept
+    data["trips"][2]["arrival_time"] = "0.09:30"
+    assert incremental_reports.update(Dataset(data)) == (set(), {"2"}, set())
+    assert incremental_reports.duty_rows["1"] is duty_1_rows
+    assert incremental_reports.build_reports()["times"][1]["End Time"] == "09:30"
+
+    # A trip and a stop no duty references change nothing
+    data["trips"].append({**data["trips"][0], "trip_id": "T9"})
+    data["stops"].append({"stop_id": "D", "stop_name": "Stop D"})
+    assert incremental_reports.update(Dataset(data)) == (set(), set(), set())
+
+    # The stop of the break renamed, also the end stop of duty 2
+    data["stops"][2]["stop_name"] = "Stop C North"
+    assert incremental_reports.update(Dataset(data)) == (set(), {"1", "2"}, set())
+    report_rows = incremental_reports.build_reports()
+    assert report_rows["breaks"][0]["Break stop name"] == "Stop C North"
+    assert report_rows["stops"][1]["End Stop Description"] == "Stop C North"
+
+    # Duty 1 removed with its vehicle, then added back
+    removed_data = {**data, "vehicles": data["vehicles"][1:], "duties": data["duties"][1:]}
+    assert incremental_reports.update(Dataset(removed_data)) == (set(), set(), {"1"})
+    report_rows = incremental_reports.build_reports()
+    assert report_rows["breaks"] == []
+    assert [row["Duty ID"] for row in report_rows["times"]] == ["2"]
+    assert incremental_reports.update(Dataset(data)) == ({"1"}, set(), set())
+    assert incremental_reports.build_reports() == build_reports(Dataset(data))
+
+    # A watched file deleted: refresh_reports() raises and the reports are kept, until
+    # the file is written again
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_file = Path(directory) / "dataset.json"
+        dataset_file.write_text(json.dumps(data))
+        signature = get_file_signature(dataset_file)
+        incremental_reports = IncrementalReports(load_dataset(dataset_file))
+        assert refresh_reports(dataset_file, signature, incremental_reports)[1] is None
+
+        dataset_file.unlink()
+        try:
+            refresh_reports(dataset_file, signature, incremental_reports)
+            assert False, "deleted file refreshed"
+        except FileNotFoundError:
+            pass
+        assert len(incremental_reports.build_reports()["times"]) == 2
+
+        data["duties"] = data["duties"][:1]
+        dataset_file.write_text(json.dumps(data))
+        signature, changes = refresh_reports(dataset_file, signature, incremental_reports)
+        assert changes == (set(), set(), {"2"})
+        assert signature == get_file_signature(dataset_file)
+        assert refresh_reports(dataset_file, signature, incremental_reports)[1] is None
+
+def test_fleet_aggregator():
+    """Tests for FleetAggregator(): the groupings of the breaks, the minutes of the
+    vehicles driven by a duty only, duties without events, batch sizes and filters
+    """
+    data = make_test_data()
+    # Vehicle 3: a 30 minute break at Stop B before any service trip, away from
+    # the depot. Vehicle 4 is driven by no duty, duty 4 has no events.
+    data["vehicles"] += [
+        {"vehicle_id": "3", "vehicle_events": [
+            {"vehicle_event_sequence": "0", "vehicle_event_type": "pre_trip",
+             "start_time": "0.10:00", "end_time": "0.10:10", "origin_stop_id": "B",
+             "destination_stop_id": "B", "duty_id": "3"},
+            {"vehicle_event_sequence": "1", "vehicle_event_type": "deadhead",
+             "start_time": "0.10:40", "end_time": "0.11:00", "origin_stop_id": "B",
+             "destination_stop_id": "C", "duty_id": "3"}]},
+        {"vehicle_id": "4", "vehicle_events": [
+            {"vehicle_event_sequence": "0", "vehicle_event_type": "pre_trip",
+             "start_time": "0.12:00", "end_time": "0.12:10", "origin_stop_id": "A",
+             "destination_stop_id": "A", "duty_id": "9"}]}]
+    data["duties"] += [
+        {"duty_id": "3", "duty_events": [
+            {"duty_event_sequence": str(sequence), "duty_event_type": "vehicle_event",
+             "vehicle_event_sequence": sequence, "vehicle_id": "3"} for sequence in (0, 1)]},
+        {"duty_id": "4", "duty_events": []}]
+    dataset = Dataset(data)
+
+    aggregator = FleetAggregator(dataset)
+    aggregator.add_duties(dataset.duties)
+    # Sorted by minutes, ties in the order found; no route or depot grouped as ''
+    assert aggregator.get_rows('break_minutes_by_stop') == [
+        {"Stop": "Stop C", "Breaks": 1, "Break minutes": 30},
+        {"Stop": "Stop B", "Breaks": 1, "Break minutes": 30}]
+    assert aggregator.get_rows('break_minutes_by_route') == [
+        {"Route": "10", "Breaks": 1, "Break minutes": 30},
+        {"Route": "", "Breaks": 1, "Break minutes": 30}]
+    assert aggregator.get_rows('break_minutes_by_depot') == [
+        {"Depot": "Depot", "Breaks": 1, "Break minutes": 30},
+        {"Depot": "", "Breaks": 1, "Break minutes": 30}]
+
+    vehicle_minutes = {row["Vehicle ID"]: row for row in aggregator.get_rows('vehicle_minutes')}
+    assert list(vehicle_minutes) == ["1", "2", "3"]
+    assert vehicle_minutes["1"] == {
+        "Vehicle ID": "1", "pre_trip": 10, "depot_pull_out": 20, "service_trip": 60,
+        "deadhead": 0, "depot_pull_in": 20, "attendance": 0, "Total minutes": 110}
+    assert (vehicle_minutes["3"]["pre_trip"], vehicle_minutes["3"]["deadhead"]) == (10, 20)
+
+    # Duty 4, without events, has no length
+    assert aggregator.get_rows('duty_lengths') == [
+        {"Duty length": "1-2 h", "Duties": 2, "Duty minutes": 120},
+        {"Duty length": "2-3 h", "Duties": 1, "Duty minutes": 140}]
+
+    # Totals kept across batches are the same whatever their size
+    single_aggregator = FleetAggregator(dataset)
+    single_aggregator.add_duties(dataset.duties, batch_size=1)
+    for aggregate in AGGREGATES:
+        assert single_aggregator.get_rows(aggregate) == aggregator.get_rows(aggregate), aggregate
+
+    # Filtered duties only, none selected gives empty reports
+    aggregates = build_aggregates(dataset, duty_filter=DutyFilter(vehicle_ids=["3"]))
+    assert aggregates['break_minutes_by_stop'] == [
+        {"Stop": "Stop B", "Breaks": 1, "Break minutes": 30}]
+    assert [row["Vehicle ID"] for row in aggregates['vehicle_minutes']] == ["3"]
+    aggregates = build_aggregates(dataset, duty_filter=DutyFilter(duty_ids=["9"]))
+    assert all(rows == [] for rows in aggregates.values())
+
+def test_duty_filter():
+    """Tests for DutyFilter(): each filter and its edge cases, unknown and empty IDs,
+    window bounds, missing records, and the pushdown to the dataset load
+    """
+    data = make_test_data()
+    dataset = Dataset(data)
+
+    def selected(duty_filter, dataset=dataset):
+        return [duty.duty_id for duty in duty_filter.filter(dataset.duties, dataset)]
+
+    # Empty filters select every duty, unknown IDs and routes none
+    assert not DutyFilter(duty_ids=[], vehicle_ids=[], route_numbers=[])
+    assert selected(DutyFilter(duty_ids=[])) == ["1", "2"]
+    assert selected(DutyFilter(duty_ids=["9"])) == []
+    assert selected(DutyFilter(vehicle_ids=["9"])) == []
+    assert selected(DutyFilter(route_numbers=["99"])) == []
+    assert list(iter_report_rows(dataset, duty_filter=DutyFilter(route_numbers=["99"]))) == []
+
+    # Filters combined must all match
+    assert selected(DutyFilter(duty_ids=["1", "9"], vehicle_ids=["1", "2"])) == ["1"]
+    assert selected(DutyFilter(duty_ids=["1"], route_numbers=["30"])) == []
+
+    # Duty 1 runs 05:00-07:20 and duty 2 08:00-09:00, the window end excluded
+    assert selected(DutyFilter(window=parse_window("07:20-08:00"))) == []
+    assert selected(DutyFilter(window=parse_window("07:19-08:01"))) == ["1", "2"]
+    assert selected(DutyFilter(window=parse_window("0.08:30-0.08:31"))) == ["2"]
+    try:
+        parse_window("08:00")
+        assert False, "window without an end parsed"
+    except argparse.ArgumentTypeError:
+        pass
+
+    # A duty whose last vehicle event or trip is missing matches no window or route
+    broken_data = make_test_data()
+    del broken_data["trips"][2]
+    broken_dataset = Dataset(broken_data)
+    assert selected(DutyFilter(window=(0, 1440)), broken_dataset) == ["1"]
+    assert selected(DutyFilter(route_numbers=["30"]), broken_dataset) == []
+
+    # Pushed down: only the records of the selected duties are indexed, from the
+    # JSON data and from the cache columns
+    columns = dataset.get_columns()
+    for filtered in (Dataset(data, DutyFilter(vehicle_ids=["2"])),
+                     Dataset.from_columns(columns, DutyFilter(vehicle_ids=["2"]))):
+        assert [duty.duty_id for duty in filtered.duties] == ["2"]
+        assert {key[0] for key in filtered.vehicle_event_index} == {"2"}
+        assert set(filtered.trip_index) == {"T3"}
+    for filtered in (Dataset(data, DutyFilter(duty_ids=["9"])),
+                     Dataset.from_columns(columns, DutyFilter(duty_ids=["9"]))):
+        assert list(filtered.duties) == [] and len(filtered.vehicle_event_index) == 0
+        assert len(filtered.trip_index) == 0
+
+def run_tests():
     test_duty_events_positive = [
         {
             "duty_event_sequence": "0",
@@ -568,32 +4647,439 @@ def run_tests():
     test_get_vehicle_event(test_vehicles)
     test_get_first_service_trip(test_vehicles, test_duty_events_positive, test_duty_events_negative)
     test_get_last_service_trip(test_vehicles, test_duty_events_positive, test_duty_events_negative)
+    test_json_stream_reader()
+    test_get_time_difference_minutes()
+    test_find_breaks()
+    test_report_writers()
+    test_profiler()
+    test_validate_dataset()
+    test_interval_index()
+    test_decode_json()
+    test_get_layover_rows()
+    test_sweep_occupancy()
+    test_stop_grid()
+    test_diff_datasets()
+    test_record_index()
+    test_dataset_cache()
+    test_decode_json_typed()
+    test_dataset_store()
+    test_query_server()
+    test_batch_reports()
+    test_parallel_reports()
+    test_lookup_counters()
+    test_profiler_workers()
+    test_incremental_reports()
+    test_fleet_aggregator()
+    test_duty_filter()
+
+
+def parse_window(value):
+    """Return a "START-END" time window as (start, end) integer minutes"""
+    start, separator, end = value.partition('-')
+    if not separator:
+        raise argparse.ArgumentTypeError(f"invalid window: {value!r}, expected START-END")
+    return parse_query_time(start), parse_query_time(end)
+
+def add_dataset_arguments(parser):
+    """Add the dataset file, cache, validation, profile and test options shared by
+    every subcommand
+    """
+    parser.add_argument('dataset_file', type=Path,
+                        help="JSON dataset file, or with --batch a directory or glob pattern "
+                             "of dataset files")
+    parser.add_argument('--cache-dir', type=Path, default=get_cache_dir(),
+                        help="Directory of the parsed dataset cache (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Parse the JSON file without reading or writing the cache")
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help="Parse the JSON file and replace its cache")
+    parser.add_argument('--json-backend', choices=tuple(JSON_BACKENDS),
+                        help="JSON decoder of the dataset file (default: the fastest "
+                             f"installed, here {get_json_backends()[0]})")
+    parser.add_argument('--validate', choices=('full', 'sample', 'skip'), default='full',
+                        help="Check the schema and references of the dataset before the "
+                             "reports: every record (default), a random --sample-rate of "
+                             "them, or none for trusted files. Not done with --stream")
+    parser.add_argument('--sample-rate', type=float, default=0.05, metavar='RATE',
+                        help="Fraction of the records checked by --validate sample "
+                             "(default: %(default)s)")
+    parser.add_argument('--profile', action='store_true',
+                        help="Print the time of each stage and the lookup, cache and duty "
+                             "counters to standard error at the end")
+    parser.add_argument('--profile-output', type=Path, metavar='FILE',
+                        help="Write the profile as JSON to FILE (implies --profile)")
+    parser.add_argument('--no-tests', action='store_true',
+                        help="Skip the self tests run before the reports")
+
+def add_output_arguments(parser):
+    """Add the output format and directory options"""
+    parser.add_argument('--output-format', choices=('table',) + tuple(OUTPUT_FORMATS),
+                        default='table',
+                        help="table: tabulate tables (default); csv, jsonl, fixed: rows written "
+                             "as they are produced, fixed as tables with pre-computed widths")
+    parser.add_argument('--output-dir', type=Path,
+                        help="Write each report to its own file in this directory "
+                             "(csv, jsonl and fixed formats)")
+
+def add_filter_arguments(parser, duty_filters=True):
+    """Add the minimum break and the duty filter options, only the vehicle and
+    window filters without 'duty_filters'
+    """
+    parser.add_argument('--min-break', type=int, default=15, metavar='MINUTES',
+                        help="Breaks are gaps between events over MINUTES (default: %(default)s)")
+    if duty_filters:
+        parser.add_argument('--duty-id', action='append', metavar='ID',
+                            help="Only this duty, can be repeated")
+    parser.add_argument('--vehicle-id', action='append', metavar='ID',
+                        help="Only the duties driving this vehicle, can be repeated")
+    if duty_filters:
+        parser.add_argument('--route-number', action='append', metavar='ROUTE',
+                            help="Only the duties with a service trip of this route, "
+                                 "can be repeated")
+    parser.add_argument('--window', type=parse_window, metavar='START-END',
+                        help="Only the duties overlapping this time window, "
+                             "e.g. 0.06:00-0.10:00 or 06:00-10:00")
+
+def add_report_arguments(parser):
+    """Add the options of the duty reports: the execution modes and the break queries"""
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help="Resolve the duties in N parallel processes (default: 1), "
+                             "with --batch process N files at a time (default: CPU count)")
+    # One way of running the reports at a time
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--stream', action='store_true',
+                       help="Index stops, trips and vehicles and read the duties one at a time "
+                            "instead of loading the whole file (for very large datasets)")
+    modes.add_argument('--watch', action='store_true',
+                       help="Keep running and print the reports again whenever the dataset "
+                            "file changes, recomputing only the affected duties")
+    modes.add_argument('--serve', action='store_true',
+                       help="Keep the dataset in memory and answer per-duty queries over HTTP "
+                            "instead of printing the reports")
+    modes.add_argument('--batch', action='store_true',
+                       help="Write the reports of every dataset file matched by dataset_file "
+                            "to --output-dir, one file each, plus a summary.csv")
+    modes.add_argument('--store', type=Path, metavar='FILE',
+                       help="Import the dataset into this SQLite file, unless it is up to "
+                            "date, and run the reports from it with bounded memory")
+    parser.add_argument('--interval', type=float, default=0.5, metavar='SECONDS',
+                        help="Seconds between checks of the dataset file in --watch mode "
+                             "(default: %(default)s)")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address of the --serve HTTP server (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="Port of the --serve HTTP server (default: %(default)s)")
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='N',
+                        help="Resolved duties kept in memory by --serve (default: %(default)s)")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help="Start files of a --batch only while their estimated memory "
+                             "stays under MB megabytes")
+    parser.add_argument('--rebuild-store', action='store_true',
+                        help="Import the dataset into the --store file even if up to date")
+    parser.add_argument('--breaks-at', type=parse_query_time, metavar='TIME',
+                        help="Print the breaks in progress at TIME (HH:MM or D.HH:MM) "
+                             "instead of the reports")
+    parser.add_argument('--breaks-between', type=parse_query_time, nargs=2,
+                        metavar=('START', 'END'),
+                        help="Print the breaks overlapping START to END instead of the reports")
+    parser.add_argument('--stop',
+                        help="Only the breaks at this stop, by ID or name, with --breaks-at "
+                             "or --breaks-between")
+    parser.add_argument('--near', type=parse_point, metavar='LATITUDE,LONGITUDE',
+                        help="Print the breaks at the stops within --radius of this point, "
+                             "with --breaks-at or --breaks-between at these times only")
+    parser.add_argument('--radius', type=float, metavar='METERS',
+                        help="Distance of --near (default: 500)")
+
+# Reports printed by each subcommand, 'all' when none is given
+COMMAND_REPORTS = {
+    'all': REPORTS,
+    'times': ('times',),
+    'stops': ('stops',),
+    'breaks': ('breaks',),
+    'fleet': AGGREGATES,
+    'layovers': VEHICLE_REPORTS,
+    'occupancy': OCCUPANCY_REPORTS,
+    'clusters': ('stop_clusters',),
+    'diff': ('duty_diff',)
+}
+
+def parse_arguments(argv):
+    """Return the command line arguments. The first argument is a subcommand, each
+    accepting only its own options; without one all the duty reports are printed.
+    """
+    if not argv or (argv[0] not in COMMAND_REPORTS and argv[0] not in ('-h', '--help')):
+        argv = ['all'] + list(argv)
+
+    parser = argparse.ArgumentParser(
+        description="Print the duty times, stop names and breaks reports of a JSON dataset "
+                    "file, or the reports of a subcommand.",
+        usage="python3 optibus_assignment.py [SUBCOMMAND] mini_json_dataset.json [options]"
+    )
+    # Options a subcommand does not accept keep these values
+    parser.set_defaults(workers=None, stream=False, watch=False, serve=False, batch=False,
+                        store=None, rebuild_store=False, memory_budget=None, breaks_at=None,
+                        breaks_between=None, stop=None, near=None, radius=None, min_break=15,
+                        resolution=60, duty_id=None, vehicle_id=None, route_number=None,
+                        window=None, new_dataset_file=None, output_format='table',
+                        output_dir=None)
+    subparsers = parser.add_subparsers(dest='command', metavar='SUBCOMMAND', required=True,
+                                       prog="python3 optibus_assignment.py")
+
+    report_help = {
+        'all': "the duty times, stops and breaks reports (default)",
+        'times': "the duty times report",
+        'stops': "the duty times and stops report",
+        'breaks': "the breaks report"
+    }
+    for command, summary in report_help.items():
+        subparser = subparsers.add_parser(command, help=summary, description=f"Print {summary}.")
+        add_dataset_arguments(subparser)
+        add_output_arguments(subparser)
+        add_filter_arguments(subparser)
+        add_report_arguments(subparser)
+
+    summary = "the break, vehicle and duty length totals of the fleet"
+    subparser = subparsers.add_parser('fleet', help=summary,
+                                      description=f"Print {summary}.")
+    add_dataset_arguments(subparser)
+    add_output_arguments(subparser)
+    add_filter_arguments(subparser)
+
+    summary = "the idle time of the vehicles between their events"
+    subparser = subparsers.add_parser('layovers', help=summary,
+                                      description=f"Print {summary}.")
+    add_dataset_arguments(subparser)
+    add_output_arguments(subparser)
+    add_filter_arguments(subparser, duty_filters=False)
+    subparser.add_argument('--stream', action='store_true',
+                           help="Read the duties one at a time instead of loading the whole file")
+
+    summary = "the peak number of buses on layover and drivers on break at each stop"
+    subparser = subparsers.add_parser('occupancy', help=summary,
+                                      description=f"Print {summary}.")
+    add_dataset_arguments(subparser)
+    add_output_arguments(subparser)
+    add_filter_arguments(subparser, duty_filters=False)
+    subparser.add_argument('--stream', action='store_true',
+                           help="Read the duties one at a time instead of loading the whole file")
+    subparser.add_argument('--resolution', type=int, default=60, metavar='MINUTES',
+                           help="Bins of the occupancy time series (default: %(default)s)")
+
+    summary = "the stops within --radius of one another"
+    subparser = subparsers.add_parser('clusters', help=summary,
+                                      description=f"Print {summary}.")
+    add_dataset_arguments(subparser)
+    add_output_arguments(subparser)
+    subparser.add_argument('--radius', type=float, default=25, metavar='METERS',
+                           help="Distance between the stops of a cluster (default: %(default)s)")
+
+    summary = "the duties changed between two versions of a dataset"
+    subparser = subparsers.add_parser('diff', help=summary,
+                                      description=f"Print {summary}.")
+    add_dataset_arguments(subparser)
+    subparser.add_argument('new_dataset_file', type=Path,
+                           help="The new version of the dataset file")
+    add_output_arguments(subparser)
+    add_filter_arguments(subparser)
 
+    args = parser.parse_args(argv)
+    args.reports = COMMAND_REPORTS[args.command]
+    args.duty_filter = DutyFilter(args.duty_id, args.vehicle_id, args.route_number, args.window)
+
+    if args.json_backend and args.json_backend not in get_json_backends():
+        parser.error(f"--json-backend {args.json_backend} is not installed")
+    if args.output_dir and args.output_format == 'table':
+        parser.error("--output-dir needs --output-format csv, jsonl or fixed")
+    if args.radius is not None and args.radius <= 0:
+        parser.error("--radius must be positive")
+    if args.resolution < 1:
+        parser.error("--resolution must be at least 1 minute")
+    if args.workers is None:
+        args.workers = os.cpu_count() if args.batch else 1
+
+    # Rules between the options of the duty reports
+    if args.batch and (args.output_dir is None or args.output_format == 'table'):
+        parser.error("--batch needs --output-dir and --output-format csv, jsonl or fixed")
+    if (args.watch or args.serve) and args.output_format != 'table':
+        parser.error("--watch and --serve print tables, they cannot be used with "
+                     "--output-format")
+    break_query = (args.breaks_at is not None or args.breaks_between is not None
+                   or args.near is not None)
+    if args.stop and args.breaks_at is None and args.breaks_between is None:
+        parser.error("--stop needs --breaks-at or --breaks-between")
+    if args.command in report_help and args.radius is not None and args.near is None:
+        parser.error("--radius needs --near")
+    if break_query and (args.watch or args.serve or args.batch or args.store):
+        parser.error("--breaks-at, --breaks-between and --near cannot be used with --watch, "
+                     "--serve, --batch or --store")
+    if args.store and args.workers > 1:
+        parser.error("--store runs the reports serially, it cannot be used with --workers")
+    if args.rebuild_store and not args.store:
+        parser.error("--rebuild-store needs --store")
+    if args.duty_filter and (args.watch or args.serve or args.batch or break_query):
+        parser.error("--duty-id, --vehicle-id, --route-number and --window filter the "
+                     "reports, not --watch, --serve, --batch or break queries")
+    return args
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Number of arguments invalid.")
-        print("Usage: python3 optibus_assignment.py mini_json_dataset.json")
-        sys.exit()
+    args = parse_arguments(sys.argv[1:])
+
+    # Keep standard output to the rows with the machine readable formats
+    log = sys.stdout if args.output_format in ('table', 'fixed') else sys.stderr
+
+    print("Running Python script:", sys.argv[0], file=log)
+    print("JSON file passed:", args.dataset_file, file=log)
+    print(file=log) # empty line
 
-    print("Running Python script:", sys.argv[0])
-    print("JSON file passed:", sys.argv[1])
-    print() # empty line
+    dataset_file = args.dataset_file
+    cache_dir = None if args.no_cache else args.cache_dir
+    set_json_backend(args.json_backend)
 
-    dataset_file = Path(sys.argv[1])
-    assert dataset_file.is_file(), "Invalid dataset file"
+    if args.batch:
+        dataset_files = get_batch_files(dataset_file)
+        assert dataset_files, "No dataset files found"
+    else:
+        assert dataset_file.is_file(), "Invalid dataset file"
 
     # Call test functions and check results
-    run_tests()
-    print("All tests passed!\n")
+    if not args.no_tests:
+        run_tests()
+        print("All tests passed!\n", file=log)
 
-    # Call function 1: Start and End Time
-    print_times_report(dataset_file)
+    if args.profile or args.profile_output:
+        profiler.enable()
 
-    # Call function 2: Start and End Stop Name
-    print_stop_names_report(dataset_file)
-    
-    # Call function 3. Breaks
-    print_breaks_report(dataset_file, 15)
+    # The profile is written however the script exits, the early exits included
+    try:
+        # Load the dataset once, from the cache when it is up to date, validated while
+        # loading. The validation is cached too, a trusted file is not validated again.
+        sample_rate = {'full': 1.0, 'sample': args.sample_rate, 'skip': None}[args.validate]
+
+        if args.batch:
+            # Each file is validated, loaded and reported in a worker process, its output
+            # named after it, the profiles of the files merged here
+            memory_budget = args.memory_budget * 1e6 if args.memory_budget else None
+            try:
+                summaries = batch_reports(dataset_files, args.output_dir, args.output_format,
+                                          args.reports, args.min_break, args.workers,
+                                          memory_budget, cache_dir, sample_rate)
+            except ValueError as e:
+                print(e.args)
+                sys.exit(1)
+            write_batch_summary(summaries, args.output_dir)
+            sys.exit(1 if any(summary["error"] for summary in summaries) else 0)
+
+        if args.store:
+            # Out of core: imported once, then the duties are read from SQLite in batches
+            dataset = open_store(dataset_file, args.store, args.rebuild_store)
+        else:
+            # Filters pushed down to the load, only the records of the selected duties are indexed
+            dataset = load_dataset(dataset_file, args.stream, cache_dir, args.rebuild_cache,
+                                   sample_rate, args.duty_filter)
+        if sample_rate and getattr(dataset, 'validation', None) and not dataset.validation.ok:
+            dataset.validation.print_report(log)
+            sys.exit(1)
+
+        if args.command == 'diff':
+            # Duties of both versions fingerprinted, only the changed ones compared field by field
+            assert args.new_dataset_file.is_file(), "Invalid new dataset file"
+            new_dataset = load_dataset(args.new_dataset_file, False, cache_dir, args.rebuild_cache,
+                                       sample_rate, args.duty_filter)
+            if sample_rate and new_dataset.validation and not new_dataset.validation.ok:
+                new_dataset.validation.print_report(log)
+                sys.exit(1)
+            rows = diff_datasets(dataset, new_dataset, args.min_break, args.duty_filter)
+            if args.output_format == 'table':
+                print_report('duty_diff', rows)
+            else:
+                write_report_rows({'duty_diff': rows}, args.output_format,
+                                  output_dir=args.output_dir)
+            print("--- END OF REPORTS ---\n", file=log)
+            sys.exit()
+
+        if args.watch:
+            # Reports printed again on every change of the dataset file, until interrupted
+            watch_reports(dataset_file, args.reports, args.min_break, args.interval, dataset)
+            sys.exit()
+
+        if args.serve:
+            # Queries answered from memory until interrupted, POST /reload reads the file again
+            serve(dataset_file, args.host, args.port, args.cache_size, cache_dir, dataset)
+            sys.exit()
+
+        if args.breaks_at is not None or args.breaks_between is not None or args.near is not None:
+            # Breaks indexed by time and stop, then queried instead of printing the reports
+            break_index = BreakIndex(dataset, args.min_break)
+            if args.breaks_at is not None:
+                breaks = break_index.at(args.breaks_at, args.stop)
+            elif args.breaks_between is not None:
+                breaks = break_index.overlapping(*args.breaks_between, args.stop)
+            else:
+                breaks = break_index.index.items
+            # Stops near the point looked up in a grid of the stops, not all of them
+            stop_grid = StopGrid(dataset.stop_index.values())
+            if args.near is not None:
+                radius = args.radius if args.radius is not None else 500
+                near_stop_names = {stop.stop_name
+                                   for _, stop in stop_grid.within(*args.near, radius)}
+                breaks = [item for item in breaks if item['stop_name'] in near_stop_names]
+            print_report('break_query',
+                         get_break_query_rows(breaks, get_nearest_depots(dataset, stop_grid)))
+            sys.exit()
+
+        if args.command == 'clusters':
+            rows = get_stop_cluster_rows(dataset, args.radius)
+            if args.output_format == 'table':
+                print_report('stop_clusters', rows)
+            else:
+                write_report_rows({'stop_clusters': rows}, args.output_format,
+                                  output_dir=args.output_dir)
+            print("--- END OF REPORTS ---\n", file=log)
+            sys.exit()
+
+        if args.command == 'fleet':
+            # Fleet totals grouped as the duties are resolved, no per-duty rows
+            aggregate_rows = build_aggregates(dataset, args.min_break, args.duty_filter)
+            if args.output_format == 'table':
+                for aggregate, rows in aggregate_rows.items():
+                    print_report(aggregate, rows)
+            else:
+                write_report_rows(aggregate_rows, args.output_format, output_dir=args.output_dir)
+            print("--- END OF REPORTS ---\n", file=log)
+            sys.exit()
+
+        if args.command in ('layovers', 'occupancy'):
+            if args.command == 'occupancy':
+                # One sweep per stop over the start and end of the layovers and breaks
+                report_rows = build_occupancy(dataset, args.min_break, args.resolution,
+                                              args.duty_filter)
+            else:
+                # One sweep per vehicle over its events sorted by sequence
+                report_rows = {'layovers': list(iter_layover_rows(dataset, args.min_break,
+                                                                  args.duty_filter))}
+            if args.output_format == 'table':
+                for report, rows in report_rows.items():
+                    print_report(report, rows)
+            else:
+                write_report_rows(report_rows, args.output_format, output_dir=args.output_dir)
+            print("--- END OF REPORTS ---\n", file=log)
+            sys.exit()
+
+        # Call functions 1, 2 and 3: Start and End Time, Start and End Stop Name, Breaks
+        # Each duty is resolved once for all three reports, duties not selected never are
+        if args.output_format == 'table':
+            print_reports(dataset, args.reports, args.min_break, workers=args.workers,
+                          duty_filter=args.duty_filter)
+        else:
+            write_reports(dataset, args.output_format, args.reports, args.min_break, args.workers,
+                          output_dir=args.output_dir, duty_filter=args.duty_filter)
+
+        print("--- END OF REPORTS ---\n", file=log)
 
-    print("--- END OF REPORTS ---\n")
+    finally:
+        if args.profile_output:
+            with open(args.profile_output, 'w') as f:
+                json.dump(profiler.summary(), f, indent=2)
+        elif args.profile:
+            profiler.print_summary()